@@ -0,0 +1,51 @@
+# coding: utf-8
+
+import os, sys
+import argparse
+import json
+import logging
+
+from tmnt.parallel import fit_bow_data_parallel
+from tmnt.data_loading import load_vocab, file_to_data
+from tmnt.common_params import get_base_argparser
+from tmnt.utils.log_utils import logging_config
+
+parser = get_base_argparser()
+parser.description = 'Measure scaling of data-parallel bag-of-words topic model training with the number of worker processes'
+
+parser.add_argument('--config', type=str, help='Configuration file (generated by select_model.py or set by hand)')
+parser.add_argument('--worker_counts', type=str, help='Comma-separated numbers of worker processes to benchmark', default='1,2,4')
+parser.add_argument('--local_sgd_intervals', type=str, help='Comma-separated local SGD averaging intervals to benchmark (0 = synchronous SGD)', default='0')
+
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    logging_config(folder=args.save_dir, name='benchmark_parallel', level=args.log_level, console_level=args.log_level)
+    with open(args.config, 'r') as f:
+        config = json.load(f)
+    vocab = load_vocab(args.vocab_file, encoding=args.str_encoding)
+    X, y, _, _ = file_to_data(args.tr_vec_file, len(vocab))
+    num_examples = X.shape[0] * int(config['epochs'])
+    rows = []
+    traces = []
+    intervals = [int(m) for m in args.local_sgd_intervals.split(',')]
+    runs = [ (n, m) for n in [int(c) for c in args.worker_counts.split(',')] for m in intervals ]
+    for i, (n, m) in enumerate(runs):
+        ## distinct scheduler port for each run avoids waiting for the previous one to be released
+        obj, _, secs, trace = fit_bow_data_parallel(config, vocab, args.tr_vec_file, val_X=args.val_vec_file,
+                                                    num_workers=n, seed=args.seed, local_sgd_interval=m, port=9092+i)
+        rows.append((n, m, secs, num_examples / secs, obj))
+        traces.append((n, m, trace))
+    base_secs = rows[0][2]
+    print("{:>8} {:>9} {:>12} {:>14} {:>9} {:>10}".format('workers', 'interval', 'train secs', 'examples/sec', 'speedup', 'objective'))
+    for n, m, secs, rate, obj in rows:
+        print("{:>8} {:>9} {:>12.1f} {:>14.1f} {:>9.2f} {:>10.4f}".format(n, m, secs, rate, base_secs / secs, obj if obj is not None else float('nan')))
+    print()
+    print("Convergence against wall-clock time")
+    print("{:>8} {:>9} {:>6} {:>10} {:>12}".format('workers', 'interval', 'epoch', 'secs', 'elbo'))
+    for n, m, trace in traces:
+        for point in trace:
+            print("{:>8} {:>9} {:>6} {:>10.1f} {:>12}".format(n, m, point['epoch'], point['secs'],
+                                                             '{:.4f}'.format(point['elbo']) if point['elbo'] is not None else '-'))
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+import os, sys
+import io
+import json
+import asyncio
+import argparse
+
+from tmnt.serving import InferenceServer, run_load
+from tmnt.utils.log_utils import logging_config
+
+parser = argparse.ArgumentParser('Serve a trained bag-of-words topic model over HTTP with micro-batching of concurrent requests')
+parser.add_argument('--model_dir', type=str, help='Directory with the saved model (parameters, config, vocabulary and vectorizer)')
+parser.add_argument('--host', type=str, help='Host address to listen on', default='127.0.0.1')
+parser.add_argument('--port', type=int, help='Port to listen on', default=8080)
+parser.add_argument('--max_batch_size', type=int, help='Maximum number of texts per micro-batch', default=256)
+parser.add_argument('--max_latency_ms', type=float, help='Maximum milliseconds a request waits for others to join its batch', default=5.0)
+parser.add_argument('--log_level', type=str, help='Logging level', default='info')
+parser.add_argument('--load_test_file', type=str, help='Run a loopback load test with the texts in this file (one per line) instead of serving', default=None)
+parser.add_argument('--load_test_path', type=str, help='Endpoint for the load test', default='/encode')
+parser.add_argument('--concurrency', type=int, help='Number of concurrent load test connections', default=16)
+parser.add_argument('--n_requests', type=int, help='Number of load test requests', default=1000)
+parser.add_argument('--texts_per_request', type=int, help='Number of texts per load test request', default=1)
+
+args = parser.parse_args()
+
+
+async def load_test(server, texts):
+    await server.start()
+    try:
+        report = await run_load(server.host, server.port, texts, path=args.load_test_path, concurrency=args.concurrency,
+                                n_requests=args.n_requests, texts_per_request=args.texts_per_request)
+    finally:
+        await server.stop()
+    return {'load': report, 'server': server.stats()}
+
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    logging_config(folder='.', name='serve_model', level=args.log_level, console_level=args.log_level)
+    server = InferenceServer.from_saved(args.model_dir, host=args.host, port=args.port,
+                                        max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms)
+    if args.load_test_file:
+        with io.open(args.load_test_file, 'r', encoding='utf-8') as fp:
+            texts = [ l.strip() for l in fp if l.strip() ]
+        print(json.dumps(asyncio.run(load_test(server, texts)), indent=2))
+    else:
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            pass
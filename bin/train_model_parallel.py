@@ -0,0 +1,21 @@
+# coding: utf-8
+
+import os, sys
+import argparse
+
+from tmnt.trainer import train_bow_vae_parallel
+from tmnt.common_params import get_base_argparser
+
+parser = get_base_argparser()
+parser.description = 'Train a bag-of-words topic model with data-parallel training over multiple local worker processes'
+
+parser.add_argument('--config', type=str, help='Configuration file (generated by select_model.py or set by hand)')
+parser.add_argument('--num_workers', type=int, help='Number of local worker processes', default=2)
+parser.add_argument('--local_sgd_interval', type=int, help='Average parameters across workers every N batches (local SGD); 0 synchronizes gradients every batch', default=0)
+
+
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    os.environ["MXNET_STORAGE_FALLBACK_LOG_VERBOSE"] = "0"
+    train_bow_vae_parallel(args)
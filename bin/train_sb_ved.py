@@ -24,7 +24,10 @@ parser.add_argument('--json_text_key', type=str, help='Assume json list format a
 parser.add_argument('--json_label_key', type=str, help='Assume json list format and select labels using this key', default=None)
 parser.add_argument('--config', type=str, help='JSON-formatted configuration file', default=None)
 parser.add_argument('--log_level', type=str, help='Log level (info, error, debug)', default='info')
+parser.add_argument('--num_final_evals', type=int, help='Number of models to fit (with random initializations) and evaluate', default=1)
+parser.add_argument('--parallel_final_evals', type=int, help='Number of worker processes for fitting the final evaluation models in parallel (0 = sequential)', default=0)
 
 args = parser.parse_args()
 
-train_seq_bow(args)
+if __name__ == '__main__':
+    train_seq_bow(args)
@@ -1,6 +1,12 @@
+import os
+import tempfile
 import numpy as np
+import mxnet as mx
 from scipy.sparse import csr_matrix
-from tmnt.estimator import BowEstimator
+from tmnt.estimator import BowEstimator, StackedBowEstimator
+from tmnt.utils.random import seed_rng
+from tmnt.data_loading import MemmapCSRData
+from tmnt.eval_npmi import NPMICounts
 import gluonnlp as nlp
 
 X_scipy = csr_matrix(np.ones((100,100)))
@@ -17,6 +23,36 @@ def test_train_and_npmi_scipy():
     model.fit(X_scipy)
     assert(model.npmi(X_scipy, 10)[0] == 0)
 
+def test_validate_single_pass_scipy():
+    rs = np.random.RandomState(0)
+    X = csr_matrix(rs.poisson(0.3, (150, 100)).astype('float32'))
+    y = rs.randint(0, 3, 150).astype('float32')
+    ## several validation batches, the last one partial
+    model = BowEstimator(vocabulary, n_labels=3, batch_size=32, test_batch_size=64)
+    model.fit(X, y)
+    seed_rng(1)
+    v_res = model.validate(X, y, include_encodings=True)
+    ## compare with the separate passes used before single-pass validation
+    seed_rng(1)
+    ppl = model.perplexity(X)
+    assert(np.isclose(v_res['ppl'], ppl, rtol=1e-5))
+    assert(np.isclose(v_res['npmi'], model.npmi(X, 10)[0]))
+    encodings = model.transform(X)
+    assert(v_res['encodings'].shape == (150, model.n_latent))
+    assert(np.allclose(v_res['encodings'], encodings, atol=1e-4))
+    predictions = model.model.predict(mx.nd.array(X)).asnumpy()
+    assert(np.isclose(v_res['accuracy'], (np.argmax(predictions, axis=1) == y).mean()))
+
+def test_npmi_counts_over_batches():
+    X = csr_matrix(np.random.binomial(1, 0.3, (100, 100)))
+    top_k = [[0, 1, 2, 3], [2, 5, 7, 11]]
+    counts = NPMICounts(top_k)
+    counts.update(X)
+    batch_counts = NPMICounts(top_k)
+    for i in range(0, 100, 32):
+        batch_counts.update(X[i:i+32])
+    assert(abs(counts.npmi() - batch_counts.npmi()) < 1e-8)
+
 def test_train_and_transform_scipy():
     model = BowEstimator(vocabulary, batch_size=32)
     model.fit(X_scipy)
@@ -28,3 +64,177 @@ def test_train_and_get_topics_scipy():
     model.fit(X_scipy)
     model.get_topic_vectors()
     assert(True)
+
+def test_early_stopping_restores_best_scipy():
+    model = BowEstimator(vocabulary, batch_size=32, epochs=20, early_stopping_patience=2, early_stopping_metric='ppl')
+    obj, v_res = model.fit_with_validation(X_scipy, None, X_scipy, None)
+    assert(model.best_epoch <= model.stop_epoch <= 20)
+    assert(abs(model.perplexity(X_scipy) - v_res['ppl']) / v_res['ppl'] < 0.05)
+
+def test_early_stopping_restores_best_epoch_parameters_scipy():
+    X = csr_matrix(np.random.RandomState(0).binomial(1, 0.3, (100, 100)).astype('float32'))
+    model = BowEstimator(vocabulary, batch_size=32, epochs=12, early_stopping_patience=2, early_stopping_metric='ppl')
+    snapshots, reported = {}, []
+    def reporter(**kwargs):
+        reported.append(kwargs['epoch'])
+        if 'stop_epoch' not in kwargs:
+            snapshots[kwargs['epoch']] = { k: p.data().asnumpy() for k, p in model.model.collect_params().items() }
+    model.reporter = reporter
+    model.fit_with_validation(X, None, X, None)
+    for k, p in model.model.collect_params().items():
+        assert(np.array_equal(p.data().asnumpy(), snapshots[model.best_epoch][k]))
+    ## the scheduler is never told that more epochs were used than were actually trained
+    assert(max(reported) == model.stop_epoch)
+
+def test_semi_supervised_fused_aux_scipy():
+    y = np.array([i % 2 for i in range(100)], dtype='float32')
+    model = BowEstimator(vocabulary, n_labels=2, batch_size=32, fuse_aux_forward=True)
+    obj, v_res = model.fit_with_validation(X_scipy, y, X_scipy, y, aux_X=X_scipy)
+    assert(0.0 <= v_res['accuracy'] <= 1.0)
+
+def test_fused_aux_matches_separate_passes_scipy(monkeypatch):
+    rs = np.random.RandomState(0)
+    X = csr_matrix(rs.binomial(1, 0.3, (64, 100)).astype('float32'))
+    y = np.array([i % 2 for i in range(64)], dtype='float32')
+    model = BowEstimator(vocabulary, n_labels=2, batch_size=32, epochs=1)
+    model.fit(X, y)
+    ## no sampling noise and batch normalization in inference mode, so both paths compute the same function
+    monkeypatch.setattr(mx.nd, 'random_normal', lambda loc=0, scale=1, shape=None, ctx=None, **kw: mx.nd.zeros(shape, ctx=ctx))
+    orig_record = mx.autograd.record
+    monkeypatch.setattr(mx.autograd, 'record', lambda *args, **kw: orig_record(train_mode=False))
+    params = model.model.collect_params()
+    params.setattr('grad_req', 'add')
+    data = mx.nd.sparse.csr_matrix(X[:32], ctx=model.ctx)
+    aux = mx.nd.sparse.csr_matrix(X[32:], ctx=model.ctx)
+    labels = mx.nd.array(y[:32], ctx=model.ctx)
+    def grads(loss_fn):
+        params.zero_grad()
+        with mx.autograd.record():
+            total = loss_fn()
+        total.backward()
+        return total.asscalar(), { k: p.grad().asnumpy().copy() for k, p in params.items() if p.grad_req != 'null' }
+    fused_total, fused_grads = grads(lambda: model._get_fused_losses(model.model, ((data, labels),), aux)[-1])
+    sep_total, sep_grads = grads(lambda: model._get_losses(model.model, ((data, labels),))[-1] +
+                                 model._get_unlabeled_losses(model.model, aux)[-1])
+    assert(np.isclose(fused_total, sep_total, rtol=1e-4))
+    for k in sep_grads:
+        assert(np.allclose(fused_grads[k], sep_grads[k], rtol=1e-3, atol=1e-5))
+
+def test_async_validation_reports_each_epoch_scipy():
+    reported = []
+    model = BowEstimator(vocabulary, batch_size=32, epochs=3, validate_each_epoch=True, async_validation=True,
+                         reporter=lambda **kwargs: reported.append(kwargs['epoch']))
+    model.fit_with_validation(X_scipy, None, X_scipy, None)
+    assert(reported == [1, 2, 3])
+    assert(all('objective' in p for p in model.convergence_trace))
+
+def test_checkpoint_retention_scipy():
+    with tempfile.TemporaryDirectory() as tmp:
+        model = BowEstimator(vocabulary, batch_size=32, epochs=5, validate_each_epoch=True,
+                             checkpoint_dir=tmp, checkpoint_keep_last=2, checkpoint_keep_best=1)
+        model.fit_with_validation(X_scipy, None, X_scipy, None)
+        best = max(range(5), key=lambda e: model.convergence_trace[e]['objective'])
+        kept = set(f[len('model.params'):] for f in os.listdir(tmp) if f.startswith('model.params'))
+        assert(kept == {'3', '4', str(best)})
+        assert(not any(f.endswith('.tmp') for f in os.listdir(tmp)))
+        model.model.load_parameters(os.path.join(tmp, 'model.params4'))
+    with tempfile.TemporaryDirectory() as tmp:
+        ## keep_last=0 retains every checkpoint regardless of keep_best
+        model = BowEstimator(vocabulary, batch_size=32, epochs=3, validate_each_epoch=True,
+                             checkpoint_dir=tmp, checkpoint_keep_last=0, checkpoint_keep_best=1)
+        model.fit_with_validation(X_scipy, None, X_scipy, None)
+        kept = set(f[len('model.params'):] for f in os.listdir(tmp) if f.startswith('model.params'))
+        assert(kept == {'0', '1', '2'})
+
+def _train_params(epochs, state_dir, resume_from=None):
+    seed_rng(1)
+    X = csr_matrix(np.random.RandomState(0).randint(0, 3, size=(100, 100)).astype('float32'))
+    model = BowEstimator(vocabulary, batch_size=16, epochs=epochs, training_state_dir=state_dir)
+    model.fit_with_validation(X, None, None, None, resume_from=resume_from)
+    params = { k: p.data().asnumpy() for k, p in model.model._collect_params_with_prefix().items() }
+    return params, [ p['epoch'] for p in model.convergence_trace ]
+
+def _same_params(p1, p2):
+    return p1.keys() == p2.keys() and all(np.array_equal(p1[k], p2[k]) for k in p1)
+
+def test_saving_training_state_does_not_change_training_scipy():
+    with tempfile.TemporaryDirectory() as tmp:
+        plain, _ = _train_params(3, None)
+        saved, _ = _train_params(3, os.path.join(tmp, 'state'))
+    assert(_same_params(plain, saved))
+
+def test_resumed_training_restores_state_scipy():
+    with tempfile.TemporaryDirectory() as tmp:
+        partial, _ = _train_params(2, os.path.join(tmp, 'partial'))
+        ## nothing left to train: the saved parameters are restored as they were
+        restored, trace = _train_params(2, None, resume_from=os.path.join(tmp, 'partial'))
+        assert(_same_params(partial, restored))
+        assert(trace == [1, 2])
+        ## continuing is reproducible and the convergence trace picks up where it stopped
+        resumed_1, trace = _train_params(4, None, resume_from=os.path.join(tmp, 'partial'))
+        resumed_2, _ = _train_params(4, None, resume_from=os.path.join(tmp, 'partial'))
+        assert(trace == [1, 2, 3, 4])
+        assert(_same_params(resumed_1, resumed_2))
+        assert(not _same_params(resumed_1, partial))
+
+def test_resumed_training_matches_uninterrupted_scipy():
+    with tempfile.TemporaryDirectory() as tmp:
+        uninterrupted, _ = _train_params(4, None)
+        _train_params(2, os.path.join(tmp, 'state'))
+        resumed, trace = _train_params(4, None, resume_from=os.path.join(tmp, 'state'))
+    assert(trace == [1, 2, 3, 4])
+    assert(_same_params(uninterrupted, resumed))
+
+def test_stacked_seeds_validated_separately_scipy():
+    model = StackedBowEstimator(vocabulary, n_seeds=3, batch_size=32, epochs=2)
+    obj, v_res = model.fit_with_validation(X_scipy, None, X_scipy, None)
+    assert(len(model.seed_results) == 3)
+    assert(obj == max(o for o, _ in model.seed_results))
+    for s, (_, s_res) in enumerate(model.seed_results):
+        ppl = model.seed_estimator(s).perplexity(X_scipy)
+        assert(abs(ppl - s_res['ppl']) / s_res['ppl'] < 1e-4)
+
+def test_stacked_evaluation_uses_best_seed_scipy():
+    model = StackedBowEstimator(vocabulary, n_seeds=2, batch_size=32, epochs=1)
+    model.fit_with_validation(X_scipy, None, X_scipy, None)
+    seed_rng(1)
+    ppl = model.perplexity(X_scipy)
+    seed_rng(1)
+    best_ppl = model.seed_estimator(model.best_seed).perplexity(X_scipy)
+    assert(abs(ppl - best_ppl) < 1e-4 * best_ppl)
+    v_res = model.validate(X_scipy, None)
+    assert(v_res['ppl'] > 0 and 'npmi' in v_res)
+    assert(model.transform(X_scipy).shape == (100, model.n_latent))
+
+def test_stacked_forward_matches_unstacked_models_scipy(monkeypatch):
+    model = StackedBowEstimator(vocabulary, n_seeds=3, batch_size=32, epochs=1)
+    model.fit(X_scipy)
+    ## without sampling noise (and outside training mode) each copy computes the same losses as its unstacked model
+    monkeypatch.setattr(mx.nd, 'random_normal', lambda loc=0, scale=1, shape=None, ctx=None, **kw: mx.nd.zeros(shape, ctx=ctx))
+    data = mx.nd.sparse.csr_matrix(X_scipy[:16], ctx=model.ctx)
+    stacked_elbo, stacked_kl, stacked_rec = [ x.asnumpy() for x in model.model(data)[:3] ]
+    for s in range(3):
+        elbo, kl, rec = [ x.asnumpy() for x in model.model.unstack(s)(data)[:3] ]
+        assert(np.allclose(stacked_elbo[s], elbo, rtol=1e-4, atol=1e-4))
+        assert(np.allclose(stacked_kl[s], kl, rtol=1e-4, atol=1e-4))
+        assert(np.allclose(stacked_rec[s], rec, rtol=1e-4, atol=1e-4))
+
+def test_memmap_csr_data_round_trip():
+    y = np.arange(100, dtype='float32')
+    with tempfile.TemporaryDirectory() as tmp:
+        X, y_m = MemmapCSRData.save(os.path.join(tmp, 'train'), X_scipy, y).load()
+        assert((X != X_scipy).nnz == 0)
+        assert(np.all(y_m == y))
+
+def test_inferencer_encode_to_array_matches_encode_data():
+    from tmnt.inference import BowVAEInferencer
+    model = BowEstimator(vocabulary, batch_size=32)
+    model.fit(X_scipy)
+    inferencer = BowVAEInferencer(model, max_batch_size=16)
+    encs = np.array(inferencer.encode_data(X_scipy))
+    with tempfile.TemporaryDirectory() as d:
+        out = inferencer.encode_to_array(X_scipy, out_file=os.path.join(d, 'encs.npy'), batch_size=7, dtype='float64')
+        assert(out.shape == (100, model.n_latent))
+        assert(np.allclose(np.load(os.path.join(d, 'encs.npy')), encs))
+    batches = list(inferencer.iter_encode(X_scipy, batch_size=30, target_entropy=None))
+    assert([b.shape[0] for b in batches] == [30, 30, 30, 10])
@@ -0,0 +1,20 @@
+import numpy as np
+from sklearn.metrics import average_precision_score, top_k_accuracy_score
+from tmnt.eval_metrics import classification_metrics
+
+scores = np.random.rand(200, 6)
+labels = np.random.randint(0, 6, 200)
+
+def test_top_k_accuracy_matches_sklearn():
+    metrics = classification_metrics(labels, scores, top_k=(1, 3), average_precision_scores=False)
+    for k in (1, 3):
+        assert(abs(metrics['top_k'][k] - top_k_accuracy_score(labels, scores, k=k, labels=np.arange(6))) < 1e-8)
+
+def test_average_precision_matches_sklearn_in_blocks():
+    ## small blocks so that label columns are processed in several pieces
+    metrics = classification_metrics(labels, np.round(scores, 1), top_k=(), micro_ap=True, block_elements=400)
+    y = np.eye(6)[labels]
+    for c, (ap, support) in enumerate(metrics['ap_scores']):
+        assert(abs(ap - average_precision_score(y[:, c], np.round(scores, 1)[:, c])) < 1e-8)
+        assert(support == int(y[:, c].sum()))
+    assert(abs(metrics['micro_ap'] - average_precision_score(y, np.round(scores, 1), average='micro')) < 1e-8)
@@ -0,0 +1,47 @@
+# coding: utf-8
+
+import os
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+from tmnt.parallel import fit_bow_data_parallel
+import gluonnlp as nlp
+
+vocabulary = nlp.Vocab(nlp.data.Counter(['a'*i for i in range(100)]), unknown_token=None, padding_token=None, bos_token=None, eos_token=None)
+
+def _bow_config():
+    return {'lr': 0.005, 'optimizer': 'adam', 'n_latent': 10, 'enc_hidden_dim': 50, 'batch_size': 16, 'epochs': 2,
+            'coherence_loss_wt': 0.0, 'redundancy_loss_wt': 0.0, 'covar_net_layers': 1, 'num_enc_layers': 1, 'enc_dr': 0.1,
+            'latent_distribution': {'dist_type': 'gaussian'}, 'embedding': {'source': 'random', 'size': 50}}
+
+def test_fit_bow_data_parallel_two_workers():
+    X = csr_matrix(np.random.RandomState(0).binomial(1, 0.3, (128, 100)).astype('float32'))
+    with tempfile.TemporaryDirectory() as tmp:
+        obj, v_res, train_secs, trace = fit_bow_data_parallel(_bow_config(), vocabulary, X, val_X=X, num_workers=2,
+                                                              model_dir=tmp)
+        assert(np.isfinite(obj))
+        assert(train_secs > 0)
+        assert([ p['epoch'] for p in trace ] == [1, 2])
+        assert(os.path.exists(os.path.join(tmp, 'model.params')))
+        assert(os.path.exists(os.path.join(tmp, 'convergence_trace.json')))
+
+def test_parallel_final_evals_two_seeds():
+    import autogluon.core as ag
+    from tmnt.trainer import BowVAETrainer
+    X = csr_matrix(np.random.RandomState(0).binomial(1, 0.3, (128, 100)).astype('float32'))
+    config = ag.space.Dict(**_bow_config())
+    with tempfile.TemporaryDirectory() as tmp:
+        trainer = BowVAETrainer(vocabulary, X, X, log_out_dir=tmp, model_out_dir=os.path.join(tmp, 'model'),
+                                rng_seed=1, parallel_final_evals=2)
+        runs = trainer._run_final_evals(config, 2)
+        objectives = [ obj for _, obj, _, _ in runs ]
+        assert(len(runs) == 2 and all(np.isfinite(objectives)))
+        ## only the best model is loaded back from its worker's output directory
+        best = objectives.index(max(objectives))
+        assert([ m is not None for m, _, _, _ in runs ] == [ i == best for i in range(2) ])
+        best_model, best_vres = runs[best][0], runs[best][2]
+        assert(np.isclose(best_model.npmi(X, 10)[0], best_vres['npmi']))
+        ## aggregated over the seeds, the best objective, its results and its (reloaded) model are returned
+        model, obj, v_res = trainer.train_with_single_config(config, 2)
+        assert(np.isfinite(obj) and model is not None)
+        assert(np.isclose(model.npmi(X, 10)[0], v_res['npmi']))
@@ -0,0 +1,88 @@
+import multiprocessing as mp
+import numpy as np
+from scipy.sparse import csr_matrix
+
+## AMP patches MXNet operators process-wide, so each precision is run in a fresh process
+
+def _train_and_perplexity(dtype):
+    from tmnt.estimator import BowEstimator
+    from tmnt.inference import BowVAEInferencer
+    from tmnt.utils.random import seed_rng
+    from tmnt.utils.precision import init_reduced_precision
+    import gluonnlp as nlp
+    init_reduced_precision(dtype)
+    seed_rng(1234)
+    X_scipy = csr_matrix(np.ones((100,100)))
+    vocabulary = nlp.Vocab(nlp.data.Counter(['a'*i for i in range(100)]), unknown_token=None, padding_token=None, bos_token=None, eos_token=None)
+    model = BowEstimator(vocabulary, batch_size=32, epochs=10, dtype=dtype)
+    model.fit(X_scipy)
+    ppl = model.perplexity(X_scipy)
+    encodings = BowVAEInferencer(model, dtype=dtype).encode_to_array(X_scipy, use_probs=False)
+    return model.dtype, ppl, encodings
+
+def _seq_bow_train_and_encode(dtype):
+    import mxnet as mx
+    import gluonnlp as nlp
+    from tmnt.estimator import SeqBowEstimator
+    from tmnt.inference import SeqVEDInferencer
+    from tmnt.distribution import GaussianDistribution
+    from tmnt.utils.random import seed_rng
+    from tmnt.utils.precision import init_reduced_precision
+    init_reduced_precision(dtype)
+    seed_rng(1234)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta']
+    bert_vocab = nlp.vocab.BERTVocab(nlp.data.Counter(words))
+    bow_vocab = nlp.Vocab(nlp.data.Counter(words), unknown_token=None, padding_token=None, bos_token=None, eos_token=None)
+    encoder = nlp.model.BERTEncoder(num_layers=2, units=16, hidden_size=32, max_length=32, num_heads=2, dropout=0.0)
+    bert = nlp.model.BERTModel(encoder, vocab_size=len(bert_vocab), token_type_vocab_size=2, units=16, embed_size=16,
+                               use_pooler=True, use_decoder=False, use_classifier=False, prefix='bert_')
+    bert.initialize(mx.init.Normal(0.02))
+    estimator = SeqBowEstimator(bert, bert_vocab, bow_vocab=bow_vocab, n_labels=2, batch_size=4, epochs=2,
+                                latent_distribution=GaussianDistribution(4, dr=0.0), warm_start=True, log_interval=100,
+                                dtype=dtype)
+    estimator.model = estimator._get_model()
+    estimator.model.initialize_bias_terms(mx.nd.ones(len(bow_vocab)))
+    rng = np.random.RandomState(0)
+    n_docs, seq_len = 8, 8
+    input_ids = mx.nd.array(rng.randint(5, len(bert_vocab), size=(n_docs, seq_len)))
+    valid_length = mx.nd.array(rng.randint(2, seq_len+1, size=(n_docs,)))
+    type_ids = mx.nd.zeros((n_docs, seq_len))
+    bow = mx.nd.array(rng.randint(0, 3, size=(n_docs, 1, len(bow_vocab))))
+    label = mx.nd.one_hot(mx.nd.array(rng.randint(0, 2, size=(n_docs,))), 2)
+    batches = [ ((input_ids[i:i+4], valid_length[i:i+4], type_ids[i:i+4], bow[i:i+4], label[i:i+4]),) for i in range(0, n_docs, 4) ]
+    estimator.fit_with_validation(batches, None, None, n_docs)
+    texts = [ ' '.join(words[:i+1]) for i in range(len(words)) ]
+    return estimator.dtype, SeqVEDInferencer(estimator, 16, dtype=dtype).encode_texts(texts)
+
+def _run(fn, dtype):
+    with mp.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, (dtype,))
+
+def _reduced_dtype_without_init():
+    from tmnt.estimator import BowEstimator
+    import gluonnlp as nlp
+    vocabulary = nlp.Vocab(nlp.data.Counter(['a', 'b']), unknown_token=None, padding_token=None, bos_token=None, eos_token=None)
+    try:
+        BowEstimator(vocabulary, dtype='bfloat16')
+    except Exception:
+        return True
+    return False
+
+def test_reduced_precision_perplexity_drift():
+    _, ppl_32, enc_32 = _run(_train_and_perplexity, 'float32')
+    dtype, ppl_reduced, enc_reduced = _run(_train_and_perplexity, 'bfloat16')
+    assert(dtype in ('bfloat16', 'float16'))
+    assert(abs(ppl_reduced - ppl_32) / ppl_32 < 0.05)
+    assert(enc_reduced.shape == enc_32.shape)
+
+def test_reduced_precision_seq_bow_drift():
+    _, enc_32 = _run(_seq_bow_train_and_encode, 'float32')
+    dtype, enc_reduced = _run(_seq_bow_train_and_encode, 'bfloat16')
+    assert(dtype in ('bfloat16', 'float16'))
+    ## same initialization and data; reduced precision training and inference stay close to float32
+    assert(np.abs(enc_reduced - enc_32).max() / (np.abs(enc_32).max() + 1e-6) < 0.1)
+
+def test_reduced_precision_requires_explicit_init():
+    ## constructing an estimator never enables mixed precision as a side effect
+    with mp.get_context('spawn').Pool(1) as pool:
+        assert(pool.apply(_reduced_dtype_without_init))
@@ -0,0 +1,17 @@
+import numpy as np
+from tmnt.utils.recalibrate import entropy, recalibrate_scores, recalibrate_scores_batch
+
+probs = np.random.dirichlet(np.ones(10), size=50)
+
+def test_batch_recalibration_matches_rowwise():
+    batch = recalibrate_scores_batch(probs, target_entropy=1.0)
+    assert(batch.shape == probs.shape)
+    for i in range(probs.shape[0]):
+        single = recalibrate_scores(probs[i], target_entropy=1.0)
+        assert(abs(entropy(batch[i]) - entropy(single)) < 1e-3)
+        assert(np.allclose(batch[i], single, atol=1e-3))
+
+def test_batch_recalibration_single_row():
+    x = recalibrate_scores_batch(probs[0], target_entropy=2.0)
+    assert(x.shape == probs[0].shape)
+    assert(abs(x.sum() - 1.0) < 1e-8)
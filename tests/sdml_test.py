@@ -0,0 +1,25 @@
+import mxnet as mx
+from tmnt.modeling import GeneralizedSDMLLoss, ScalableSDMLLoss
+
+x1 = mx.nd.random.normal(shape=(8, 5))
+x2 = mx.nd.random.normal(shape=(6, 5))
+l1 = mx.nd.array([0, 1, 2, 0, 1, 2, 0, 1])
+l2 = mx.nd.array([0, 1, 2, 3, 0, 1])
+
+def test_scalable_sdml_matches_generalized():
+    loss = GeneralizedSDMLLoss()(x1, l1, x2, l2)
+    scalable_loss = ScalableSDMLLoss()(x1, l1, x2, l2)
+    assert(mx.nd.abs(loss - scalable_loss).max().asscalar() < 1e-4)
+
+def test_sdml_memory_bank_fifo():
+    loss_fn = ScalableSDMLLoss(memory_size=10)
+    x2.attach_grad()
+    for _ in range(3):
+        with mx.autograd.record():
+            loss = loss_fn(x1, l1, x2, l2)
+        loss.backward()
+    assert(loss_fn._memory_x.shape == (10, 5))
+    assert(x2.grad.shape == x2.shape)
+    ## outside of training the bank is used but not updated
+    loss_fn(x1, l1, x2 * 2, l2)
+    assert(mx.nd.abs(loss_fn._memory_x[:6] - x2).max().asscalar() == 0)
@@ -0,0 +1,240 @@
+import os
+import tempfile
+import numpy as np
+import mxnet as mx
+import gluonnlp as nlp
+from mxnet import gluon
+from tmnt.estimator import SeqBowEstimator, SeqBowMetricEstimator
+from tmnt.distribution import GaussianDistribution
+from tmnt.bert_handling import TokenBudgetBatchSampler, FixedSeedRandomSampler, EncodingStore
+from tmnt.data_loading import SamplerDataLoader
+from tmnt.utils.random import seed_rng
+
+bow_vocab = nlp.Vocab(nlp.data.Counter(['a'*i for i in range(1, 21)]), unknown_token=None, padding_token=None, bos_token=None, eos_token=None)
+n_docs, seq_len = 8, 8
+
+def _tiny_bert():
+    encoder = nlp.model.BERTEncoder(num_layers=2, units=16, hidden_size=32, max_length=32, num_heads=2, dropout=0.0)
+    return nlp.model.BERTModel(encoder, vocab_size=50, token_type_vocab_size=2, units=16, embed_size=16,
+                               use_pooler=True, use_decoder=False, use_classifier=False, prefix='bert_')
+
+def _batches(batch_size):
+    rng = np.random.RandomState(0)
+    input_ids = mx.nd.array(rng.randint(1, 50, size=(n_docs, seq_len)))
+    valid_length = mx.nd.array(rng.randint(2, seq_len+1, size=(n_docs,)))
+    type_ids = mx.nd.zeros((n_docs, seq_len))
+    bow = mx.nd.array(rng.randint(0, 3, size=(n_docs, 1, len(bow_vocab))))
+    label = mx.nd.one_hot(mx.nd.array(rng.randint(0, 2, size=(n_docs,))), 2)
+    return [ ((input_ids[i:i+batch_size], valid_length[i:i+batch_size], type_ids[i:i+batch_size],
+               bow[i:i+batch_size], label[i:i+batch_size]),) for i in range(0, n_docs, batch_size) ]
+
+def _estimator(batch_size, accumulation_steps, param_file, epochs=1, **kwargs):
+    bert = _tiny_bert()
+    bert.initialize(mx.init.Normal(0.02))
+    estimator = SeqBowEstimator(bert, None, bow_vocab=bow_vocab, n_labels=2, batch_size=batch_size, epochs=epochs,
+                                latent_distribution=GaussianDistribution(4, dr=0.0), warm_start=True,
+                                grad_accumulation_steps=accumulation_steps, log_interval=100, **kwargs)
+    estimator.model = estimator._get_model()
+    estimator.model.initialize_bias_terms(mx.nd.ones(len(bow_vocab)))
+    if os.path.exists(param_file):
+        estimator.model.load_parameters(param_file)
+    else:
+        ## zero decoder weights make the reconstruction loss independent of the (random) latent sample
+        estimator.model.decoder.weight.set_data(mx.nd.zeros(estimator.model.decoder.weight.shape))
+        estimator.model.save_parameters(param_file)
+    return estimator
+
+def _bert_step_gradients(monkeypatch, batch_size, accumulation_steps, param_file):
+    estimator = _estimator(batch_size, accumulation_steps, param_file)
+    bert_params = estimator.model.bert.collect_params()
+    recorded = {}
+    orig_update = gluon.Trainer.update
+    def recording_update(trainer, step_size, ignore_stale_grad=False):
+        for p in trainer._params:
+            if p.name in bert_params.keys():
+                recorded[p.name] = p.grad().asnumpy() / step_size
+        orig_update(trainer, step_size, ignore_stale_grad)
+    orig_record = mx.autograd.record
+    ## predict mode: no dropout and batch norm uses running statistics, so micro-batch losses decompose exactly
+    monkeypatch.setattr(mx.autograd, 'record', lambda *args, **kwargs: orig_record(train_mode=False))
+    monkeypatch.setattr(gluon.Trainer, 'update', recording_update)
+    estimator.fit_with_validation(_batches(batch_size), None, None, n_docs)
+    monkeypatch.undo()
+    return recorded
+
+def test_accumulated_gradients_match_large_batch(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        param_file = os.path.join(tmp, 'model.params')
+        full_grads = _bert_step_gradients(monkeypatch, n_docs, 1, param_file)
+        accum_grads = _bert_step_gradients(monkeypatch, n_docs // 4, 4, param_file)
+    assert(len(full_grads) > 0 and full_grads.keys() == accum_grads.keys())
+    for k in full_grads:
+        assert(np.allclose(full_grads[k], accum_grads[k], rtol=1e-4, atol=1e-6))
+
+class _Interrupted(Exception):
+    pass
+
+def _train_seqbow_params(monkeypatch, param_file, state_dir=None, resume_from=None, interrupt_after=None):
+    import tmnt.estimator
+    seed_rng(1)
+    estimator = _estimator(2, 1, param_file, epochs=4, training_state_dir=state_dir)
+    (input_ids, valid_length, type_ids, bow, label), = _batches(n_docs)[0]
+    dataset = gluon.data.SimpleDataset([ ((input_ids[i].asnumpy(), valid_length[i].asnumpy(), type_ids[i].asnumpy(),
+                                           bow[i].asnumpy(), label[i].asnumpy()),) for i in range(n_docs) ])
+    batchify_fn = nlp.data.batchify.Tuple(nlp.data.batchify.Tuple(*[ nlp.data.batchify.Stack() for _ in range(5) ]))
+    loader = SamplerDataLoader(dataset, sampler=FixedSeedRandomSampler(n_docs), batch_size=2, batchify_fn=batchify_fn)
+    if interrupt_after is not None:
+        orig_save = tmnt.estimator.save_training_state
+        def save_and_interrupt(state_dir, model, trainers, state, arrays=None):
+            orig_save(state_dir, model, trainers, state, arrays=arrays)
+            if state['epoch'] == interrupt_after:
+                raise _Interrupted()
+        monkeypatch.setattr(tmnt.estimator, 'save_training_state', save_and_interrupt)
+    try:
+        estimator.fit_with_validation(loader, None, None, n_docs, resume_from=resume_from)
+    except _Interrupted:
+        pass
+    finally:
+        monkeypatch.undo()
+    return { k: p.data().asnumpy() for k, p in estimator.model._collect_params_with_prefix().items() }
+
+def test_resumed_training_matches_uninterrupted(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        param_file = os.path.join(tmp, 'model.params')
+        uninterrupted = _train_seqbow_params(monkeypatch, param_file)
+        ## the learning rate schedule depends on the number of epochs, so a 4 epoch run is stopped after 2 epochs
+        _train_seqbow_params(monkeypatch, param_file, state_dir=os.path.join(tmp, 'state'), interrupt_after=2)
+        resumed = _train_seqbow_params(monkeypatch, param_file, resume_from=os.path.join(tmp, 'state'))
+    assert(uninterrupted.keys() == resumed.keys())
+    assert(all(np.array_equal(uninterrupted[k], resumed[k]) for k in uninterrupted))
+
+def test_frozen_encoder_with_encoding_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        bert = _tiny_bert()
+        bert.initialize(mx.init.Normal(0.02))
+        initial = {k: p.data().asnumpy() for k, p in bert.collect_params().items()}
+        estimator = SeqBowEstimator(bert, None, bow_vocab=bow_vocab, n_labels=2, batch_size=4, epochs=2,
+                                    freeze_encoder=True, encoding_cache_dir=tmp, log_interval=100)
+        estimator.fit_with_validation(_batches(4), _batches(4), None, n_docs)
+        estimator.fit_with_validation(_batches(2), None, None, n_docs)
+        assert(len([f for f in os.listdir(tmp) if f.endswith('.enc')]) == 1)
+        for k, p in bert.collect_params().items():
+            assert(np.array_equal(initial[k], p.data().asnumpy()))
+        ## different encoder weights or different labels for the same token ids get their own entries
+        store = EncodingStore(tmp, 'tiny')
+        enc_a, _, _ = store.get_encodings(bert, _batches(4))
+        next(iter(bert.collect_params().values())).data()[:] += 1.0
+        enc_b, _, _ = store.get_encodings(bert, _batches(4))
+        relabeled = [ ((ids, vl, tt, bow, 1.0 - lab),) for (ids, vl, tt, bow, lab), in _batches(4) ]
+        store.get_encodings(bert, relabeled)
+        assert(len([f for f in os.listdir(tmp) if f.endswith('.enc')]) == 4)
+        assert(not np.allclose(enc_a, enc_b))
+
+def test_frozen_bottom_layers():
+    bert = _tiny_bert()
+    bert.initialize(mx.init.Normal(0.02))
+    frozen = {**bert.word_embed.collect_params(), **bert.encoder.transformer_cells[0].collect_params()}
+    tuned  = bert.encoder.transformer_cells[1].collect_params()
+    frozen_initial = {k: p.data().asnumpy() for k, p in frozen.items()}
+    tuned_initial = {k: p.data().asnumpy() for k, p in tuned.items()}
+    estimator = SeqBowEstimator(bert, None, bow_vocab=bow_vocab, n_labels=2, batch_size=4, epochs=1,
+                                frozen_bert_layers=1, log_interval=100)
+    estimator.fit_with_validation(_batches(4), None, None, n_docs)
+    for k, p in frozen.items():
+        assert(p.grad_req == 'null' and np.array_equal(frozen_initial[k], p.data().asnumpy()))
+    assert(any(not np.array_equal(tuned_initial[k], p.data().asnumpy()) for k, p in tuned.items()))
+
+def test_token_budget_batch_sampler():
+    lengths = np.random.RandomState(1).randint(1, 64, size=200)
+    sampler = TokenBudgetBatchSampler(lengths, max_tokens=256)
+    batches = list(sampler)
+    assert(len(batches) == len(sampler))
+    assert(sorted(i for b in batches for i in b) == list(range(200)))
+    assert(all(len(b) * max(lengths[b]) <= 256 for b in batches))
+    assert(batches != list(sampler)) ## reshuffled on each epoch
+    assert(batches == list(TokenBudgetBatchSampler(lengths, max_tokens=256))) ## but reproducible
+
+def test_sampler_data_loader_state_round_trip():
+    from tmnt.data_loading import SamplerDataLoader, PairedDataLoader
+    lengths = np.random.RandomState(1).randint(1, 64, size=200)
+    dataset = gluon.data.SimpleDataset(list(range(200)))
+    def loader():
+        return PairedDataLoader(SamplerDataLoader(dataset, batch_sampler=TokenBudgetBatchSampler(lengths, max_tokens=256)), None)
+    trained = loader()
+    for _ in range(3):
+        list(trained)
+    state = trained.state_dict()
+    restored = loader()
+    restored.load_state_dict(state)
+    next_epoch = [ b.asnumpy().tolist() for b, _ in trained ]
+    assert(next_epoch == [ b.asnumpy().tolist() for b, _ in restored ])
+
+def _metric_items(n, n_labels, seed):
+    rng = np.random.RandomState(seed)
+    input_ids = mx.nd.array(rng.randint(1, 50, size=(n, seq_len)))
+    valid_length = mx.nd.array(rng.randint(2, seq_len+1, size=(n,)))
+    type_ids = mx.nd.zeros((n, seq_len))
+    bow = mx.nd.array(rng.randint(0, 3, size=(n, 1, len(bow_vocab))))
+    label = mx.nd.one_hot(mx.nd.array(np.arange(n) % n_labels), n_labels)
+    return (input_ids, valid_length, type_ids, bow, label)
+
+def test_cached_b_losses_match_uncached_after_refresh(monkeypatch):
+    from tmnt.data_loading import PairedDataLoader
+    bert = _tiny_bert()
+    bert.initialize(mx.init.Normal(0.02))
+    estimator = SeqBowMetricEstimator(bert, None, bow_vocab=bow_vocab, n_labels=4, batch_size=4, epochs=1,
+                                      latent_distribution=GaussianDistribution(4, dr=0.0), warm_start=True,
+                                      cache_b_encodings=True, b_refresh_steps=2, b_subset_size=4)
+    model = estimator._get_model()
+    model.initialize_bias_terms(mx.nd.ones(len(bow_vocab)))
+    a_items, b_items = _metric_items(4, 4, 0), _metric_items(8, 4, 1)
+    estimator._setup_b_cache(PairedDataLoader([a_items], [b_items]))
+    refreshes = []
+    orig_refresh = estimator._refresh_b_cache
+    def counting_refresh(m):
+        refreshes.append(estimator._b_pos)
+        orig_refresh(m)
+    monkeypatch.setattr(estimator, '_refresh_b_cache', counting_refresh)
+    def uncached_label_loss():
+        cached_items, estimator._b_items = estimator._b_items, None
+        try:
+            return estimator._get_losses(model, (a_items, b_items))[4].asscalar()
+        finally:
+            estimator._b_items = cached_items
+    def perturb_bert(seed):
+        rng = np.random.RandomState(seed)
+        for p in model.bert.collect_params().values():
+            p.set_data(p.data() + mx.nd.array(rng.normal(scale=0.05, size=p.shape)))
+    ## 8 b-side items in subsets of 4: the cache is refreshed every 2 steps, each time at the start of the b items
+    for step in range(6):
+        label_ls = estimator._get_losses(model, (a_items, b_items))[4].asscalar()
+        if step % 2 == 0:
+            ## directly after a refresh the cached encodings are those of the current model
+            assert(len(refreshes) == step // 2 + 1 and refreshes[-1] == 0)
+            assert(np.isclose(label_ls, uncached_label_loss(), rtol=1e-4, atol=1e-6))
+            _, fresh_enc = model.bert(b_items[0], b_items[2], b_items[1].astype('float32'))
+            assert(np.allclose(estimator._b_cache.asnumpy(), fresh_enc.asnumpy(), rtol=1e-4, atol=1e-6))
+        else:
+            ## b items 0-3 are taken from the cache computed before the BERT parameters changed
+            assert(len(refreshes) == step // 2 + 1 and estimator._b_steps == 2)
+            assert(not np.isclose(label_ls, uncached_label_loss(), rtol=1e-4, atol=1e-6))
+        perturb_bert(step)
+
+def test_batched_encode_texts_matches_single():
+    from tmnt.inference import SeqVEDInferencer
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta']
+    bert_vocab = nlp.vocab.BERTVocab(nlp.data.Counter(words))
+    bert = _tiny_bert()
+    bert.initialize(mx.init.Normal(0.02))
+    estimator = SeqBowEstimator(bert, bert_vocab, bow_vocab=bow_vocab, n_labels=2,
+                                latent_distribution=GaussianDistribution(4, dr=0.0))
+    estimator.model = estimator._get_model()
+    inferencer = SeqVEDInferencer(estimator, 16)
+    texts = [ ' '.join(words[:(i % len(words)) + 1]) for i in range(13) ]
+    encs = inferencer.encode_texts(texts, max_tokens=24)
+    assert(encs.shape == (13, 4))
+    for i, txt in enumerate(texts):
+        enc, _ = inferencer.encode_text(txt)
+        assert(np.allclose(encs[i], enc.asnumpy()[0], atol=1e-5))
+    streamed = list(inferencer.iter_encode_texts(texts, max_tokens=24, sort_window=5))
+    assert(sorted(i for idx, _ in streamed for i in idx) == list(range(13)))
@@ -0,0 +1,23 @@
+import asyncio
+from tmnt.serving import InferenceServer, run_load
+
+def test_micro_batching_loopback():
+    batch_sizes = []
+    def text_lengths(texts):
+        batch_sizes.append(len(texts))
+        return [ len(t) for t in texts ]
+    async def run():
+        server = InferenceServer({'/encode': text_lengths}, port=0, max_batch_size=64, max_latency_ms=20.0)
+        await server.start()
+        try:
+            report = await run_load(server.host, server.port, ['a', 'bb', 'ccc'], concurrency=16, n_requests=64)
+            results = await asyncio.gather(*[ server.batchers['/encode'].submit(['x' * i]) for i in range(5) ])
+        finally:
+            await server.stop()
+        return report, results, server.stats()
+    report, results, stats = asyncio.run(run())
+    assert(report['requests'] == 64 and report['errors'] == 0)
+    assert(results == [[0], [1], [2], [3], [4]])
+    ## concurrent requests are coalesced into fewer batches
+    assert(stats['/encode']['batches'] < 64 + 5)
+    assert(stats['/encode']['latency']['count'] == 64 + 5)
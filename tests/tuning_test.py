@@ -0,0 +1,43 @@
+# coding: utf-8
+
+import tempfile
+import numpy as np
+from scipy.sparse import csr_matrix
+from tmnt.estimator import BowEstimator
+from tmnt.tuning import ThroughputTuner, write_tuning_report, read_tuning_report
+import gluonnlp as nlp
+
+vocabulary = nlp.Vocab(nlp.data.Counter(['a'*i for i in range(100)]), unknown_token=None, padding_token=None, bos_token=None, eos_token=None)
+X = csr_matrix(np.random.RandomState(0).binomial(1, 0.3, (200, 100)).astype('float32'))
+
+def _fake_probes(docs_per_sec, peak_rss_mb):
+    ## probe results by batch size for each thread setting, in place of timing in a separate process
+    def probe_threads(spec, mode, X, y, batch_sizes, omp, engine):
+        return [ {'batch_size': b, 'docs_per_sec': docs_per_sec[b] * omp, 'peak_rss_mb': peak_rss_mb[b],
+                  'omp_threads': omp, 'engine_threads': engine} for b in batch_sizes ]
+    return probe_threads
+
+def test_batch_size_search_respects_memory_cap(monkeypatch):
+    tuner = ThroughputTuner(batch_sizes=(16, 32, 64, 1024), omp_threads=[1, 2], engine_threads=[1], memory_cap_mb=200)
+    monkeypatch.setattr(tuner, '_probe_threads', _fake_probes({16: 100.0, 32: 200.0, 64: 300.0}, {16: 100, 32: 150, 64: 250}))
+    report = tuner.tune(BowEstimator(vocabulary), X)
+    ## batch sizes larger than the data sample are not probed
+    assert(sorted(set(p['batch_size'] for p in report['probes'])) == [16, 32, 64])
+    ## batch size 64 is fastest but exceeds the memory cap
+    assert((report['best']['batch_size'], report['best']['omp_threads']) == (32, 2))
+    tuner.memory_cap_mb = 50
+    assert(tuner.tune(BowEstimator(vocabulary), X)['best'] is None)
+
+def test_tune_probes_in_worker_processes():
+    tuner = ThroughputTuner(batch_sizes=(16, 32), omp_threads=[1], engine_threads=[1], steps=2, warmup_steps=1)
+    report = tuner.tune(BowEstimator(vocabulary, batch_size=16), X, mode='inference')
+    assert(len(report['probes']) == 2 and all('error' not in p for p in report['probes']))
+    assert(report['best']['docs_per_sec'] == max(p['docs_per_sec'] for p in report['probes']))
+
+def test_tuning_report_round_trip():
+    tuner = ThroughputTuner(batch_sizes=(16,), omp_threads=[1], engine_threads=[1])
+    tuner._probe_threads = _fake_probes({16: 100.0}, {16: 10})
+    report = tuner.tune(BowEstimator(vocabulary), X)
+    with tempfile.TemporaryDirectory() as tmp:
+        write_tuning_report(report, tmp)
+        assert(read_tuning_report(tmp) == report)
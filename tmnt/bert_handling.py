@@ -16,9 +16,11 @@ from gluonnlp.model import get_model
 from gluonnlp.data import BERTTokenizer
 from gluonnlp.data.dataset import SimpleDataset, Dataset
 import json
+import hashlib
 import collections
+import scipy.sparse as sp
 from tmnt.preprocess.vectorizer import TMNTVectorizer
-from tmnt.data_loading import to_label_matrix, PairedDataLoader, RoundRobinDataLoader
+from tmnt.data_loading import to_label_matrix, PairedDataLoader, RoundRobinDataLoader, SamplerDataLoader
 from typing import Dict
 from gluonnlp.data import BERTSentenceTransform
 from itertools import accumulate
@@ -261,11 +263,221 @@ class FixedSeedRandomSampler(Sampler):
     def __len__(self):
         return self._length
 
-    
+    def state_dict(self):
+        """Epoch position of the sampler, restorable with `load_state_dict`."""
+        return {'calls': self._calls}
+
+    def load_state_dict(self, state):
+        self._calls = state['calls']
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Batch sampler that groups sequences of similar length and fills each batch up to a token budget.
+    The cost of a batch is its padded size, i.e. the number of sequences times the longest sequence length.
+    Like :class:`FixedSeedRandomSampler`, shuffling uses a fixed seed that advances with each epoch (call)
+    so that runs are reproducible.
+
+    Parameters:
+        lengths: Sequence lengths for each element of the dataset
+        max_tokens: Maximum number of (padded) tokens per batch; longer single sequences form their own batch
+        max_batch_size: Optional upper bound on the number of sequences per batch
+        shuffle: Shuffle order of sequences within same-length groups and order of batches each epoch
+        rng: Random seed
+    """
+    def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=True, rng=1234):
+        self._lengths = np.array(lengths, dtype='int64').reshape(-1)
+        self._max_tokens = max_tokens
+        self._max_batch_size = max_batch_size
+        self._shuffle = shuffle
+        self._rng = rng
+        self._calls = 0
+        self._num_batches = len(self._get_batches(np.argsort(self._lengths, kind='stable')))
+
+    def _get_batches(self, sorted_indices):
+        batches, batch, batch_max_len = [], [], 0
+        for i in sorted_indices:
+            seq_len = max(int(self._lengths[i]), 1)
+            new_max_len = max(batch_max_len, seq_len)
+            full = (len(batch) + 1) * new_max_len > self._max_tokens or \
+                (self._max_batch_size is not None and len(batch) >= self._max_batch_size)
+            if batch and full:
+                batches.append(batch)
+                batch, new_max_len = [], seq_len
+            batch.append(int(i))
+            batch_max_len = new_max_len
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        if self._shuffle:
+            self._calls += 1
+            rs = np.random.RandomState(self._rng + self._calls)
+            ## random order among sequences of equal length; stable sort keeps it within each length
+            indices = rs.permutation(len(self._lengths))
+            indices = indices[np.argsort(self._lengths[indices], kind='stable')]
+            batches = self._get_batches(indices)
+            return iter([ batches[i] for i in rs.permutation(len(batches)) ])
+        return iter(self._get_batches(np.argsort(self._lengths, kind='stable')))
+
+    def __len__(self):
+        return self._num_batches
+
+    def state_dict(self):
+        """Epoch position of the sampler, restorable with `load_state_dict`."""
+        return {'calls': self._calls}
+
+    def load_state_dict(self, state):
+        self._calls = state['calls']
+
+
+class EncodingStore(object):
+    """Disk-backed store of pooled BERT ([CLS]) encodings for a dataset, used when training with a frozen encoder.
+
+    Encodings are written once as a raw float32 file and read back as a read-only `np.memmap`; the bag-of-words
+    vectors and labels for each document are stored alongside in the same order. Entries are keyed by the 
+    encoder name, a fingerprint of the encoder parameters (so fine-tuned or warm-started encoders do not share
+    entries) and an order-independent hash of the full contents of each document (token ids, type ids,
+    bag-of-words vector and label), so a re-shuffled loader over the same data hits the same entry.
+
+    Parameters:
+        cache_dir: Directory in which to store encodings
+        model_name: Identifier for the (frozen) encoder, e.g. BERT model and dataset names
+    """
+    def __init__(self, cache_dir: str, model_name: str):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def _encoder_fingerprint(bert):
+        h = hashlib.sha1()
+        for p in bert.collect_params().values():
+            data = p.data().asnumpy()
+            h.update(str(data.shape).encode('utf-8'))
+            h.update(data.tobytes())
+        return h.hexdigest()
+
+    @staticmethod
+    def _host_batch(data):
+        seqs = data[0] if len(data) == 1 else data
+        input_ids, valid_length, type_ids, bow, label = [ x.asnumpy() for x in seqs ]
+        return input_ids, valid_length, type_ids, sp.csr_matrix(bow.reshape(bow.shape[0], -1)), label
+
+    @staticmethod
+    def _document_digests(batch):
+        input_ids, valid_length, type_ids, bow, label = batch
+        digests = []
+        for i, vl in enumerate(valid_length.astype('int64')):
+            h = hashlib.sha1(input_ids[i, :vl].astype('int32').tobytes())
+            h.update(type_ids[i, :vl].astype('int32').tobytes())
+            row = slice(bow.indptr[i], bow.indptr[i+1])
+            h.update(bow.indices[row].tobytes())
+            h.update(bow.data[row].astype('float32').tobytes())
+            h.update(np.asarray(label[i], dtype='float32').tobytes())
+            digests.append(h.hexdigest())
+        return digests
+
+    def _paths(self, key):
+        prefix = os.path.join(self.cache_dir, key)
+        return prefix + '.enc', prefix + '.bow.npz', prefix + '.labels.npy', prefix + '.json'
+
+    def _compute(self, bert, batches, key, ctx):
+        enc_file, bow_file, label_file, meta_file = self._paths(key)
+        n, units = 0, 0
+        with open(enc_file + '.tmp', 'wb') as fp:
+            for input_ids, valid_length, type_ids, _, _ in batches:
+                _, enc = bert(mx.nd.array(input_ids, dtype=input_ids.dtype, ctx=ctx),
+                              mx.nd.array(type_ids, dtype=type_ids.dtype, ctx=ctx),
+                              mx.nd.array(valid_length, dtype='float32', ctx=ctx))
+                enc = enc.asnumpy().astype('float32')
+                fp.write(enc.tobytes())
+                n, units = n + enc.shape[0], enc.shape[1]
+        sp.save_npz(bow_file, sp.vstack([ b[3] for b in batches ], format='csr'))
+        np.save(label_file, np.concatenate([ b[4] for b in batches ], axis=0))
+        with open(meta_file, 'w') as fp:
+            json.dump({'model_name': self.model_name, 'shape': [n, units]}, fp)
+        os.replace(enc_file + '.tmp', enc_file)  ## written last: an entry is complete only once this file exists
+        logging.info("Stored {} encodings of dimension {} in {}".format(n, units, enc_file))
+
+    def get_encodings(self, bert, dataloader, ctx=mx.cpu()):
+        """Get encodings for all documents in `dataloader`, computing and storing them if not already present.
+        The loader is iterated once: batches are kept in host memory while the key is computed and are encoded
+        from there when the entry is not present.
+
+        Parameters:
+            bert: BERT model used (in inference mode) to compute pooled encodings
+            dataloader: Loader providing batches of (input_ids, valid_length, type_ids, bow, label)
+            ctx: MXNet context for the BERT forward pass
+        Returns:
+            (tuple): Tuple containing:
+                - encodings (:class:`numpy.memmap`): Encodings of shape (n_docs, units)
+                - bow (:class:`scipy.sparse.csr_matrix`): Bag-of-words vectors of shape (n_docs, bow_vocab_size)
+                - labels (:class:`numpy.ndarray`): Labels for each document
+        """
+        batches, digests = [], []
+        for data in dataloader:
+            batch = self._host_batch(data)
+            batches.append(batch)
+            digests.extend(self._document_digests(batch))
+        digests.sort()
+        h = hashlib.sha1(self.model_name.encode('utf-8'))
+        h.update(self._encoder_fingerprint(bert).encode('utf-8'))
+        for d in digests:
+            h.update(d.encode('utf-8'))
+        key = h.hexdigest()
+        enc_file, bow_file, label_file, meta_file = self._paths(key)
+        if not os.path.exists(enc_file):
+            self._compute(bert, batches, key, ctx)
+        else:
+            logging.info("Using stored encodings from {}".format(enc_file))
+        with open(meta_file, 'r') as fp:
+            shape = tuple(json.load(fp)['shape'])
+        encodings = np.memmap(enc_file, dtype='float32', mode='r', shape=shape)
+        return encodings, sp.load_npz(bow_file), np.load(label_file)
+
+
+class CachedEncodingLoader(object):
+    """Data loader over precomputed encodings (e.g. from :class:`EncodingStore`). Batches have the form
+    (encodings, bow, label) with bow of shape (batch_size, 1, bow_vocab_size) as produced by `preprocess_seq_data`.
+
+    Parameters:
+        encodings: Array of encodings with shape (n_docs, units)
+        bow: Sparse bag-of-words matrix with shape (n_docs, bow_vocab_size)
+        labels: Label array with n_docs rows
+        batch_size: Batch size
+        shuffle: Shuffle each epoch; incomplete final batches are discarded when shuffling
+        singleton: Wrap each batch in a singleton tuple (as for labeled training/validation data)
+    """
+    def __init__(self, encodings, bow, labels, batch_size, shuffle=False, singleton=True):
+        self.encodings = encodings
+        self.bow = bow
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.singleton = singleton
+        self.num_examples = encodings.shape[0]
+
+    def __iter__(self):
+        indices = np.random.permutation(self.num_examples) if self.shuffle else np.arange(self.num_examples)
+        for i in range(len(self)):
+            ## sorted indices within a batch give sequential reads on the memmap
+            batch_ids = np.sort(indices[i * self.batch_size : (i+1) * self.batch_size])
+            batch = (mx.nd.array(self.encodings[batch_ids]),
+                     mx.nd.array(self.bow[batch_ids].toarray()).expand_dims(axis=1),
+                     mx.nd.array(self.labels[batch_ids]))
+            yield (batch,) if self.singleton else batch
+
+    def __len__(self):
+        if self.shuffle:
+            return max(1, self.num_examples // self.batch_size)
+        return (self.num_examples + self.batch_size - 1) // self.batch_size
 
 
 
-def preprocess_seq_data(trans, class_labels, dataset, batch_size, max_len, train_mode=True, pad=False, aux_dataset=None):
+
+def preprocess_seq_data(trans, class_labels, dataset, batch_size, max_len, train_mode=True, pad=False, aux_dataset=None, max_tokens=0):
     pool = multiprocessing.Pool()
     # transformation for data train and dev
     label_dtype = 'float32' # if not task.class_labels else 'int32'
@@ -281,7 +493,15 @@ def preprocess_seq_data(trans, class_labels, dataset, batch_size, max_len, train
         nlp.data.batchify.Tuple(
                 nlp.data.batchify.Pad(axis=0), nlp.data.batchify.Stack(),
                 nlp.data.batchify.Pad(axis=0), nlp.data.batchify.Stack(bow_count_dtype), nlp.data.batchify.Stack(label_dtype)))
-    if train_mode:
+    if max_tokens > 0:
+        # variable size batches filled up to the token budget
+        batch_sampler = TokenBudgetBatchSampler(final_ds_len, max_tokens, shuffle=train_mode)
+        loader = SamplerDataLoader(
+            dataset=final_ds,
+            num_workers=4,
+            batch_sampler=batch_sampler,
+            batchify_fn=batchify_fn)
+    elif train_mode:
         # bucket sampler 
         num_buckets = min(6, len(data_ds) // batch_size)
         batch_sampler = nlp.data.sampler.FixedBucketSampler(
@@ -362,6 +582,7 @@ def get_bert_datasets(class_labels,
                       use_bert_vocab=False,
                       label_alias=None,
                       num_classes = None,
+                      max_tokens = 0,
                       ctx=mx.cpu()):
     if class_labels is None and num_classes is None:
         raise Exception("Must provide class_labels or num_classes")
@@ -383,13 +604,15 @@ def get_bert_datasets(class_labels,
                                  vectorizer=vectorizer,
                                  bert_vocab_size = len(bert_vocabulary) if use_bert_vocab else 0,
                                  num_classes = num_classes)
-    train_data, num_train_examples = preprocess_seq_data(trans, class_labels, train_ds, batch_size, max_len, train_mode=True, pad=pad)
+    train_data, num_train_examples = preprocess_seq_data(trans, class_labels, train_ds, batch_size, max_len, train_mode=True, pad=pad,
+                                                         max_tokens=max_tokens)
     if aux_ds is not None:
         aux_data = get_aux_dataloader(trans, batch_size, aux_ds)
     else:
         aux_data = None
     if dev_ds is not None:
-        dev_data, _ = preprocess_seq_data(trans, class_labels, dev_ds, batch_size, max_len, train_mode=False, pad=pad)
+        dev_data, _ = preprocess_seq_data(trans, class_labels, dev_ds, batch_size, max_len, train_mode=False, pad=pad,
+                                          max_tokens=max_tokens)
     else:
         dev_data = None
     return train_data, dev_data, aux_data, num_train_examples, bert, bert_vocabulary
@@ -401,8 +624,10 @@ def get_bert_datasets(class_labels,
 # Handle dataloading for Smoothed Deep Metric Loss with parallel batching
 ############
 
-def preprocess_data_metriclearn(trans, class_labels, train_a_ds, train_b_ds, batch_size, max_len, pad=False, bucket_sample=False, aux_dataset=None):
-    """Train/eval Data preparation function."""
+def preprocess_data_metriclearn(trans, class_labels, train_a_ds, train_b_ds, batch_size, max_len, pad=False, bucket_sample=False, aux_dataset=None,
+                                max_tokens=0, shuffle=False):
+    """Train/eval Data preparation function. `shuffle` applies to the default and token-budget (`max_tokens`) batching;
+    the bucket sampler (`bucket_sample`) always shuffles."""
     pool = multiprocessing.Pool()
     label_dtype = 'float32' # if not task.class_labels else 'int32'
     bow_count_dtype = 'float32'
@@ -446,7 +671,15 @@ def preprocess_data_metriclearn(trans, class_labels, train_a_ds, train_b_ds, bat
             nlp.data.batchify.Tuple(
                     nlp.data.batchify.Pad(axis=0), nlp.data.batchify.Stack(),
                     nlp.data.batchify.Pad(axis=0), nlp.data.batchify.Stack(bow_count_dtype), nlp.data.batchify.Stack(label_dtype)))
-    if bucket_sample:
+    if max_tokens > 0:
+        ## token budget applies to the combined lengths of the a, b (and aux) sequences for each element
+        batch_sampler = TokenBudgetBatchSampler(final_len, max_tokens, shuffle=shuffle)
+        loader = SamplerDataLoader(
+            dataset=final_ds,
+            num_workers=4,
+            batch_sampler=batch_sampler,
+            batchify_fn=batchify_fn)
+    elif bucket_sample:
         batch_sampler = nlp.data.sampler.FixedBucketSampler(
             final_len,
             batch_size=batch_size,
@@ -462,12 +695,13 @@ def preprocess_data_metriclearn(trans, class_labels, train_a_ds, train_b_ds, bat
         loader = gluon.data.DataLoader(
             dataset=final_ds,
             num_workers=4,
-            shuffle=False, batch_size = batch_size,
+            shuffle=shuffle, batch_size = batch_size,
             batchify_fn=batchify_fn)
     return loader, len(final_ds)
 
 
-def preprocess_data_metriclearn_separate(trans1, trans2, class_labels, train_a_ds, train_b_ds, batch_size, shuffle_both=False, shuffle_a_only=True):
+def preprocess_data_metriclearn_separate(trans1, trans2, class_labels, train_a_ds, train_b_ds, batch_size, shuffle_both=False, shuffle_a_only=True,
+                                         max_tokens=0):
     """Train/eval Data preparation function."""
     pool = multiprocessing.Pool()
     label_dtype = 'float32' # if not task.class_labels else 'int32'
@@ -484,8 +718,17 @@ def preprocess_data_metriclearn_separate(trans1, trans2, class_labels, train_a_d
         nlp.data.batchify.Pad(axis=0), nlp.data.batchify.Stack(),
         nlp.data.batchify.Pad(axis=0), nlp.data.batchify.Stack(bow_count_dtype), nlp.data.batchify.Stack(label_dtype))
 
+    if max_tokens > 0 and batch_size < len(b_data_train):
+        raise Exception("Token budget batching (max_tokens) for metric learning requires all b-side items in each batch "
+                        "(batch size = {} < {})".format(batch_size, len(b_data_train)))
+
     ## set up 'parallel' samplers that always stay in sync
-    if shuffle_both:
+    if max_tokens > 0:
+        ## b-side is a single batch with all items; only a-side batches are filled up to the token budget
+        a_lengths = a_data_train.transform(lambda input_id, length, segment_id, bow, label_id: length, lazy=False)
+        a_sampler = TokenBudgetBatchSampler(a_lengths, max_tokens, shuffle=(shuffle_both or shuffle_a_only))
+        b_sampler = SequentialSampler(len(b_data_train))
+    elif shuffle_both:
         a_sampler = FixedSeedRandomSampler(len(a_data_train), rng=1234)
         b_sampler = FixedSeedRandomSampler(len(b_data_train), rng=1234)
     elif shuffle_a_only:
@@ -495,13 +738,20 @@ def preprocess_data_metriclearn_separate(trans1, trans2, class_labels, train_a_d
         a_sampler = SequentialSampler(len(a_data_train))
         b_sampler = SequentialSampler(len(b_data_train))
 
-    a_loader_train = gluon.data.DataLoader(
-        dataset=a_data_train,
-        num_workers=4,
-        last_batch = 'discard', ## need to ensure all batches are the same size here AND stay synchronized
-        sampler    = a_sampler,
-        batch_size  = batch_size,
-        batchify_fn = a_batchify_fn)
+    if max_tokens > 0:
+        a_loader_train = SamplerDataLoader(
+            dataset=a_data_train,
+            num_workers=4,
+            batch_sampler = a_sampler,
+            batchify_fn = a_batchify_fn)
+    else:
+        a_loader_train = SamplerDataLoader(
+            dataset=a_data_train,
+            num_workers=4,
+            last_batch = 'discard', ## need to ensure all batches are the same size here AND stay synchronized
+            sampler    = a_sampler,
+            batch_size  = batch_size,
+            batchify_fn = a_batchify_fn)
     b_loader_train = gluon.data.DataLoader(
         dataset=b_data_train,
         num_workers=4,
@@ -528,6 +778,7 @@ def get_dual_bert_datasets(class_labels,
                            aux_dataset = None,
                            forced_batch_size = 0, 
                            aux_batch_size = 32,
+                           max_tokens = 0,
                            ctx=mx.cpu()):
     bert, bert_vocabulary = get_model(
         name=model_name,
@@ -556,7 +807,8 @@ def get_dual_bert_datasets(class_labels,
         trans2s = [ get_transform(class_labels[i], max_len2) for i in range(len(train_ds2)) ]        
         train_sets = [
             preprocess_data_metriclearn_separate(trans1s[i], trans2s[i], class_labels[i], train_ds1[i], train_ds2[i],
-                                                 (forced_batch_size or len(train_ds2[i])), shuffle_a_only=shuffle_a_only, shuffle_both=shuffle_both)
+                                                 (forced_batch_size or len(train_ds2[i])), shuffle_a_only=shuffle_a_only, shuffle_both=shuffle_both,
+                                                 max_tokens=max_tokens)
             for i in range(len(train_ds1)) ]
         num_train_examples = list(accumulate([ s for _,s in train_sets], lambda x,y: x + y)).pop()
         loaders = [l for l,_ in train_sets]
@@ -566,7 +818,8 @@ def get_dual_bert_datasets(class_labels,
         trans1 = get_transform(class_labels, max_len1)
         trans2 = get_transform(class_labels, max_len2)
         train_data, num_train_examples = preprocess_data_metriclearn_separate(
-            trans1, trans2, class_labels, train_ds1, train_ds2, batch_size, shuffle_a_only=shuffle_a_only, shuffle_both=shuffle_both)
+            trans1, trans2, class_labels, train_ds1, train_ds2, batch_size, shuffle_a_only=shuffle_a_only, shuffle_both=shuffle_both,
+            max_tokens=max_tokens)
     if aux_dataset is not None:
         aux_trans = get_transform([], max_len1)
         aux_dataloader = get_aux_dataloader(aux_trans, aux_batch_size, aux_dataset)
@@ -9,9 +9,9 @@ from mxnet.gluon import nn
 from mxnet import autograd
 from mxnet.gluon.data import DataLoader
 import gluonnlp as nlp
-from sklearn.metrics import precision_recall_curve, average_precision_score
 
 from tmnt.inference import BowVAEInferencer
+from tmnt.eval_metrics import classification_metrics
 from tmnt.classifier.load_data import load_sparse_dataset
 from tmnt.classifier.model import DANTextClassifier, DANVAETextClassifier
 from tmnt.utils.log_utils import logging_config
@@ -102,31 +102,17 @@ def evaluate(model, dataloader, multiclass=True, ctx=mx.cpu()):
     Get predictions on the dataloader items from model
     Return metrics (accuracy, etc.)
     """
-    acc = 0
-    total_correct = 0
-    total = 0
     all_scores = []
     all_labels = []
     for i, (bow_data, data, label, mask) in enumerate(dataloader):
         out = model(bow_data, data, mask)
-        predictions = mx.nd.argmax(out, axis=1).astype('int32')
-        for j in range(out.shape[0]):
-            probs = mx.nd.softmax(out[j])
-            lab = int(label[j].asscalar())
-            if not multiclass:
-                all_scores.append(probs[1].asscalar())
-                all_labels.append(lab)
-                if probs[1] >= probs[0] and lab == 1:
-                    total_correct += 1
-                elif probs[1] < probs[0] and lab == 0:
-                    total_correct += 1
-            else:
-                #print("Lab = {}, argmax = {}".format(lab, int(np.argmax(probs.asnumpy()))))
-                if lab == int(np.argmax(probs.asnumpy())):
-                    total_correct += 1
-            total += 1
-    acc = total_correct / float(total)
-    ap = average_precision_score(all_labels, all_scores, average = 'weighted' if multiclass else 'macro') if not multiclass else 0.0
+        all_scores.append(mx.nd.softmax(out, axis=1).asnumpy())
+        all_labels.append(label.asnumpy().reshape(-1))
+    metrics = classification_metrics(np.concatenate(all_labels), np.concatenate(all_scores), top_k=(1,),
+                                     average_precision_scores=not multiclass)
+    acc = metrics['accuracy']
+    ## average precision of the positive class for binary classification
+    ap = metrics['ap_scores'][1][0] if not multiclass else 0.0
     return ap, acc
     
 
@@ -21,6 +21,10 @@ def get_base_argparser():
     parser.add_argument('--encoder_coherence', action='store_true', help='Get top K terms for coherence via encoder Jacobian', default=False)
     parser.add_argument('--optimize_encoder_coherence', action='store_true', help='Optimize encoder-derived coherence')
     parser.add_argument('--num_final_evals', type=int, help='Number of times to evaluate selected configuration (with random initializations)', default=1)
+    parser.add_argument('--stack_final_evals', action='store_true', help='Train the final evaluation models together as one stacked (multi-seed) model', default=False)
+    parser.add_argument('--parallel_final_evals', type=int, default=0, help='Number of worker processes for fitting the final evaluation models in parallel (0 = sequential)')
+    parser.add_argument('--tune_throughput', action='store_true', help='Probe and apply the batch size and thread counts with the highest training throughput', default=False)
+    parser.add_argument('--tune_memory_cap_mb', type=float, default=None, help='Memory cap (MB) for settings chosen with --tune_throughput')
     parser.add_argument('--str_encoding', type=str, default='utf-8')
     parser.add_argument('--hybridize', action='store_true', help='Use Symbolic computation graph (i.e. MXNet hybridize)')
     parser.add_argument('--use_gpu', action='store_true', help='Use GPU for fitting models', default=False)
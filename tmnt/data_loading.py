@@ -187,6 +187,40 @@ class DataIterLoader():
         return self.__next__()
 
 
+class MemmapCSRData():
+    """
+    A sparse document-term matrix (and optional labels) saved as Numpy arrays in a directory and
+    re-opened as memory-mapped arrays. Objects of this class are small and picklable, so several
+    worker processes can share one copy of the data through the operating system page cache.
+
+    Parameters:
+        path: Directory holding the arrays written by :meth:`save`
+        shape: Shape of the matrix
+    """
+    def __init__(self, path, shape):
+        self.path = path
+        self.shape = shape
+
+    @classmethod
+    def save(cls, path, X, y=None):
+        """Write CSR matrix `X` and labels `y` (optional) to directory `path` and return a handle to them."""
+        X = scipy.sparse.csr_matrix(X)
+        os.makedirs(path, exist_ok=True)
+        for name, arr in (('data', X.data), ('indices', X.indices), ('indptr', X.indptr)):
+            np.save(os.path.join(path, name + '.npy'), arr)
+        if y is not None:
+            np.save(os.path.join(path, 'labels.npy'), np.asarray(y))
+        return cls(path, X.shape)
+
+    def load(self):
+        """The matrix and labels (None if not saved) backed by read-only memory maps."""
+        arrays = [ np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r') for name in ('data', 'indices', 'indptr') ]
+        X = scipy.sparse.csr_matrix(tuple(arrays), shape=self.shape, copy=False)
+        y_file = os.path.join(self.path, 'labels.npy')
+        y = np.load(y_file, mmap_mode='r') if os.path.exists(y_file) else None
+        return X, y
+
+
 class SingletonWrapperLoader():
 
     def __init__(self, data_loader):
@@ -211,6 +245,38 @@ class SingletonWrapperLoader():
         return self.__next__()    
 
 
+def loader_state_dict(loader):
+    """State of the samplers used by `loader` (None if it has no restorable state)."""
+    return loader.state_dict() if hasattr(loader, 'state_dict') else None
+
+
+def load_loader_state_dict(loader, state):
+    """Restore a state returned by :func:`loader_state_dict` for the same loader."""
+    if state is not None:
+        if not hasattr(loader, 'load_state_dict'):
+            raise Exception("Saved sampler state cannot be restored to data loader {}".format(type(loader).__name__))
+        loader.load_state_dict(state)
+
+
+class SamplerDataLoader(gluon.data.DataLoader):
+    """
+    Gluon data loader that keeps its sampler and batch sampler, so that the epoch position of samplers with
+    a `state_dict` method (e.g. :class:`tmnt.bert_handling.FixedSeedRandomSampler`) can be saved and restored.
+    Arguments are as for `gluon.data.DataLoader`.
+    """
+    def __init__(self, dataset, sampler=None, batch_sampler=None, **kwargs):
+        super().__init__(dataset, sampler=sampler, batch_sampler=batch_sampler, **kwargs)
+        self.samplers = [ s for s in (sampler, batch_sampler) if s is not None ]
+
+    def state_dict(self):
+        return [ s.state_dict() if hasattr(s, 'state_dict') else None for s in self.samplers ]
+
+    def load_state_dict(self, state):
+        for s, s_state in zip(self.samplers, state):
+            if s_state is not None:
+                s.load_state_dict(s_state)
+
+
 class PairedDataLoader():
     
     def __init__(self, data_loader1, data_loader2):
@@ -263,6 +329,15 @@ class PairedDataLoader():
     def next(self):
         return self.__next__()
 
+    def state_dict(self):
+        return [ loader_state_dict(self.data_loader1),
+                 loader_state_dict(self.data_loader2) if self.data_loader2 is not None else None ]
+
+    def load_state_dict(self, state):
+        load_loader_state_dict(self.data_loader1, state[0])
+        if self.data_loader2 is not None:
+            load_loader_state_dict(self.data_loader2, state[1])
+
 
 
 class RoundRobinDataLoader():
@@ -304,6 +379,13 @@ class RoundRobinDataLoader():
 
     def next(self):
         return self.__next__()
+
+    def state_dict(self):
+        return [ loader_state_dict(d) for d in self.data_loaders ]
+
+    def load_state_dict(self, state):
+        for d, d_state in zip(self.data_loaders, state):
+            load_loader_state_dict(d, d_state)
     
 
 
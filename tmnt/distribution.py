@@ -74,6 +74,13 @@ class GaussianDistribution(BaseDistribution):
     def _get_kl_term(self, F, mu, lv):
         return -0.5 * F.sum(1 + lv - mu*mu - F.exp(lv), axis=1)
 
+    def sample_with_kl(self, F, mu, mu_bn, lv, lv_bn, batch_size):
+        """Sample and KL term given the mean and log-variance encodings before and after batch normalization
+        """
+        z = self._get_gaussian_sample(F, mu_bn, lv_bn, batch_size)
+        KL = self._get_kl_term(F, mu_bn, lv_bn)
+        return self.post_sample_dr_o(z), KL
+
     def hybrid_forward(self, F, data, batch_size):
         """Generate a sample according to the Gaussian given the encoder outputs
         """
@@ -81,10 +88,7 @@ class GaussianDistribution(BaseDistribution):
         mu_bn = self.mu_bn(mu)
         lv = self.lv_encoder(data)
         lv_bn = self.lv_bn(lv)
-        z = self._get_gaussian_sample(F, mu_bn, lv_bn, batch_size)
-        KL = self._get_kl_term(F, mu_bn, lv_bn)
-        z = self.post_sample_dr_o(z)
-        return z, KL
+        return self.sample_with_kl(F, mu, mu_bn, lv, lv_bn, batch_size)
 
 
 class GaussianUnitVarDistribution(BaseDistribution):
@@ -147,6 +151,14 @@ class LogisticGaussianDistribution(BaseDistribution):
         lv_div = self.prior_logvar - lv
         return 0.5 * (F.sum((v_div + dt + lv_div), axis=1) - self.n_latent)
 
+    def sample_with_kl(self, F, mu, mu_bn, lv, lv_bn, batch_size):
+        """Sample and KL term given the mean and log-variance encodings before and after batch normalization
+        """
+        z_p = self._get_gaussian_sample(F, mu_bn, lv_bn, batch_size)
+        KL = self._get_kl_term(F, mu, lv)
+        z = self.post_sample_dr_o(z_p)
+        return F.softmax(z), KL
+
     def hybrid_forward(self, F, data, batch_size):
         """Generate a sample according to the logistic Gaussian latent distribution given the encoder outputs
         """
@@ -154,10 +166,7 @@ class LogisticGaussianDistribution(BaseDistribution):
         mu_bn = self.mu_bn(mu)        
         lv = self.lv_encoder(data)
         lv_bn = self.lv_bn(lv)
-        z_p = self._get_gaussian_sample(F, mu_bn, lv_bn, batch_size)
-        KL = self._get_kl_term(F, mu, lv)
-        z = self.post_sample_dr_o(z_p)
-        return F.softmax(z), KL
+        return self.sample_with_kl(F, mu, mu_bn, lv, lv_bn, batch_size)
     
 
 class HyperSphericalDistribution(BaseDistribution):
@@ -12,6 +12,7 @@ import time
 import io
 import os
 import psutil
+import tempfile
 import mxnet as mx
 import numpy as np
 import scipy.sparse as sp
@@ -19,16 +20,21 @@ import json
 from mxnet import autograd
 from mxnet import gluon
 import gluonnlp as nlp
-import umap
-#import umap.plot
-import matplotlib.pyplot as plt
 
-from sklearn.metrics import average_precision_score, top_k_accuracy_score, roc_auc_score, ndcg_score, precision_recall_fscore_support
+from sklearn.metrics import roc_auc_score, ndcg_score, precision_recall_fscore_support
 from tmnt.data_loading import DataIterLoader, SparseMatrixDataIter, PairedDataLoader, SingletonWrapperLoader
-from tmnt.modeling import BowVAEModel, CovariateBowVAEModel, SeqBowVED
-from tmnt.modeling import GeneralizedSDMLLoss, MetricSeqBowVED, MetricBowVAEModel
-from tmnt.eval_npmi import EvaluateNPMI
+from tmnt.modeling import BowVAEModel, CovariateBowVAEModel, SeqBowVED, StackedBowVAEModel
+from tmnt.modeling import ScalableSDMLLoss, MetricSeqBowVED, MetricBowVAEModel
+from tmnt.eval_npmi import EvaluateNPMI, NPMICounts
+from tmnt.eval_metrics import classification_metrics
+from tmnt.utils.visualization import EncodingPlotter
 from tmnt.distribution import HyperSphericalDistribution, LogisticGaussianDistribution, BaseDistribution, GaussianDistribution
+from tmnt.utils.precision import resolve_dtype, DynamicLossScaler
+from tmnt.utils.async_validation import AsyncValidator
+from tmnt.utils.checkpoint import CheckpointWriter
+from tmnt.utils.training_state import save_training_state, load_training_state, get_loader_states, set_loader_states
+from tmnt.utils.random import draw_mx_seed, seed_mx_rng_for_epoch
+from tmnt.bert_handling import EncodingStore, CachedEncodingLoader
 import autogluon.core as ag
 from itertools import cycle
 import pickle
@@ -83,7 +89,23 @@ class BaseEstimator(object):
         coherence_via_encoder: Flag to use encoder to derive coherence scores (via gradient attribution)
         pretrained_param_file: Path to pre-trained parameter file to initialize weights
         warm_start: Subsequent calls to `fit` will use existing model weights rather than reinitializing
+        dtype: Training precision: 'float32' | 'bfloat16' | 'float16'. Reduced precision uses automatic mixed
+            precision with float32 accumulation and float32 master parameters (reducing activation, not parameter,
+            memory); it must be enabled for the process first with :func:`tmnt.utils.precision.init_reduced_precision`.
+            'bfloat16' falls back to 'float16' (with dynamic loss scaling) where the backend lacks bfloat16 support.
+            optional (default='float32')
+        checkpoint_dir: Directory to write a checkpoint to at the end of every training epoch (written in the
+            background); None disables checkpointing. optional (default=None)
+        checkpoint_keep_last: Number of most recent checkpoints to retain; 0 retains all. optional (default=0)
+        checkpoint_keep_best: Number of checkpoints with the best validation objective to retain in addition to the
+            most recent ones (applies only when `checkpoint_keep_last` > 0). optional (default=0)
+        training_state_dir: Directory where the full training state (parameters, optimizer states, random number
+            generator states and loop counters) is saved at the end of every epoch so that training can be continued
+            with the `resume_from` argument of `fit_with_validation`. Saving the state does not change the course of
+            training, and a resumed run continues exactly as the uninterrupted run would have. optional (default=None)
     """
+    _plotter = None
+
     def __init__(self,
                  log_method: str = 'log',
                  quiet: bool = False,
@@ -100,7 +122,12 @@ class BaseEstimator(object):
                  coherence_via_encoder: bool = False,
                  pretrained_param_file: Optional[str] = None,
                  warm_start: bool = False,
-                 test_batch_size: int = 0):
+                 test_batch_size: int = 0,
+                 dtype: str = 'float32',
+                 checkpoint_dir: Optional[str] = None,
+                 checkpoint_keep_last: int = 0,
+                 checkpoint_keep_best: int = 0,
+                 training_state_dir: Optional[str] = None):
         self.log_method = log_method
         self.quiet = quiet
         self.model = None
@@ -121,6 +148,12 @@ class BaseEstimator(object):
         self.warm_start = warm_start
         self.num_val_words = -1 ## will be set later for computing Perplexity on validation dataset
         self.latent_distribution.ctx = self.ctx
+        self.dtype = resolve_dtype(dtype)
+        self.loss_scaler = DynamicLossScaler() if self.dtype == 'float16' else None
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_keep_last = checkpoint_keep_last
+        self.checkpoint_keep_best = checkpoint_keep_best
+        self.training_state_dir = training_state_dir
 
 
     def _np_one_hot(self, vec, n_outputs):
@@ -129,6 +162,37 @@ class BaseEstimator(object):
         return ovec
         
 
+    def _backward(self, loss):
+        """Backward pass, scaling the loss first when training with float16."""
+        if self.loss_scaler is not None:
+            loss = self.loss_scaler.scale(loss)
+        loss.backward()
+
+    def _loss_scale(self):
+        return self.loss_scaler.loss_scale if self.loss_scaler is not None else 1.0
+
+    def _grads_overflowed(self, params):
+        """Check for (and adjust the loss scale after) float16 gradient overflow. 
+        If True, the update for this step should be skipped.
+        """
+        if self.loss_scaler is None:
+            return False
+        return self.loss_scaler.update_scale(self.loss_scaler.has_overflow(params))
+
+    def _get_checkpoint_writer(self):
+        if not self.checkpoint_dir:
+            return None
+        return CheckpointWriter(self.checkpoint_dir, keep_last=self.checkpoint_keep_last, keep_best=self.checkpoint_keep_best)
+
+    def _checkpoint_files(self):
+        """Files (name to contents) written alongside the parameters in each checkpoint."""
+        return {'model.config': json.dumps(self._get_config(), sort_keys=True, indent=4)}
+
+    def _close_plotter(self):
+        ## finish any encoding plots (metric learning estimators) at the end of training
+        if self._plotter is not None:
+            self._plotter.close()
+
     def _output_status(self, status_string):
         if self.log_method == 'print':
             print(status_string)
@@ -163,14 +227,17 @@ class BaseEstimator(object):
         top_k_words_per_topic = [[int(i) for i in list(sorted_ids[:k, t])] for t in range(self.n_latent)]
         npmi_eval = EvaluateNPMI(top_k_words_per_topic)
         npmi = npmi_eval.evaluate_csr_mat(X)
+        redundancy = self._redundancy(top_k_words_per_topic, num_topics)
+        return npmi, redundancy
+
+    def _redundancy(self, top_k_words_per_topic, num_topics):
         unique_term_ids = set()
         unique_limit = 5  ## only consider the top 5 terms for each topic when looking at degree of redundancy
         for i in range(num_topics):
             topic_ids = list(top_k_words_per_topic[i][:unique_limit])
             for j in range(len(topic_ids)):
                 unique_term_ids.add(topic_ids[j])
-        redundancy = (1.0 - (float(len(unique_term_ids)) / num_topics / unique_limit)) ** 2
-        return npmi, redundancy
+        return (1.0 - (float(len(unique_term_ids)) / num_topics / unique_limit)) ** 2
 
 
     def _get_objective_from_validation_result(self, val_result):
@@ -227,7 +294,28 @@ class BaseBowEstimator(BaseEstimator):
         validate_each_epoch: Perform validation of model against heldout validation 
             data after each training epoch
         multilabel: Assume labels are vectors denoting label sets associated with each document
+        early_stopping_patience: Stop training when the early stopping metric has not improved on validation data
+            for this many epochs and restore the best parameters; 0 disables early stopping. optional (default=0)
+        early_stopping_metric: Validation metric used for early stopping: 'objective' | 'npmi' | 'ppl' | 'accuracy'.
+            optional (default='objective')
+        kvstore: MXNet kvstore type (e.g. 'dist_sync') for data-parallel training across worker processes
+            started with :func:`tmnt.parallel.launch_local`; each worker trains on its own shard of the data.
+            None for single process training. optional (default=None)
+        local_sgd_interval: With a kvstore, train each worker independently on its shard (local SGD) and average all
+            model parameters, including decoder biases and batch norm statistics, across workers every
+            `local_sgd_interval` batches and at the end of each epoch; 0 synchronizes gradients every batch.
+            optional (default=0)
+        async_validation: Validate parameter snapshots taken at the end of each epoch (when `validate_each_epoch`
+            is set) in a background process while training continues; results are reported as they finish.
+            Validation after the final epoch remains synchronous. optional (default=False)
+        fuse_aux_forward: With auxiliary (unlabeled) data, run the labeled and auxiliary batches through a single
+            forward/backward pass. This is faster, but batch normalization statistics in the latent distribution are
+            computed over the combined batch rather than each batch separately, which changes semi-supervised
+            training. optional (default=False)
     """
+    ## whether labeled and auxiliary (unlabeled) batches can be combined into a single forward/backward pass
+    _fuse_aux_supported = True
+
     def __init__(self,
                  vocabulary: nlp.Vocab,
                  n_labels: int = 0,
@@ -241,8 +329,17 @@ class BaseBowEstimator(BaseEstimator):
                  num_enc_layers: int = 1,
                  enc_dr: float = 0.1,
                  classifier_dropout: float = 0.1,
+                 early_stopping_patience: int = 0,
+                 early_stopping_metric: str = 'objective',
+                 kvstore: Optional[str] = None,
+                 local_sgd_interval: int = 0,
+                 async_validation: bool = False,
+                 fuse_aux_forward: bool = False,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
+        if early_stopping_metric not in ('objective', 'npmi', 'ppl', 'accuracy'):
+            raise Exception("Unsupported early stopping metric {}; must be one of 'objective', 'npmi', 'ppl' or 'accuracy'"
+                            .format(early_stopping_metric))
         self.enc_hidden_dim = enc_hidden_dim
         self.fixed_embedding = fixed_embedding
         self.n_encoding_layers = num_enc_layers
@@ -257,6 +354,17 @@ class BaseBowEstimator(BaseEstimator):
         self.n_labels = n_labels
         self.has_classifier = n_labels > 1
         self.loss_function = gluon.loss.SigmoidBCELoss() if multilabel else gluon.loss.SoftmaxCELoss()
+        self.early_stopping_patience = early_stopping_patience
+        self.early_stopping_metric = early_stopping_metric
+        self.stop_epoch = None
+        self.best_epoch = None
+        self.kvstore = kvstore
+        self.local_sgd_interval = local_sgd_interval
+        self.async_validation = async_validation
+        self.fuse_aux_forward = fuse_aux_forward
+        self.convergence_trace = []
+        self._kv = None
+        self._avg_keys_initialized = False
 
     @classmethod
     def from_saved(cls, model_dir: str, ctx: Optional[mx.context.Context] = mx.cpu()) -> 'BaseBowEstimator':
@@ -348,6 +456,11 @@ class BaseBowEstimator(BaseEstimator):
         else:
             latent_distribution = GaussianDistribution(n_latent, ctx=ctx)
         n_labels = config.get('n_labels', n_labels)
+        dtype = config.get('dtype', 'float32')
+        early_stopping_patience = int(config.get('early_stopping_patience', 0))
+        early_stopping_metric = config.get('early_stopping_metric', 'objective')
+        async_validation = config.get('async_validation', False)
+        fuse_aux_forward = config.get('fuse_aux_forward', False)
         model = \
                 cls(vocabulary,
                     n_labels=n_labels,
@@ -364,7 +477,12 @@ class BaseBowEstimator(BaseEstimator):
                     num_enc_layers=n_encoding_layers, enc_dr=enc_dr, 
                     epochs=epochs, log_method='log', coherence_via_encoder=coherence_via_encoder,
                     pretrained_param_file = pretrained_param_file,
-                    warm_start = (pretrained_param_file is not None))
+                    warm_start = (pretrained_param_file is not None),
+                    early_stopping_patience = early_stopping_patience,
+                    early_stopping_metric = early_stopping_metric,
+                    async_validation = async_validation,
+                    fuse_aux_forward = fuse_aux_forward,
+                    dtype = dtype)
         return model
 
 
@@ -413,6 +531,49 @@ class BaseBowEstimator(BaseEstimator):
             fp.write(self.model.vocabulary.to_json())
 
 
+    def _get_kvstore(self):
+        if self._kv is None:
+            self._kv = mx.kv.create(self.kvstore)
+        return self._kv
+
+    def _get_data_shard(self, X, y):
+        """Rows of `X` (and `y`) for this worker in data-parallel training. All shards have the same
+        number of rows so that every worker performs the same number of synchronized updates."""
+        kv = self._get_kvstore()
+        shard_size = X.shape[0] // kv.num_workers
+        rows = np.arange(kv.rank, shard_size * kv.num_workers, kv.num_workers)
+        return X[rows], (y[rows] if y is not None else None)
+
+    def _average_params(self, params):
+        """Replace every parameter in `params` (including those with grad_req 'null', such as decoder biases
+        and batch norm running statistics) with its mean across data-parallel workers. All workers must call
+        this the same number of times, as pushes for a key block until every worker has pushed it."""
+        kv = self._get_kvstore()
+        arrays = [ p.data() for p in params.values() ]
+        keys = list(range(len(arrays)))
+        if not self._avg_keys_initialized:
+            kv.init(keys, arrays)
+            self._avg_keys_initialized = True
+        ## without an optimizer on the servers, pushed values are summed across workers
+        kv.push(keys, arrays)
+        kv.pull(keys, out=arrays)
+        for a in arrays:
+            a[:] = a / kv.num_workers
+
+    def _checkpoint_files(self):
+        files = super()._checkpoint_files()
+        files['vocab.json'] = self.model.vocabulary.to_json()
+        return files
+
+    def _from_config_args(self):
+        """Leading positional arguments to `from_config` (before the configuration) for this estimator class."""
+        return ()
+
+    def _get_validation_snapshot_spec(self):
+        """Picklable description used to rebuild this estimator (without parameters) in a background validation process."""
+        attrs = { k: v for k, v in vars(self).items() if isinstance(v, (bool, int, float, str)) }
+        return type(self), self._from_config_args(), self._get_config(), self.vocabulary.to_json(), attrs
+
     def _get_wd_freqs(self, X, max_sample_size=1000000):
         sample_size = min(max_sample_size, X.shape[0])
         sums = X.sum(axis=0)
@@ -421,21 +582,15 @@ class BaseBowEstimator(BaseEstimator):
     def _get_model(self):
         raise NotImplementedError()
 
-    def _npmi_with_dataloader(self, dataloader, k=10):
-        sorted_ids = self.model.get_ordered_terms_encoder(dataloader) if self.coherence_via_encoder else self.model.get_ordered_terms()
-        num_topics = min(self.n_latent, sorted_ids.shape[-1])
-        top_k_words_per_topic = [[int(i) for i in list(sorted_ids[:k, t])] for t in range(self.n_latent)]
-        npmi_eval = EvaluateNPMI(top_k_words_per_topic)
-        npmi = npmi_eval.evaluate_csr_loader(dataloader)
-        unique_term_ids = set()
-        unique_limit = 5  ## only consider the top 5 terms for each topic when looking at degree of redundancy
-        for i in range(num_topics):
-            topic_ids = list(top_k_words_per_topic[i][:unique_limit])
-            for j in range(len(topic_ids)):
-                unique_term_ids.add(topic_ids[j])
-        redundancy = (1.0 - (float(len(unique_term_ids)) / num_topics / unique_limit)) ** 2
-        return npmi, redundancy
-    
+    def _validation_forward(self, data, labels):
+        """
+        Validation forward pass of the model over a batch of data.
+
+        Returns:
+            (tuple): Tuple of kl_loss, rec_loss, encoding, classifier outputs (None without a classifier)
+        """
+        return self.model.validation_forward(data)
+
     def _perplexity(self, dataloader, total_words):
         total_rec_loss = 0
         total_kl_loss  = 0
@@ -443,15 +598,17 @@ class BaseBowEstimator(BaseEstimator):
         num_batches = dataloader.num_batches
         for i, ((data,labels),) in enumerate(dataloader):
             data = data.as_in_context(self.ctx)
-            _, kl_loss, rec_loss, _, _, _ = self._forward(self.model, data)
             if i == num_batches - 1 and last_batch_size > 0:
-                total_rec_loss += rec_loss[:last_batch_size].sum().asscalar()
-                total_kl_loss  += kl_loss[:last_batch_size].sum().asscalar()
-            else:
-                total_rec_loss += rec_loss.sum().asscalar()
-                total_kl_loss += kl_loss.sum().asscalar()
-        if ((total_rec_loss + total_kl_loss) / total_words) < 709.0:
-            perplexity = math.exp((total_rec_loss + total_kl_loss) / total_words)
+                data = data[:last_batch_size]
+                labels = labels[:last_batch_size] if labels is not None else None
+            kl_loss, rec_loss, _, _ = self._validation_forward(data, labels)
+            total_rec_loss += rec_loss.sum().asscalar()
+            total_kl_loss += kl_loss.sum().asscalar()
+        return self._perplexity_from_losses(total_rec_loss + total_kl_loss, total_words)
+
+    def _perplexity_from_losses(self, total_loss, total_words):
+        if (total_loss / total_words) < 709.0:
+            perplexity = math.exp(total_loss / total_words)
         else:
             perplexity = 1e300
         return perplexity
@@ -481,59 +638,74 @@ class BaseBowEstimator(BaseEstimator):
         val_dataloader = SingletonWrapperLoader(val_dataloader)
         return val_dataloader
 
-    def validate_with_loader(self, val_dataloader, val_size, total_val_words, val_X=None, val_y=None):
-        ppl = self._perplexity(val_dataloader, total_val_words)
-        if val_X is not None:
-            n = min(val_X.shape[0], 50000)
-            npmi, redundancy = self._npmi(val_X[:n])
-        else:
-            npmi, redundancy = self._npmi_with_dataloader(val_dataloader)
-        v_res = {'ppl': ppl, 'npmi': npmi, 'redundancy': redundancy}
+    def validate_with_loader(self, val_dataloader, val_size, total_val_words, val_y=None, include_encodings=False):
+        """
+        Validate the model with a single pass over `val_dataloader`: loss terms for perplexity, classifier outputs,
+        (optionally) encodings and the term co-occurrence counts for NPMI are all gathered from each batch.
+
+        Parameters:
+            val_dataloader: Validation data loader
+            val_size (int): Number of validation documents
+            total_val_words (int): Total number of validation tokens
+            val_y: Validation labels, used for average precision scores
+            include_encodings (bool): Include the encodings of the validation documents as 'encodings' in the results
+
+        Returns:
+            (dict): Validation results
+        """
+        k = 10
+        sorted_ids = self.model.get_ordered_terms_encoder(val_dataloader) if self.coherence_via_encoder else self.model.get_ordered_terms()
+        num_topics = min(self.n_latent, sorted_ids.shape[-1])
+        top_k_words_per_topic = [[int(i) for i in list(sorted_ids[:k, t])] for t in range(self.n_latent)]
+        npmi_counts = NPMICounts(top_k_words_per_topic)
+        total_loss = 0.0
+        tot_correct = 0
+        tot = 0
         prediction_arrays = []
-        if self.has_classifier:
-            tot_correct = 0
-            tot = 0
-            bs = min(val_size, self.batch_size)
-            num_std_batches = val_size // bs
-            last_batch_size = val_size % bs
-            for i, ((data, labels),) in enumerate(val_dataloader):
-                data = data.as_in_context(self.ctx)
-                labels = labels.as_in_context(self.ctx)
-                if i == num_std_batches - 1 and last_batch_size > 0:
-                    data = data[:last_batch_size]
-                    labels = labels[:last_batch_size]
-                predictions = self.model.predict(data)    
-                predictions_lists = [ p.asnumpy() for p in list(predictions) ]
-                prediction_arrays.extend(predictions_lists)
+        encoding_arrays = []
+        last_batch_size = val_dataloader.last_batch_size
+        num_batches = val_dataloader.num_batches
+        for i, ((data, labels),) in enumerate(val_dataloader):
+            data = data.as_in_context(self.ctx)
+            if i == num_batches - 1 and last_batch_size > 0:
+                data = data[:last_batch_size]
+                labels = labels[:last_batch_size] if labels is not None else None
+            kl_loss, rec_loss, encodings, predictions = self._validation_forward(data, labels)
+            ## accumulate on the device; one transfer per batch
+            total_loss += (rec_loss.sum() + kl_loss.sum()).asscalar()
+            npmi_counts.update(data)
+            if include_encodings:
+                encoding_arrays.append(encodings.asnumpy())
+            if self.has_classifier:
+                predictions = predictions.asnumpy()
+                prediction_arrays.append(predictions)
+                labels = labels.asnumpy()
                 if len(labels.shape) == 1:  ## standard single-label classification
-                    correct = mx.nd.argmax(predictions, axis=1) == labels
-                    tot_correct += mx.nd.sum(correct).asscalar()
-                tot += (data.shape[0] - (labels < 0.0).sum().asscalar()) # subtract off labels < 0 (for unlabeled data)
+                    tot_correct += (np.argmax(predictions, axis=1) == labels).sum()
+                tot += (data.shape[0] - (labels < 0.0).sum()) # subtract off labels < 0 (for unlabeled data)
+        ppl = self._perplexity_from_losses(total_loss, total_val_words)
+        npmi = npmi_counts.npmi()
+        redundancy = self._redundancy(top_k_words_per_topic, num_topics)
+        v_res = {'ppl': ppl, 'npmi': npmi, 'redundancy': redundancy}
+        if include_encodings:
+            v_res['encodings'] = np.concatenate(encoding_arrays)
+        if self.has_classifier:
             acc = float(tot_correct) / float(tot)
             v_res['accuracy'] = acc
-            prediction_mat = np.array(prediction_arrays)
+            prediction_mat = np.concatenate(prediction_arrays)
             ap_scores = []
             if val_y is not None:
-                if len(val_y.shape) == 1:
-                    val_y = self._np_one_hot(val_y, self.n_labels)
-                for c in range(self.n_labels):
-                    y_vec = val_y[:,c]
-                    pred_vec = prediction_mat[:,c]
-                    if not np.any(np.isnan(pred_vec)):
-                        ap_c = average_precision_score(y_vec, pred_vec)
-                    else:
-                        ap_c = 0.0
-                    ap_scores.append((ap_c, int(y_vec.sum())))
-            prediction_np_mat = np.array(prediction_arrays)
+                ap_scores = classification_metrics(val_y, prediction_mat, top_k=())['ap_scores']
             v_res['ap_scores_and_support'] = ap_scores
         return v_res
 
-    def validate(self, val_X, val_y):
+    def validate(self, val_X, val_y, include_encodings=False):
         val_dataloader = self._get_val_dataloader(val_X, val_y)
         total_val_words = val_X.sum()
         if self.num_val_words < 0:
             self.num_val_words = total_val_words
-        return self.validate_with_loader(val_dataloader, val_X.shape[0], total_val_words, val_X, val_y)
+        return self.validate_with_loader(val_dataloader, val_X.shape[0], total_val_words, val_y,
+                                         include_encodings=include_encodings)
 
 
     def initialize_with_pretrained(self):
@@ -581,39 +753,128 @@ class BaseBowEstimator(BaseEstimator):
         total_ls = elbo_ls.mean() / self.gamma
         return elbo_ls, kl_ls, rec_ls, red_ls, total_ls
 
+    def _get_fused_losses(self, model, batch_data, aux_data):
+        """Losses for a labeled batch and an auxiliary (unlabeled) batch using a single forward pass over both
+        batches concatenated into one CSR batch. The total loss equals the sum of the totals from `_get_losses`
+        and `_get_unlabeled_losses`, except that batch normalization statistics are computed over the combined batch.
+        """
+        (data,labels), = batch_data
+        n_lab, n_aux = data.shape[0], aux_data.shape[0]
+        data = mx.nd.concat(data.as_in_context(self.ctx), aux_data, dim=0)
+        elbo_ls, kl_ls, rec_ls, coherence_loss, red_ls, predicted_labels = \
+            self._forward(self.model, data)
+        ## row weights give: mean(labeled elbo) + mean(unlabeled elbo) / gamma
+        row_wts = mx.nd.concat(mx.nd.ones(n_lab, ctx=self.ctx) / n_lab,
+                               mx.nd.ones(n_aux, ctx=self.ctx) / (n_aux * self.gamma), dim=0)
+        elbo_total = (elbo_ls * row_wts).sum()
+        if self.has_classifier:
+            if labels is None:
+                labels = mx.nd.expand_dims(mx.nd.zeros(n_lab), 1)
+            labels = labels.as_in_context(self.ctx)
+            ## classification loss only over the labeled rows
+            label_ls = self.loss_function(predicted_labels.slice_axis(axis=0, begin=0, end=n_lab), labels).mean()
+            total_ls = (self.gamma * label_ls) + elbo_total
+        else:
+            total_ls = elbo_total
+            label_ls = mx.nd.zeros(total_ls.shape)
+        return elbo_ls[:n_lab], elbo_ls[n_lab:], label_ls, total_ls
+
     def fit_with_validation_loaders(self, train_dataloader, validation_dataloader, aux_dataloader,
-                                    train_X_size, val_X_size, aux_X_size, total_val_words, val_X=None, val_y=None):
+                                    train_X_size, val_X_size, aux_X_size, total_val_words, val_y=None,
+                                    resume_from=None):
         all_model_params = self.model.collect_params()                
         params = [p for p in all_model_params.values() if p.grad_req != 'null']                
         for p in params:
             p.grad_req = 'add'
             
-        trainer = gluon.Trainer(self.model.collect_params(), self.optimizer, {'learning_rate': self.lr})
+        local_sgd = self.kvstore is not None and self.local_sgd_interval > 0
+        if self.kvstore is not None and self.early_stopping_patience > 0:
+            raise Exception("Early stopping is not supported with data-parallel (kvstore) training")
+        if self.kvstore is not None and not local_sgd:
+            ## gradients are summed across workers by allreduce_grads, then averaged in the update step
+            kv = self._get_kvstore()
+            trainer = gluon.Trainer(self.model.collect_params(), self.optimizer, {'learning_rate': self.lr},
+                                    kvstore=kv, update_on_kvstore=False)
+            num_workers = kv.num_workers
+        else:
+            ## with local SGD each worker keeps its own optimizer state; parameters are averaged periodically
+            trainer = gluon.Trainer(self.model.collect_params(), self.optimizer, {'learning_rate': self.lr})
+            num_workers = 1
+        self.convergence_trace = []
+        checkpoint_writer = self._get_checkpoint_writer()
+        ts_train = time.time()
+        n_batches, n_last_averaged = 0, 0
         sc_obj, npmi, ppl, redundancy = 0.0, 0.0, 0.0, 0.0
         v_res = None
+        patience = self.early_stopping_patience if validation_dataloader is not None else 0
+        async_validator = None
+        if self.async_validation and self.validate_each_epoch and validation_dataloader is not None and self.epochs > 1:
+            if patience > 0:
+                raise Exception("Asynchronous validation cannot be combined with early stopping")
+            async_validator = AsyncValidator(self, validation_dataloader, val_X_size, total_val_words, val_y)
+        best_score, best_epoch, best_params, best_sc_obj, best_v_res = None, -1, None, None, None
+        resumable = self.training_state_dir is not None or resume_from is not None
+        if resumable and self.kvstore is not None:
+            raise Exception("Resumable training state is not supported with data-parallel (kvstore) training")
+        ## saved early-stopping parameters are keyed by structural names, which do not depend on the model instance
+        struct_names = { p.name: k for k, p in self.model._collect_params_with_prefix().items() }
+        start_epoch = 0
+        if resume_from is not None:
+            state, arrays = load_training_state(resume_from, self.model, {'model': trainer}, ctx=self.ctx)
+            start_epoch, n_batches = state['epoch'], state['n_batches']
+            self.convergence_trace = state['convergence_trace']
+            best_score, best_epoch, best_sc_obj, best_v_res = state['early_stopping']
+            if 'best_params' in arrays:
+                best_params = { k: arrays['best_params'][struct_names[k]] for k in all_model_params.keys() }
+            if self.loss_scaler is not None:
+                self.loss_scaler.__dict__.update(state['loss_scaler'])
+            if len(self.convergence_trace) > 0:
+                ts_train -= self.convergence_trace[-1]['secs']
+        ## MXNet generator state cannot be saved, so MXNet is reseeded every epoch from a seed kept in the loop state
+        mx_seed = state['mx_seed'] if resume_from is not None else draw_mx_seed()
         joint_loader = PairedDataLoader(train_dataloader, aux_dataloader)
-        for epoch in range(self.epochs):
+        for epoch in range(start_epoch, self.epochs):
+            seed_mx_rng_for_epoch(mx_seed, epoch)
             ts_epoch = time.time()
             elbo_losses = []
             lab_losses  = []
             for i, (data_batch, aux_batch) in enumerate(joint_loader):
-                with autograd.record():
-                    elbo_ls, kl_loss, _, _, lab_loss, total_ls = self._get_losses(self.model, data_batch)
-                    elbo_mean = elbo_ls.mean()
-                total_ls.backward()
-
-                if aux_batch is not None:
+                if aux_batch is not None and self.fuse_aux_forward and self._fuse_aux_supported:
                     aux_data, = aux_batch
                     aux_data, _ = aux_data # ignore (null) label
-                    aux_data = aux_data.as_in_context(self.ctx)
                     with autograd.record():
-                        elbo_ls_a, kl_loss_a, _, _, total_ls_a = \
-                            self._get_unlabeled_losses(self.model, aux_data)
-                    total_ls_a.backward()
+                        elbo_ls, elbo_ls_a, lab_loss, total_ls = \
+                            self._get_fused_losses(self.model, data_batch, aux_data.as_in_context(self.ctx))
+                        elbo_mean = elbo_ls.mean()
+                    self._backward(total_ls)
+                else:
+                    with autograd.record():
+                        elbo_ls, kl_loss, _, _, lab_loss, total_ls = self._get_losses(self.model, data_batch)
+                        elbo_mean = elbo_ls.mean()
+                    self._backward(total_ls)
+
+                    if aux_batch is not None:
+                        aux_data, = aux_batch
+                        aux_data, _ = aux_data # ignore (null) label
+                        aux_data = aux_data.as_in_context(self.ctx)
+                        with autograd.record():
+                            elbo_ls_a, kl_loss_a, _, _, total_ls_a = \
+                                self._get_unlabeled_losses(self.model, aux_data)
+                        self._backward(total_ls_a)
                 
                 trainer.allreduce_grads()
-                trainer.update(1)
+                loss_scale = self._loss_scale()
+                n_batches += 1
+                overflow = self._grads_overflowed(params)
+                if not overflow:
+                    trainer.update(loss_scale * num_workers)
                 all_model_params.zero_grad()
+                ## averaging is keyed on batches seen (not updates applied) so all workers stay in lock-step
+                if local_sgd and n_batches % self.local_sgd_interval == 0:
+                    self._average_params(all_model_params)
+                    n_last_averaged = n_batches
+                if overflow:
+                    continue
                 if not self.quiet:
                     if aux_batch is not None:
                         elbo_losses.append(float(elbo_mean.asscalar()) + float(elbo_ls_a.mean().asscalar()))
@@ -626,24 +887,89 @@ class BaseBowEstimator(BaseEstimator):
                 lab_mean  = np.mean(lab_losses) if len(lab_losses) > 0 else 0.0
                 self._output_status("Epoch [{}] finished in {} seconds. [elbo = {}, label loss = {}]"
                                     .format(epoch+1, (time.time()-ts_epoch), elbo_mean, lab_mean))
+            if local_sgd and n_last_averaged < n_batches:
+                self._average_params(all_model_params)
+                n_last_averaged = n_batches
             mx.nd.waitall()
-            if validation_dataloader is not None and (self.validate_each_epoch or epoch == self.epochs-1):
-                sc_obj, v_res = self._perform_validation(epoch, validation_dataloader, val_X_size, total_val_words, val_X, val_y)
+            trace_point = {'secs': time.time() - ts_train, 'epoch': epoch+1, 'batches': n_batches,
+                           'elbo': float(np.mean(elbo_losses)) if len(elbo_losses) > 0 else None}
+            self.convergence_trace.append(trace_point)
+            if async_validator is not None and epoch < self.epochs-1:
+                async_validator.submit(epoch, self.model)
+                self._collect_async_validation(async_validator)
+            elif validation_dataloader is not None and (self.validate_each_epoch or patience > 0 or epoch == self.epochs-1):
+                if async_validator is not None:
+                    ## report any outstanding epochs before the final one
+                    self._collect_async_validation(async_validator, wait=True)
+                sc_obj, v_res = self._perform_validation(epoch, validation_dataloader, val_X_size, total_val_words, val_y)
+                trace_point['objective'] = sc_obj
+            if checkpoint_writer is not None:
+                checkpoint_writer.save(epoch, self.model, self._checkpoint_files(), score=trace_point.get('objective'))
+            if patience > 0:
+                score = self._get_early_stopping_score(sc_obj, v_res)
+                if best_score is None or score > best_score:
+                    best_score, best_epoch, best_sc_obj, best_v_res = score, epoch, sc_obj, v_res
+                    best_params = { k: p.data().copy() for k, p in all_model_params.items() }
+                elif epoch - best_epoch >= patience:
+                    self._output_status("Early stopping after epoch {}; no improvement in {} since epoch {}"
+                                        .format(epoch+1, self.early_stopping_metric, best_epoch+1))
+                    break
+            if self.training_state_dir is not None:
+                loop_state = {'epoch': epoch+1, 'n_batches': n_batches, 'mx_seed': mx_seed,
+                              'convergence_trace': self.convergence_trace,
+                              'early_stopping': (best_score, best_epoch, best_sc_obj, best_v_res),
+                              'loss_scaler': dict(vars(self.loss_scaler)) if self.loss_scaler is not None else None}
+                saved_best = { struct_names[k]: v for k, v in best_params.items() } if best_params is not None else None
+                save_training_state(self.training_state_dir, self.model, {'model': trainer}, loop_state,
+                                    arrays={'best_params': saved_best})
         mx.nd.waitall()
+        if async_validator is not None:
+            async_validator.close()
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
+        if best_params is not None:
+            for k, p in all_model_params.items():
+                p.set_data(best_params[k])
+            sc_obj, v_res = best_sc_obj, best_v_res
+            self.stop_epoch, self.best_epoch = epoch+1, best_epoch+1
+            logging.info("Restored parameters from epoch {} (stopped at epoch {})".format(self.best_epoch, self.stop_epoch))
+            if self.reporter and self.stop_epoch < self.epochs:
+                ## report the restored model at the epoch training stopped, so schedulers account for the epochs actually used
+                self.reporter(epoch=self.stop_epoch, objective=sc_obj, time_step=time.time(),
+                              coherence=v_res.get('npmi', 0.0), perplexity=v_res.get('ppl', 0.0),
+                              redundancy=v_res.get('redundancy', 0.0),
+                              stop_epoch=self.stop_epoch, best_epoch=self.best_epoch)
         if v_res is None and validation_dataloader is not None:
-            sc_obj, v_res = self._perform_validation(0, validation_dataloader, val_X_size, total_val_words, val_X, val_y)
+            sc_obj, v_res = self._perform_validation(0, validation_dataloader, val_X_size, total_val_words, val_y)
+        self._close_plotter()
         return sc_obj, v_res
 
+
+    def _collect_async_validation(self, async_validator, wait=False):
+        for epoch, sc_obj, v_res in async_validator.completed(wait=wait):
+            self._output_status("Epoch [{}]. Background validation objective = {}".format(epoch+1, sc_obj))
+            self._report_validation(epoch, sc_obj, v_res)
+            self.convergence_trace[epoch]['objective'] = sc_obj
+
+    def _get_early_stopping_score(self, sc_obj, v_res):
+        """Validation score used for early stopping, oriented so that higher is better."""
+        if self.early_stopping_metric == 'objective':
+            return sc_obj
+        if self.early_stopping_metric not in v_res:
+            raise Exception("Early stopping metric {} not available from validation of this estimator"
+                            .format(self.early_stopping_metric))
+        score = v_res[self.early_stopping_metric]
+        return -score if self.early_stopping_metric == 'ppl' else score
+
     
     def _perform_validation(self,
                             epoch,
                             validation_dataloader,
                             val_X_size,
                             total_val_words,
-                            val_X = None,
                             val_y = None):
         logging.info('Performing validation ....')
-        v_res = self.validate_with_loader(validation_dataloader, val_X_size, total_val_words, val_X, val_y)
+        v_res = self.validate_with_loader(validation_dataloader, val_X_size, total_val_words, val_y)
         sc_obj = self._get_objective_from_validation_result(v_res)
         if self.has_classifier:
             self._output_status("Epoch [{}]. Objective = {} ==> PPL = {}. NPMI ={}. Redundancy = {}. Accuracy = {}."
@@ -652,10 +978,13 @@ class BaseBowEstimator(BaseEstimator):
         else:
             self._output_status("Epoch [{}]. Objective = {} ==> PPL = {}. NPMI ={}. Redundancy = {}."
                                 .format(epoch+1, sc_obj, v_res['ppl'], v_res['npmi'], v_res['redundancy']))
+        self._report_validation(epoch, sc_obj, v_res)
+        return sc_obj, v_res
+
+    def _report_validation(self, epoch, sc_obj, v_res):
         if self.reporter:
             self.reporter(epoch=epoch+1, objective=sc_obj, time_step=time.time(),
                           coherence=v_res['npmi'], perplexity=v_res['ppl'], redundancy=v_res['redundancy'])
-        return sc_obj, v_res
 
 
     def setup_model_with_biases(self, X: sp.csr.csr_matrix) -> int:
@@ -673,7 +1002,8 @@ class BaseBowEstimator(BaseEstimator):
                             y: np.ndarray,
                             val_X: Optional[sp.csr.csr_matrix],
                             val_y: Optional[np.ndarray],
-                            aux_X: Optional[sp.csr.csr_matrix] = None) -> Tuple[float, dict]:
+                            aux_X: Optional[sp.csr.csr_matrix] = None,
+                            resume_from: Optional[str] = None) -> Tuple[float, dict]:
         """
         Fit a model according to the options of this estimator and optionally evaluate on validation data
 
@@ -683,12 +1013,25 @@ class BaseBowEstimator(BaseEstimator):
             val_X: Validateion input tensor
             val_y: Validation co-variates
             aux_X: Auxilliary unlabeled data for semi-supervised training
+            resume_from: Training state directory (see `training_state_dir`) from which to continue an
+                interrupted run; the estimator and data must be the same as for the original run
 
         Returns:
             sc_obj, v_res
         """
         
         x_size = self.setup_model_with_biases(X)
+
+        if self.kvstore is not None:
+            ## decoder biases are set from the full data above; each worker then trains on its own shard
+            ## and only the first worker validates
+            X, y = self._get_data_shard(X, y)
+            if aux_X is not None:
+                aux_X, _ = self._get_data_shard(aux_X, None)
+            if self._get_kvstore().rank != 0:
+                val_X, val_y = None, None
+            logging.info("Data-parallel worker {} of {} training on {} rows"
+                         .format(self._get_kvstore().rank, self._get_kvstore().num_workers, X.shape[0]))
         
         if x_size > MAX_DESIGN_MATRIX:
             logging.info("Sparse matrix has total size = {}. Using Sparse Matrix data batcher.".format(x_size))
@@ -721,7 +1064,7 @@ class BaseBowEstimator(BaseEstimator):
         if aux_dataloader is not None:
             aux_dataloader   = SingletonWrapperLoader(aux_dataloader)        
         return self.fit_with_validation_loaders(train_dataloader, val_dataloader, aux_dataloader, train_X_size, val_X_size,
-                                         aux_X_size, total_val_words, val_X=val_X, val_y=val_y)
+                                         aux_X_size, total_val_words, val_y=val_y, resume_from=resume_from)
 
                     
     def fit(self, X: sp.csr.csr_matrix, y: np.ndarray = None) -> 'BaseBowEstimator':
@@ -788,13 +1131,8 @@ class BowEstimator(BaseBowEstimator):
         self.model.load_parameters(self.pretrained_param_file, allow_missing=False)
 
 
-    def _get_model(self):
-        """
-        Initializes embedding weights and returns a `BowVAEModel` with hyperparameters provided.
-
-        Returns:
-            (:class:`BowVAEModel`) initialized using provided hyperparameters
-        """
+    def _initialize_embedding(self):
+        """Set pre-trained embeddings on the vocabulary if needed and return the embedding size."""
         #vocab, emb_size = self._initialize_embedding_layer(self.embedding_source, self.embedding_size)
         if self.embedding_source != 'random' and self.vocabulary.embedding is None:
             e_type, e_name = tuple(self.embedding_source.split(':'))
@@ -806,6 +1144,16 @@ class BowEstimator(BaseBowEstimator):
                     self.vocabulary.embedding[word] = mx.nd.random.normal(0, 0.1, emb_size)
         else:
             emb_size = self.embedding_size
+        return emb_size
+
+    def _get_model(self):
+        """
+        Initializes embedding weights and returns a `BowVAEModel` with hyperparameters provided.
+
+        Returns:
+            (:class:`BowVAEModel`) initialized using provided hyperparameters
+        """
+        emb_size = self._initialize_embedding()
         model = \
                 BowVAEModel(self.enc_hidden_dim, emb_size, n_encoding_layers=self.n_encoding_layers,
                             enc_dr=self.enc_dr, fixed_embedding=self.fixed_embedding,
@@ -846,12 +1194,142 @@ class BowEstimator(BaseBowEstimator):
         return self.model.encode_data(mx_array).asnumpy()
 
 
+class StackedBowEstimator(BowEstimator):
+    """Estimator that trains `n_seeds` independently initialized bag-of-words models at once as a
+    :class:`tmnt.modeling.StackedBowVAEModel`. All copies are trained on the same batches; each copy is validated
+    and reported separately and `seed_results` holds the (objective, validation results) of every copy after
+    validation. The objective and results returned by `fit_with_validation` are those of the best copy, which is
+    also the copy used by `perplexity`, `npmi`, `validate`, `transform` and `get_topic_vectors`.
+
+    Parameters:
+        n_seeds: Number of models trained together
+    """
+
+    _fuse_aux_supported = False
+
+    def __init__(self, *args, n_seeds=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.early_stopping_patience > 0 or self.async_validation:
+            raise Exception("Stacked multi-seed training does not support early stopping or asynchronous validation")
+        self.n_seeds = n_seeds
+        self.seed_results = []
+        self.best_seed = 0
+
+    @classmethod
+    def from_config(cls, n_seeds, *args, **kwargs):
+        est = super().from_config(*args, **kwargs)
+        est.n_seeds = n_seeds
+        return est
+
+    def _from_config_args(self):
+        return (self.n_seeds,)
+
+    def _get_model(self):
+        """
+        Initializes embedding weights and returns a `StackedBowVAEModel` with hyperparameters provided.
+
+        Returns:
+            (:class:`StackedBowVAEModel`) initialized using provided hyperparameters
+        """
+        if self.pretrained_param_file is not None:
+            raise Exception("Stacked multi-seed models cannot be initialized from pre-trained parameters")
+        emb_size = self._initialize_embedding()
+        return StackedBowVAEModel(self.n_seeds, self.vocabulary, self.enc_hidden_dim, emb_size,
+                                  self.n_encoding_layers, self.enc_dr, self.fixed_embedding, self.latent_distribution,
+                                  n_labels=self.n_labels, gamma=self.gamma, multilabel=self.multilabel,
+                                  classifier_dropout=self.classifier_dropout,
+                                  coherence_reg_penalty=self.coherence_reg_penalty,
+                                  redundancy_reg_penalty=self.redundancy_reg_penalty, ctx=self.ctx)
+
+    def _get_losses(self, model, batch_data):
+        (data,labels), = batch_data
+        data = data.as_in_context(self.ctx)
+        elbo_ls, kl_ls, rec_ls, coherence_loss, red_ls, predicted_labels = \
+            self._forward(self.model, data)
+        ## the copies share no parameters, so the sum of their losses gives each copy its own gradients
+        total_ls = elbo_ls.mean(axis=1).sum()
+        if self.has_classifier:
+            if labels is None:
+                labels = mx.nd.expand_dims(mx.nd.zeros(data.shape[0]), 1)
+            labels = labels.as_in_context(self.ctx)
+            label_ls = mx.nd.concat(*[ self.loss_function(predicted_labels[s], labels).mean()
+                                       for s in range(self.n_seeds) ], dim=0)
+            total_ls = (self.gamma * label_ls.sum()) + total_ls
+        else:
+            label_ls = mx.nd.zeros(total_ls.shape)
+        return elbo_ls, kl_ls, rec_ls, red_ls, label_ls, total_ls
+
+    def _get_unlabeled_losses(self, model, data):
+        elbo_ls, kl_ls, rec_ls, coherence_loss, red_ls, predicted_labels = \
+            self._forward(self.model, data)
+        total_ls = elbo_ls.mean(axis=1).sum() / self.gamma
+        return elbo_ls, kl_ls, rec_ls, red_ls, total_ls
+
+    def seed_estimator(self, s: int) -> BowEstimator:
+        """
+        Estimator for a single copy of the stack.
+
+        Parameters:
+            s: Index of the copy
+
+        Returns:
+            A :class:`BowEstimator` with the same settings as this estimator whose model holds the parameters of copy `s`
+        """
+        est = BowEstimator.__new__(BowEstimator)
+        est.__dict__.update(self.__dict__)
+        del est.n_seeds, est.seed_results, est.best_seed
+        est.model = self.model.unstack(s)
+        est.latent_distribution = est.model.latent_distribution
+        if self.reporter:
+            est.reporter = lambda **kwargs: self.reporter(seed=s, **kwargs)
+        return est
+
+    def _perform_validation(self,
+                            epoch,
+                            validation_dataloader,
+                            val_X_size,
+                            total_val_words,
+                            val_y = None):
+        self.seed_results = []
+        for s in range(self.n_seeds):
+            logging.info("Validating model {} of {} in stack".format(s+1, self.n_seeds))
+            self.seed_results.append(self.seed_estimator(s)._perform_validation(epoch, validation_dataloader, val_X_size,
+                                                                                total_val_words, val_y))
+        self.best_seed = int(np.argmax([ sc_obj for sc_obj, _ in self.seed_results ]))
+        return self.seed_results[self.best_seed]
+
+    def write_model(self, model_dir):
+        """Write the best copy (by last validation objective) as a standard bag-of-words model."""
+        self.seed_estimator(self.best_seed).write_model(model_dir)
+
+    ## evaluation of the fitted stack uses the best copy (by last validation objective)
+
+    def perplexity(self, X: sp.csr.csr_matrix) -> float:
+        return self.seed_estimator(self.best_seed).perplexity(X)
+
+    def npmi(self, X, k=10):
+        return self.seed_estimator(self.best_seed).npmi(X, k=k)
+
+    def validate(self, val_X, val_y, include_encodings=False):
+        return self.seed_estimator(self.best_seed).validate(val_X, val_y, include_encodings=include_encodings)
+
+    def get_topic_vectors(self) -> mx.nd.NDArray:
+        return self.seed_estimator(self.best_seed).get_topic_vectors()
+
+    def transform(self, X: sp.csr.csr_matrix) -> mx.nd.NDArray:
+        return self.seed_estimator(self.best_seed).transform(X)
+
+
 class BowMetricEstimator(BowEstimator):
 
-    def __init__(self, *args, sdml_smoothing_factor=0.3, plot_dir=None, non_scoring_index=-1, **kwargs):
+    _fuse_aux_supported = False
+
+    def __init__(self, *args, sdml_smoothing_factor=0.3, sdml_memory_size=0, plot_dir=None, plot_every=1,
+                 non_scoring_index=-1, **kwargs):
         super(BowMetricEstimator, self).__init__(*args, **kwargs)
-        self.loss_function = GeneralizedSDMLLoss(smoothing_parameter=sdml_smoothing_factor)
+        self.loss_function = ScalableSDMLLoss(smoothing_parameter=sdml_smoothing_factor, memory_size=sdml_memory_size)
         self.plot_dir = plot_dir
+        self._plotter = EncodingPlotter(plot_dir, plot_every=plot_every) if plot_dir else None
         self.non_scoring_index = non_scoring_index
 
 
@@ -884,13 +1362,19 @@ class BowMetricEstimator(BowEstimator):
                             n_covars=0, ctx=self.ctx)
         if self.pretrained_param_file is not None:
             model.load_parameters(self.pretrained_param_file, allow_missing=False)
+        ## encodings in the memory bank are from the previous model
+        self.loss_function.reset_memory()
         return model
         
 
     def _get_model_bias_initialize(self, train_data):
         model = self._get_model()
-        tr_bow_matrix = self._get_bow_matrix(train_data)
-        model.initialize_bias_terms(tr_bow_matrix.sum(axis=0))
+        ## word counts from column sums of both sides of each (sparse) batch pair
+        wd_counts = mx.nd.zeros(len(self.vocabulary))
+        for (batch1, _), (batch2, _) in train_data:
+            wd_counts += mx.nd.sum(batch1, axis=0).as_in_context(wd_counts.context)
+            wd_counts += mx.nd.sum(batch2, axis=0).as_in_context(wd_counts.context)
+        model.initialize_bias_terms(wd_counts)
         return model
 
     def _forward(self, model, data):
@@ -925,7 +1409,6 @@ class BowMetricEstimator(BowEstimator):
         posteriors = []
         ground_truth = []
         ground_truth_idx = []
-        emb2 = None
         emb1 = []
         for batch_id, data_batch in enumerate(dataloader):
             elbo_ls, rec_ls, kl_ls, red_ls, z_mu1, z_mu2, label1, label2 = self._ff_batch(model, data_batch)
@@ -938,9 +1421,8 @@ class BowMetricEstimator(BowEstimator):
             gt = np.zeros((label1.shape[0], int(mx.nd.max(label2).asscalar())+1))
             gt[np.arange(label1.shape[0]), label1] = 1
             ground_truth += list(gt)
-            if emb2 is None:
-                emb2 = z_mu2.asnumpy()
-            emb1 += list(z_mu1.asnumpy())
+            if self._plotter is not None:
+                emb1.append(z_mu1.asnumpy())
         posteriors = np.array(posteriors)
         ground_truth = np.array(ground_truth)
         ground_truth_idx = np.array(ground_truth_idx)
@@ -950,39 +1432,15 @@ class BowMetricEstimator(BowEstimator):
         except:
             auroc = 0.0
             logging.error('ROC computation failed')
-        ap_scores = []
-        wsum = 0.0
-        tot  = 0.0
-        for c in range(len(labels)):
-            y_vec = ground_truth[:,c]
-            pred_vec = posteriors[:,c]
-            if not np.any(np.isnan(pred_vec)):
-                ap_c = average_precision_score(y_vec, pred_vec)
-            else:
-                ap_c = 0.0
-            if c != self.non_scoring_index:
-                support = int(y_vec.sum())
-                if support > 0:
-                    wsum += ap_c * support
-                    tot  += support
-            ap_scores.append((ap_c, int(y_vec.sum())))
-            
-        avg_prec = wsum / tot
+        metrics = classification_metrics(ground_truth_idx, posteriors, top_k=(1, 2, 3, 4),
+                                         non_scoring_index=self.non_scoring_index)
+        ap_scores = metrics['ap_scores']
+        avg_prec = metrics['weighted_ap']
         ndcg = ndcg_score(ground_truth, posteriors)
-        top_acc_1 = top_k_accuracy_score(ground_truth_idx, posteriors, k=1, labels=labels)        
-        top_acc_2 = top_k_accuracy_score(ground_truth_idx, posteriors, k=2, labels=labels)
-        top_acc_3 = top_k_accuracy_score(ground_truth_idx, posteriors, k=3, labels=labels)
-        top_acc_4 = top_k_accuracy_score(ground_truth_idx, posteriors, k=4, labels=labels)
-        y = np.where(ground_truth > 0)[1]
-        if self.plot_dir:
-            ofile = self.plot_dir + '/' + 'plot_' + str(epoch_id) + '.png'
-            umap_model = umap.UMAP(n_neighbors=4, min_dist=0.5, metric='euclidean')
-            embeddings = umap_model.fit_transform(np.array(emb1))
-            #mapper = umap_model.fit(np.array(emb1))
-            plt.scatter(*embeddings.T, c=y, s=0.8, alpha=0.9, cmap='coolwarm')
-            #umap.plot.points(mapper, labels=y)
-            plt.savefig(ofile)
-            plt.close("all")
+        top_acc_1, top_acc_2, top_acc_3, top_acc_4 = [ metrics['top_k'][k] for k in (1, 2, 3, 4) ]
+        if self._plotter is not None:
+            ## projection and plotting happen in the background
+            self._plotter.add(epoch_id, np.concatenate(emb1), np.where(ground_truth > 0)[1])
             
         if include_predictions:
             res_predictions = posteriors
@@ -998,7 +1456,6 @@ class BowMetricEstimator(BowEstimator):
                             validation_dataloader,
                             val_X_size,
                             total_val_words,
-                            val_X = None,
                             val_y = None):
         logging.info("Performing validation .. val_X_size = {}".format(val_X_size))
         v_res = self.classifier_validate(self.model, validation_dataloader, epoch)
@@ -1006,15 +1463,20 @@ class BowMetricEstimator(BowEstimator):
                             .format(epoch, v_res['avg_prec'], v_res['avg_prec'], v_res['au_roc'], v_res['ndcg'],
                                     v_res['top_1'], v_res['top_2'], v_res['top_3'], v_res['top_4']))
         self._output_status("  AP Scores: {}".format(v_res['ap_scores']))
+        self._report_validation(epoch, v_res['avg_prec'], v_res)
+        return v_res['avg_prec'], v_res
+
+    def _report_validation(self, epoch, sc_obj, v_res):
         if self.reporter:
-            self.reporter(epoch=epoch+1, objective=v_res['avg_prec'], time_step=time.time(), coherence=0.0,
+            self.reporter(epoch=epoch+1, objective=sc_obj, time_step=time.time(), coherence=0.0,
                           perplexity=0.0, redundancy=0.0)
-        return v_res['avg_prec'], v_res
 
 
 
 class CovariateBowEstimator(BaseBowEstimator):
 
+    _fuse_aux_supported = False
+
     def __init__(self, *args, n_covars=0, **kwargs):
 
         super().__init__(*args, **kwargs)
@@ -1028,6 +1490,9 @@ class CovariateBowEstimator(BaseBowEstimator):
         est = super().from_config(*args, **kwargs)
         est.n_covars = n_covars
         return est
+
+    def _from_config_args(self):
+        return (self.n_covars,)
     
     def _get_model(self):
         """
@@ -1140,9 +1605,8 @@ class CovariateBowEstimator(BaseBowEstimator):
     def _get_objective_from_validation_result(self, v_res):
         return v_res['npmi']
 
-    def validate(self, X, y):
-        npmi, redundancy = self._npmi(X)
-        return {'npmi': npmi, 'redundancy': redundancy, 'ppl': 0.0}
+    def _validation_forward(self, data, covars):
+        return self.model.validation_forward(data, covars.as_in_context(self.ctx))
 
     def get_topic_vectors(self) -> mx.nd.NDArray:
         """
@@ -1188,17 +1652,23 @@ class SeqBowEstimator(BaseEstimator):
                  gamma=1.0,
                  multilabel=False,
                  decoder_lr = 0.01,
-                 checkpoint_dir = None,
                  optimizer = 'bertadam',
                  classifier_dropout = 0.0,
                  pure_classifier_objective = False,
                  validate_each_epoch = False,
+                 grad_accumulation_steps = 1,
+                 freeze_encoder = False,
+                 encoding_cache_dir = None,
+                 frozen_bert_layers = 0,
                  **kwargs):
         super(SeqBowEstimator, self).__init__(*args, optimizer=optimizer, **kwargs)
         self.pure_classifier_objective = pure_classifier_objective
+        self.grad_accumulation_steps = max(1, int(grad_accumulation_steps))
+        self.freeze_encoder = freeze_encoder
+        self.encoding_cache_dir = encoding_cache_dir
+        self.frozen_bert_layers = frozen_bert_layers
         self.validate_each_epoch = validate_each_epoch
         self.minimum_lr = 1e-9
-        self.checkpoint_dir = checkpoint_dir
         self.bert_base = bert_base
         self.bert_vocab = bert_vocab
         self.bert_model_name = bert_model_name
@@ -1213,7 +1683,6 @@ class SeqBowEstimator(BaseEstimator):
         self.loss_function = gluon.loss.SigmoidBCELoss() if multilabel else gluon.loss.SoftmaxCELoss(sparse_label=False)
         self.gamma = gamma
         self.decoder_lr = decoder_lr
-        self._bow_matrix = None
         self.bow_vocab = bow_vocab
 
 
@@ -1284,7 +1753,12 @@ class SeqBowEstimator(BaseEstimator):
                         warm_start = (pretrained_param_file is not None),
                         reporter=reporter,
                         ctx=ctx,
-                        log_interval=log_interval)
+                        log_interval=log_interval,
+                        grad_accumulation_steps = config.get('grad_accumulation_steps', 1),
+                        freeze_encoder = config.get('freeze_encoder', False),
+                        encoding_cache_dir = config.get('encoding_cache_dir', None),
+                        frozen_bert_layers = int(config.get('frozen_bert_layers', 0)),
+                        dtype = config.get('dtype', 'float32'))
         estimator.initialize_with_pretrained()
         return estimator
 
@@ -1367,6 +1841,9 @@ class SeqBowEstimator(BaseEstimator):
         config['bert_model_name'] = self.bert_model_name
         config['bert_dataset'] = self.bert_dataset
         config['classifier_dropout'] = self.classifier_dropout
+        config['grad_accumulation_steps'] = self.grad_accumulation_steps
+        config['freeze_encoder'] = self.freeze_encoder
+        config['frozen_bert_layers'] = self.frozen_bert_layers
         return config
 
     def write_model(self, model_dir: str, suffix: str ='') -> None:
@@ -1389,6 +1866,11 @@ class SeqBowEstimator(BaseEstimator):
             f.write(self.bow_vocab.to_json())
 
 
+    def _checkpoint_files(self):
+        files = super()._checkpoint_files()
+        files['vocab.json'] = self.bow_vocab.to_json()
+        return files
+
     def log_train(self, batch_id, batch_num, metric, step_loss, rec_loss, red_loss, class_loss,
                   log_interval, epoch_id, learning_rate):
         """Generate and print out the log message for training. """
@@ -1411,29 +1893,16 @@ class SeqBowEstimator(BaseEstimator):
         self._output_status("Batch {}/{} loss={} (rec_loss = {}), metrics: {:.10f}"
               .format(batch_id+1, batch_num, step_loss/log_interval, rec_loss/log_interval, *metric_val))
 
-    def _get_bow_matrix(self, dataloader, cache=False):
-        bow_matrix = []
-        max_rows = 2000000000 / len(self.bow_vocab)
-        logging.info("Maximum rows for BOW matrix = {}".format(max_rows))
-        rows = 0
+    def _bow_batches(self, dataloader):
+        """Bag-of-words batches, of shape (batch_size, bow_vocab_size), from `dataloader`."""
         for i, data in enumerate(dataloader):
             seqs, = data
-            bow_batch = list(seqs[3].squeeze(axis=1))
-            rows += len(bow_batch)
-            if i >= max_rows:
-                break
-            bow_matrix.extend(bow_batch)
-        bow_matrix = mx.nd.stack(*bow_matrix)
-        if cache:
-            self._bow_matrix = bow_matrix
-        return bow_matrix
+            yield seqs[-2].squeeze(axis=1)
 
     def _get_bow_wd_counts(self, dataloader):
         sums = mx.nd.zeros(len(self.bow_vocab))
-        for i, data in enumerate(dataloader):
-            seqs, = data
-            bow_batch = seqs[3].squeeze(axis=1)
-            sums += bow_batch.sum(axis=0)
+        for bow_batch in self._bow_batches(dataloader):
+            sums += mx.nd.sum(bow_batch, axis=0).as_in_context(sums.context)
         return sums
 
     def _get_objective_from_validation_result(self, val_result):
@@ -1450,13 +1919,21 @@ class SeqBowEstimator(BaseEstimator):
                          .format(sc_obj, val_result['accuracy'], orig_obj))
         return sc_obj
 
+    def _forward_seqs(self, model, seqs):
+        if len(seqs) == 3:
+            ## precomputed encodings from a frozen encoder: (encodings, bow, label)
+            enc, bow, _ = seqs
+            enc = enc.as_in_context(self.ctx)
+            return model.forward_with_cached_encoding(enc, enc, bow.as_in_context(self.ctx))
+        input_ids, valid_length, type_ids, bow, _ = seqs
+        return model(input_ids.as_in_context(self.ctx), type_ids.as_in_context(self.ctx),
+                     valid_length.astype('float32').as_in_context(self.ctx), bow.as_in_context(self.ctx))
+
     def _get_losses(self, model, batch_data):
         ## batch_data should be a singleton tuple: (seqs,)
         seqs, = batch_data
-        input_ids, valid_length, type_ids, bow, label = seqs
-        elbo_ls, rec_ls, kl_ls, red_ls, out = model(
-            input_ids.as_in_context(self.ctx), type_ids.as_in_context(self.ctx),
-            valid_length.astype('float32').as_in_context(self.ctx), bow.as_in_context(self.ctx))
+        label = seqs[-1]
+        elbo_ls, rec_ls, kl_ls, red_ls, out = self._forward_seqs(model, seqs)
         if self.has_classifier:
             label = label.as_in_context(self.ctx)
             label_ls = self.loss_function(out, label)
@@ -1474,19 +1951,37 @@ class SeqBowEstimator(BaseEstimator):
         return elbo_ls, rec_ls, kl_ls, red_ls, label_ls, total_ls
 
     def _get_unlabeled_losses(self, model, batch_data):
-        inputs, vl, tt, bow, _ = batch_data
-        elbo_ls, rec_ls, kl_ls, red_ls, out = model(
-            inputs.as_in_context(self.ctx), tt.as_in_context(self.ctx),
-            vl.astype('float32').as_in_context(self.ctx), bow.as_in_context(self.ctx))
+        elbo_ls, rec_ls, kl_ls, red_ls, out = self._forward_seqs(model, batch_data)
         total_ls = elbo_ls.mean() / self.gamma
         return elbo_ls, rec_ls, kl_ls, red_ls, total_ls
+
+    def _freeze_bert_layers(self, bert, n_layers):
+        """Freeze the embedding layers and the bottom `n_layers` transformer layers of the BERT encoder."""
+        cells = bert.encoder.transformer_cells
+        n_layers = min(n_layers, len(cells))
+        frozen_blocks = [bert.word_embed, bert.encoder.layer_norm] + [cells[i] for i in range(n_layers)]
+        if bert.token_type_embed is not None:
+            frozen_blocks.append(bert.token_type_embed)
+        for block in frozen_blocks:
+            block.collect_params().setattr('grad_req', 'null')
+        bert.encoder.position_weight.grad_req = 'null'
+        logging.info("Frozen BERT embeddings and bottom {} of {} transformer layers".format(n_layers, len(cells)))
+
+    def _get_cached_encoding_loader(self, model, dataloader, shuffle=False, singleton=True):
+        if self.encoding_cache_dir is None:
+            self.encoding_cache_dir = tempfile.mkdtemp(prefix='tmnt_encodings_')
+        encoder_name = '{}_{}_{}'.format(self.bert_model_name, self.bert_dataset, self.pretrained_param_file or '')
+        store = EncodingStore(self.encoding_cache_dir, encoder_name)
+        encodings, bow, labels = store.get_encodings(model.bert, dataloader, ctx=self.ctx)
+        return CachedEncodingLoader(encodings, bow, labels, self.batch_size, shuffle=shuffle, singleton=singleton)
         
 
     def fit_with_validation(self,
                             train_data: gluon.data.DataLoader,
                             dev_data: gluon.data.DataLoader,
                             aux_data: gluon.data.DataLoader,
-                            num_train_examples: int):
+                            num_train_examples: int,
+                            resume_from: Optional[str] = None):
         """
         Training function.
 
@@ -1495,6 +1990,8 @@ class SeqBowEstimator(BaseEstimator):
             dev_data: Gluon dataloader with dev/validation data.
             aux_data: Gluon dataloader with auxilliary data.
             num_train_examples: Number of training samples
+            resume_from: Training state directory (see `training_state_dir`) from which to continue an
+                interrupted run with the same estimator settings and data loaders
         """
         if self.model is None or not self.warm_start:
             self.model = self._get_model_bias_initialize(train_data)
@@ -1502,22 +1999,38 @@ class SeqBowEstimator(BaseEstimator):
         model = self.model
 
         has_aux_data = aux_data is not None
+
+        if self.freeze_encoder:
+            ## encode all data once with the frozen encoder; only the latent, decoder and classifier heads are trained
+            model.bert.collect_params().setattr('grad_req', 'null')
+            train_data = self._get_cached_encoding_loader(model, train_data, shuffle=True)
+            if dev_data is not None:
+                dev_data = self._get_cached_encoding_loader(model, dev_data)
+            if has_aux_data:
+                aux_data = self._get_cached_encoding_loader(model, aux_data, shuffle=True, singleton=False)
+        elif self.frozen_bert_layers > 0:
+            self._freeze_bert_layers(model.bert, self.frozen_bert_layers)
         
-        accumulate = False
+        ## number of micro-batches whose gradients are summed for each optimizer step
+        accumulate = self.grad_accumulation_steps if self.grad_accumulation_steps > 1 else False
         v_res      = None
 
         all_model_params = model.collect_params()
         optimizer_params = {'learning_rate': self.lr, 'epsilon': 1e-6, 'wd': 0.02}
-        non_decoder_params = {**model.bert.collect_params()}
+        non_decoder_params = {k: p for k, p in model.bert.collect_params().items() if p.grad_req != 'null'}
+        n_encoder_params = sum(int(np.prod(p.shape)) for p in model.bert.collect_params().values())
+        n_trainable_params = sum(int(np.prod(p.shape)) for p in non_decoder_params.values())
+        ## (bert)adam keeps two float32 state arrays for each trainable parameter
+        logging.info("Encoder parameters: {} trainable of {} (frozen layers = {}); encoder optimizer state = {:.1f} MB"
+                     .format(n_trainable_params, n_encoder_params, self.frozen_bert_layers, n_trainable_params * 8 / 1e6))
         decoder_params     = {**model.decoder.collect_params(), **model.latent_dist.collect_params()}
         if self.has_classifier:
             decoder_params.update(model.classifier.collect_params())
 
+        ## no encoder trainer when the whole encoder is frozen
         trainer = gluon.Trainer(non_decoder_params, self.optimizer,
-                                    optimizer_params, update_on_kvstore=False)
+                                    optimizer_params, update_on_kvstore=False) if len(non_decoder_params) > 0 else None
         dec_trainer = gluon.Trainer(decoder_params, 'adam', {'learning_rate': self.decoder_lr, 'epsilon': 1e-6, 'wd': 0.00001})
-        #if args.dtype == 'float16':
-        #    amp.init_trainer(trainer)
 
         num_effective_samples = num_train_examples
 
@@ -1526,9 +2039,10 @@ class SeqBowEstimator(BaseEstimator):
 
         joint_loader = PairedDataLoader(train_data, aux_data)
         
-        num_train_steps = len(joint_loader) * self.epochs
-        if accumulate:
-            num_train_steps /= accumulate
+        num_batches = len(joint_loader)
+        ## LR schedule (warmup and decay) is in units of optimizer steps, i.e. effective batches
+        steps_per_epoch = int(math.ceil(num_batches / accumulate)) if accumulate else num_batches
+        num_train_steps = steps_per_epoch * self.epochs
         
         warmup_ratio = self.warmup_ratio
         num_warmup_steps = int(num_train_steps * warmup_ratio)
@@ -1558,10 +2072,24 @@ class SeqBowEstimator(BaseEstimator):
             loss_details['red_loss'] += red_ls.mean().asscalar()
             if class_ls is not None:
                 loss_details['class_loss'] += class_ls.mean().asscalar()
-            
-        for epoch_id in range(self.epochs):
+
+        checkpoint_writer = self._get_checkpoint_writer()
+        trainers = {'bert': trainer, 'decoder': dec_trainer}
+        start_epoch = 0
+        if resume_from is not None:
+            state, _ = load_training_state(resume_from, model, trainers, ctx=self.ctx)
+            start_epoch, step_num = state['epoch'], state['step_num']
+            set_loader_states([train_data, aux_data], state['loader_states'])
+            if self.loss_scaler is not None:
+                self.loss_scaler.__dict__.update(state['loss_scaler'])
+        ## MXNet generator state cannot be saved, so MXNet is reseeded every epoch from a seed kept in the loop state
+        mx_seed = state['mx_seed'] if resume_from is not None else draw_mx_seed()
+        for epoch_id in range(start_epoch, self.epochs):
+            seed_mx_rng_for_epoch(mx_seed, epoch_id)
             self.metric.reset()
             all_model_params.zero_grad()
+            ts_epoch = time.time()
+            n_epoch_examples = 0
             
             for (batch_id, (data, aux_batch)) in enumerate(joint_loader):
                 # data_batch is either a 2-tuple of: (labeled, unlabeled)
@@ -1575,72 +2103,79 @@ class SeqBowEstimator(BaseEstimator):
                     offset = non_warmup_steps / (num_train_steps - num_warmup_steps)
                     new_lr = self.lr - offset * self.lr
                 new_lr = max(new_lr, self.minimum_lr)
-                trainer.set_learning_rate(new_lr)
+                if trainer is not None:
+                    trainer.set_learning_rate(new_lr)
                 # forward and backward with optional auxilliary data
                 with mx.autograd.record():
                     elbo_ls, rec_ls, kl_ls, red_ls, label_ls, total_ls = self._get_losses(model, data)
-                total_ls.backward()
+                self._backward(total_ls)
                 if aux_batch is not None:
                     with mx.autograd.record():
                         elbo_ls_2, rec_ls_2, kl_ls_2, red_ls_2, total_ls_2 = self._get_unlabeled_losses(model, aux_batch)
-                    total_ls_2.backward()
+                    self._backward(total_ls_2)
                 update_loss_details(total_ls, elbo_ls, red_ls, label_ls)
+                n_epoch_examples += elbo_ls.shape[0]
                 if aux_batch is not None:
                     update_loss_details(total_ls_2, elbo_ls_2, red_ls_2, None)
-                # update
-                if not accumulate or (batch_id + 1) % accumulate == 0:
-                    trainer.allreduce_grads()
+                    n_epoch_examples += elbo_ls_2.shape[0]
+                # update; a trailing partial group of micro-batches at the end of an epoch is still applied
+                if not accumulate or (batch_id + 1) % accumulate == 0 or (batch_id + 1) == num_batches:
+                    n_accumulated = (batch_id % accumulate) + 1 if accumulate else 1
+                    if trainer is not None:
+                        trainer.allreduce_grads()
                     dec_trainer.allreduce_grads()
-                    nlp.utils.clip_grad_global_norm(clipped_params, 1.0, check_isfinite=True)
-                    trainer.update(accumulate if accumulate else 1)
-                    dec_trainer.update(accumulate if accumulate else 1)
+                    loss_scale = self._loss_scale()
+                    if self._grads_overflowed(params):
+                        all_model_params.zero_grad()
+                        continue
+                    ## gradients are summed over micro-batches and multiplied by the loss scale here,
+                    ## so clip against the correspondingly scaled norm
+                    if trainer is not None:
+                        nlp.utils.clip_grad_global_norm(clipped_params, 1.0 * n_accumulated * loss_scale, check_isfinite=True)
+                        trainer.update(n_accumulated * loss_scale)
+                    dec_trainer.update(n_accumulated * loss_scale)
                     step_num += 1
                     if (accumulate and accumulate > 1) or aux_batch:
                         # set grad to zero for gradient accumulation
                         all_model_params.zero_grad()
                 if (batch_id + 1) % (self.log_interval) == 0:
-                    self.log_train(batch_id, num_train_steps / self.epochs, self.metric, loss_details['step_loss'],
+                    self.log_train(batch_id, num_batches, self.metric, loss_details['step_loss'],
                                    loss_details['elbo_loss'], loss_details['red_loss'], loss_details['class_loss'], self.log_interval,
-                                   epoch_id, trainer.learning_rate)
+                                   epoch_id, (trainer or dec_trainer).learning_rate)
                     ## reset loss details
                     for d in loss_details:
                         loss_details[d] = 0.0
             mx.nd.waitall()
+            epoch_secs = time.time() - ts_epoch
+            self._output_status("Epoch {} trained on {} examples in {:.1f} seconds ({:.2f} examples/sec, frozen layers = {})"
+                                .format(epoch_id+1, n_epoch_examples, epoch_secs, n_epoch_examples / max(epoch_secs, 1e-6),
+                                        self.frozen_bert_layers))
 
             # inference on dev data
             if dev_data is not None and (self.validate_each_epoch or epoch_id == (self.epochs-1)):
                 sc_obj, v_res = self._perform_validation(model, dev_data, epoch_id)
             else:
                 sc_obj, v_res = None, None
-            if self.checkpoint_dir:
-                self.write_model(self.checkpoint_dir, suffix=str(epoch_id))
+            if checkpoint_writer is not None:
+                checkpoint_writer.save(epoch_id, model, self._checkpoint_files(), score=sc_obj)
+            if self.training_state_dir is not None:
+                loop_state = {'epoch': epoch_id+1, 'step_num': step_num, 'mx_seed': mx_seed,
+                              'loader_states': get_loader_states([train_data, aux_data]),
+                              'loss_scaler': dict(vars(self.loss_scaler)) if self.loss_scaler is not None else None}
+                save_training_state(self.training_state_dir, model, trainers, loop_state)
         mx.nd.waitall()
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
         if v_res is None and dev_data is not None:
             sc_obj, v_res = self._perform_validation(model, dev_data, 0)
+        self._close_plotter()
         return sc_obj, v_res
 
 
-    def _compute_coherence(self, model, k, test_data, log_terms=False):
-        num_topics = model.n_latent
+    def _top_k_terms(self, model, k):
         sorted_ids = model.get_top_k_terms(k)
-        num_topics = min(num_topics, sorted_ids.shape[-1])
-        top_k_words_per_topic = [[ int(i) for i in list(sorted_ids[:k, t])] for t in range(num_topics)]
-        npmi_eval = EvaluateNPMI(top_k_words_per_topic)
-        npmi = npmi_eval.evaluate_csr_mat(test_data)
-        unique_term_ids = set()
-        unique_limit = 5  ## only consider the top 5 terms for each topic when looking at degree of redundancy
-        for i in range(num_topics):
-            topic_ids = list(top_k_words_per_topic[i][:unique_limit])
-            for j in range(len(topic_ids)):
-                unique_term_ids.add(topic_ids[j])
-        redundancy = (1.0 - (float(len(unique_term_ids)) / num_topics / unique_limit)) ** 2.0
-        logging.info("Test Coherence: {}".format(npmi))
-        #if log_terms:
-        #    top_k_tokens = [list(map(lambda x: self.vocabulary.idx_to_token[x], list(li))) for li in top_k_words_per_topic]
-        #    for i in range(num_topics):
-        #        logging.info("Topic {}: {}".format(i, top_k_tokens[i]))
-        return npmi, redundancy
-    
+        num_topics = min(model.n_latent, sorted_ids.shape[-1])
+        return [[ int(i) for i in list(sorted_ids[:k, t])] for t in range(num_topics)]
 
     def _perform_validation(self, model, dev_data, epoch_id):
         v_res, metric_nm, metric_val = self.validate(model, dev_data)
@@ -1662,9 +2197,10 @@ class SeqBowEstimator(BaseEstimator):
                 
     
     def validate(self, model, dataloader):
-        bow_matrix = self._bow_matrix if self._bow_matrix is not None else self._get_bow_matrix(dataloader, cache=True)
-        num_words = bow_matrix.sum().asscalar()
-        npmi, redundancy = self._compute_coherence(model, 10, bow_matrix, log_terms=True)
+        ## losses, classifier metrics and the term co-occurrence counts for NPMI are gathered in a single pass
+        top_k_words_per_topic = self._top_k_terms(model, 10)
+        npmi_counts = NPMICounts(top_k_words_per_topic)
+        num_words = 0.0
         self.metric.reset()
         step_loss = 0
         elbo_loss  = 0
@@ -1672,6 +2208,11 @@ class SeqBowEstimator(BaseEstimator):
         total_kl_loss  = 0.0
         for batch_id, seqs in enumerate(dataloader):
             elbo_ls, rec_ls, kl_ls, red_ls, label_ls, total_ls = self._get_losses(model, seqs)
+            bow_batch = seqs[0][-2]
+            if len(bow_batch.shape) == 3:
+                bow_batch = bow_batch.squeeze(axis=1)
+            npmi_counts.update(bow_batch)
+            num_words += bow_batch.sum().asscalar()
             total_rec_loss += rec_ls.sum().asscalar()
             total_kl_loss  += kl_ls.sum().asscalar()
             step_loss += total_ls.mean().asscalar()
@@ -1686,6 +2227,9 @@ class SeqBowEstimator(BaseEstimator):
             perplexity = math.exp(likelihood)
         else:
             perplexity = 1e300
+        npmi = npmi_counts.npmi()
+        redundancy = self._redundancy(top_k_words_per_topic, len(top_k_words_per_topic))
+        logging.info("Test Coherence: {}".format(npmi))
         v_res = {'ppl':perplexity, 'npmi': npmi, 'redundancy': redundancy}
         metric_nm = 0.0
         metric_val = 0.0
@@ -1700,11 +2244,22 @@ class SeqBowEstimator(BaseEstimator):
 
 class SeqBowMetricEstimator(SeqBowEstimator):
 
-    def __init__(self, *args, sdml_smoothing_factor=0.3, plot_dir=None, non_scoring_index=-1, **kwargs):
+    def __init__(self, *args, sdml_smoothing_factor=0.3, sdml_memory_size=0, plot_dir=None, plot_every=1,
+                 non_scoring_index=-1, cache_b_encodings=False, b_refresh_steps=0, b_subset_size=32, **kwargs):
         super(SeqBowMetricEstimator, self).__init__(*args, **kwargs)
-        self.loss_function = GeneralizedSDMLLoss(smoothing_parameter=sdml_smoothing_factor, x2_downweight_idx=non_scoring_index)
+        if self.freeze_encoder:
+            raise Exception("Frozen encoder training (freeze_encoder) is not supported for metric learning estimators")
+        self.loss_function = ScalableSDMLLoss(smoothing_parameter=sdml_smoothing_factor, x2_downweight_idx=non_scoring_index,
+                                              memory_size=sdml_memory_size)
         self.plot_dir = plot_dir
+        self._plotter = EncodingPlotter(plot_dir, plot_every=plot_every) if plot_dir else None
         self.non_scoring_index = non_scoring_index ## if >=0 this will avoid considering this label index in evaluation
+        ## cached b-side encodings: each step encodes `b_subset_size` b-side items with gradients and takes the rest
+        ## from a cache of pooled encodings, fully refreshed every `b_refresh_steps` steps (0 for once per epoch)
+        self.cache_b_encodings = cache_b_encodings
+        self.b_refresh_steps = b_refresh_steps
+        self.b_subset_size = b_subset_size
+        self._b_items = None
 
 
     @classmethod
@@ -1721,25 +2276,15 @@ class SeqBowMetricEstimator(SeqBowEstimator):
         model.latent_dist.post_init(self.ctx)
         if self.pretrained_param_file is not None:
             model.load_parameters(self.pretrained_param_file, allow_missing=False)
+        ## encodings in the memory bank are from the previous model
+        self.loss_function.reset_memory()
         return model
 
-    def _get_model_bias_initialize(self, train_data):
-        model = self._get_model()
-        tr_bow_matrix = self._get_bow_matrix(train_data)
-        model.initialize_bias_terms(tr_bow_matrix.sum(axis=0))
-        return model
-        
-
-    def _get_bow_matrix(self, dataloader, cache=False):
-        bow_matrix = []
+    def _bow_batches(self, dataloader):
         for _, seqs in enumerate(dataloader):
-            batch_1, batch_2 = seqs                
-            bow_matrix.extend(list(batch_2[3].squeeze(axis=1)))
-            bow_matrix.extend(list(batch_1[3].squeeze(axis=1)))
-        bow_matrix = mx.nd.stack(*bow_matrix)
-        if cache:
-            self._bow_matrix = bow_matrix
-        return bow_matrix
+            batch_1, batch_2 = seqs
+            yield batch_2[3].squeeze(axis=1)
+            yield batch_1[3].squeeze(axis=1)
 
     def _ff_batch(self, model, batch_data):
         batch1, batch2 = batch_data
@@ -1752,7 +2297,70 @@ class SeqBowMetricEstimator(SeqBowEstimator):
             vl2.astype('float32').as_in_context(self.ctx), bow2.as_in_context(self.ctx))
         return elbo_ls, rec_ls, kl_ls, red_ls, z_mu1, z_mu2, label1, label2
 
+    def fit_with_validation(self, train_data, dev_data, *args, **kwargs):
+        if self.cache_b_encodings:
+            self._setup_b_cache(train_data)
+        try:
+            return super().fit_with_validation(train_data, dev_data, *args, **kwargs)
+        finally:
+            self._b_items, self._b_cache = None, None
+
+    def _setup_b_cache(self, train_data):
+        if not isinstance(train_data, PairedDataLoader) or train_data.data_loader2 is None or len(train_data.data_loader2) != 1:
+            raise Exception("Cached b-side encodings (cache_b_encodings) require a paired data loader with all b-side items in a single batch")
+        ## b-side items are taken once from the loader; their order is fixed for the cache
+        self._b_items = next(iter(train_data.data_loader2))
+        self._b_cache = None
+        self._b_pos = 0
+        self._b_steps = 0
+        self._b_refresh_interval = self.b_refresh_steps if self.b_refresh_steps > 0 else len(train_data)
+
+    def _refresh_b_cache(self, model):
+        in2, vl2, tt2, _, _ = self._b_items
+        n = self.b_subset_size
+        encs = []
+        with mx.autograd.pause():
+            for i in range(0, in2.shape[0], n):
+                _, enc = model.bert(in2[i:i+n].as_in_context(self.ctx), tt2[i:i+n].as_in_context(self.ctx),
+                                    vl2[i:i+n].astype('float32').as_in_context(self.ctx))
+                encs.append(enc)
+        self._b_cache = mx.nd.concat(*encs, dim=0)
+        self._b_steps = 0
+
+    def _get_cached_b_losses(self, model, batch_data):
+        batch1, _ = batch_data
+        in1, vl1, tt1, bow1, label1 = batch1
+        if self._b_cache is None or self._b_steps >= self._b_refresh_interval:
+            self._refresh_b_cache(model)
+        in2, vl2, tt2, bow2, label2 = self._b_items
+        n_b = in2.shape[0]
+        start = self._b_pos
+        end = min(start + self.b_subset_size, n_b)
+        rest = [ (a, b) for a, b in ((0, start), (end, n_b)) if b > a ]
+        cached_enc2 = mx.nd.concat(*[ self._b_cache[a:b] for a, b in rest ], dim=0) if len(rest) > 0 else None
+        elbo_ls, rec_ls, kl_ls, red_ls, z_mu1, z_mu2, enc2 = model.forward_with_cached_b(
+            in1.as_in_context(self.ctx), tt1.as_in_context(self.ctx),
+            vl1.astype('float32').as_in_context(self.ctx), bow1.as_in_context(self.ctx),
+            in2[start:end].as_in_context(self.ctx), tt2[start:end].as_in_context(self.ctx),
+            vl2[start:end].astype('float32').as_in_context(self.ctx), bow2[start:end].as_in_context(self.ctx),
+            cached_enc2)
+        with mx.autograd.pause():
+            ## the fresh encodings of the subset replace their cached values
+            self._b_cache[start:end] = enc2.detach()
+        self._b_pos = end % n_b
+        self._b_steps += 1
+        ## labels in the order of z_mu2: the subset, then the cached items; as label indices rather than 1-hot vecs
+        label2 = mx.nd.concat(*[ label2[a:b] for a, b in [(start, end)] + rest ], dim=0)
+        label1 = label1.argmax(axis=1).as_in_context(self.ctx)
+        label2 = label2.argmax(axis=1).as_in_context(self.ctx)
+        label_ls = self.loss_function(z_mu1, label1, z_mu2, label2)
+        label_ls = label_ls.mean()
+        total_ls = (self.gamma * label_ls) + elbo_ls.mean()
+        return elbo_ls, rec_ls, kl_ls, red_ls, label_ls, total_ls
+
     def _get_losses(self, model, batch_data):
+        if self._b_items is not None:
+            return self._get_cached_b_losses(model, batch_data)
         elbo_ls, rec_ls, kl_ls, red_ls, z_mu1, z_mu2, label1, label2 = self._ff_batch(model, batch_data)
         ## convert back to label indices rather than 1-hot vecs
         label1_ind = label1.argmax(axis=1)
@@ -1776,7 +2384,6 @@ class SeqBowMetricEstimator(SeqBowEstimator):
         posteriors = []
         ground_truth = []
         ground_truth_idx = []
-        emb2 = None
         emb1 = []
         for batch_id, data_batch in enumerate(dataloader):
             elbo_ls, rec_ls, kl_ls, red_ls, z_mu1, z_mu2, label1, label2 = self._ff_batch(model, data_batch)
@@ -1790,17 +2397,12 @@ class SeqBowMetricEstimator(SeqBowEstimator):
             posteriors += list(probs)
             ground_truth_idx += list(label1_ind.asnumpy()) ## index values for labels
             ground_truth += list(label1.asnumpy())
-            if emb2 is None:
-                emb2 = z_mu2.asnumpy()
-            emb1 += list(z_mu1.asnumpy())
+            if self._plotter is not None:
+                emb1.append(z_mu1.asnumpy())
         posteriors = np.array(posteriors)        
         ground_truth = np.array(ground_truth)
         ground_truth_idx = np.array(ground_truth_idx)
         labels = np.arange(posteriors[0].shape[0])
-        if not np.any(np.isnan(posteriors)):
-            avg_prec = average_precision_score(ground_truth, posteriors, average='weighted')
-        else:
-            avg_prec = 0.0
         try:
             auroc = roc_auc_score(ground_truth, posteriors, average='weighted', labels=labels)
         except:
@@ -1808,36 +2410,16 @@ class SeqBowMetricEstimator(SeqBowEstimator):
             logging.error('ROC computation failed')
         ndcg = ndcg_score(ground_truth, posteriors)
 
-        ## bit of hackery to only compute average precision for non-null/other categories
+        ## the weighted average precision leaves out the non-null/other category (if any);
         ## in many cases, we'd like to optimize over this score
-        if self.non_scoring_index >= 0:
-            wsum = 0.0
-            tot  = 0.0
-            for c in range(len(labels)):
-                y_vec = ground_truth[:,c]
-                pred_vec = posteriors[:,c]
-                ap_c = average_precision_score(y_vec, pred_vec) if not np.any(np.isnan(pred_vec)) else 0.0
-                if c != self.non_scoring_index:
-                    support = int(y_vec.sum())
-                    if support > 0:
-                        wsum += ap_c * support
-                        tot  += support
-            avg_prec = wsum / tot
-
-        top_acc_1 = top_k_accuracy_score(ground_truth_idx, posteriors, k=1, labels=labels)        
-        top_acc_2 = top_k_accuracy_score(ground_truth_idx, posteriors, k=2, labels=labels)
-        top_acc_3 = top_k_accuracy_score(ground_truth_idx, posteriors, k=3, labels=labels)
-        top_acc_4 = top_k_accuracy_score(ground_truth_idx, posteriors, k=4, labels=labels)
-        y = np.where(ground_truth > 0)[1]
-        if self.plot_dir:
-            ofile = self.plot_dir + '/' + 'plot_' + str(epoch_id) + '.png'
-            umap_model = umap.UMAP(n_neighbors=4, min_dist=0.5, metric='euclidean')
-            embeddings = umap_model.fit_transform(np.array(emb1))
-            #mapper = umap_model.fit(np.array(emb1))
-            plt.scatter(*embeddings.T, c=y, s=0.8, alpha=0.9, cmap='coolwarm')
-            #umap.plot.points(mapper, labels=y)
-            plt.savefig(ofile)
-            plt.close("all")
+        metrics = classification_metrics(ground_truth, posteriors, top_k=(), non_scoring_index=self.non_scoring_index)
+        avg_prec = metrics['weighted_ap']
+        top_k_acc = classification_metrics(ground_truth_idx, posteriors, top_k=(1, 2, 3, 4),
+                                           average_precision_scores=False)['top_k']
+        top_acc_1, top_acc_2, top_acc_3, top_acc_4 = [ top_k_acc[k] for k in (1, 2, 3, 4) ]
+        if self._plotter is not None:
+            ## projection and plotting happen in the background
+            self._plotter.add(epoch_id, np.concatenate(emb1), np.where(ground_truth > 0)[1])
         if include_predictions:
             res_predictions = posteriors
             res_ground_truth = ground_truth
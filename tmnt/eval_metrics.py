@@ -0,0 +1,139 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Vectorized classification metrics (accuracy, top-k accuracy and average precision) computed from whole
+score matrices. Large matrices are processed in blocks of rows (top-k accuracy) or label columns
+(average precision) so memory use stays bounded with thousands of labels.
+"""
+
+import numpy as np
+import scipy.sparse as sp
+
+__all__ = ['top_k_accuracy', 'average_precision', 'classification_metrics']
+
+## maximum number of matrix elements processed at once
+BLOCK_ELEMENTS = 2 ** 22
+
+
+def top_k_accuracy(labels, scores, ks=(1,), block_elements=BLOCK_ELEMENTS):
+    """Top-k accuracy for several values of k with a single pass over the score matrix. The rank of the true label
+    is the number of labels with a strictly higher score, so ties are counted in favour of the true label.
+
+    Parameters:
+        labels (array): Label indices of shape [n_samples]; samples with negative labels (unlabeled) are skipped
+        scores (array): Scores of shape [n_samples, n_labels]
+        ks (tuple): Values of k
+        block_elements (int): Maximum number of score matrix elements processed at once
+
+    Returns:
+        (dict): Dictionary of k to accuracy
+    """
+    labels = np.asarray(labels, dtype='int64').reshape(-1)
+    hits = np.zeros(len(ks))
+    total = 0
+    rows = max(1, block_elements // max(1, scores.shape[1]))
+    for r0 in range(0, scores.shape[0], rows):
+        lab = labels[r0:r0+rows]
+        block = np.asarray(scores[r0:r0+rows])[lab >= 0]
+        lab = lab[lab >= 0]
+        true_scores = block[np.arange(lab.shape[0]), lab]
+        rank = (block > true_scores[:, None]).sum(axis=1)
+        hits += (rank[:, None] < np.asarray(ks)[None, :]).sum(axis=0)
+        total += lab.shape[0]
+    return { k: (hits[i] / total if total > 0 else 0.0) for i, k in enumerate(ks) }
+
+
+def _average_precision_columns(y_true, scores):
+    ## average precision of each column; tied scores form a single threshold as with sklearn.metrics.average_precision_score
+    n = scores.shape[0]
+    order = np.argsort(-scores, axis=0, kind='mergesort')
+    s_sorted = np.take_along_axis(scores, order, axis=0)
+    y_sorted = np.take_along_axis(y_true, order, axis=0).astype('float64')
+    tp = np.cumsum(y_sorted, axis=0)
+    precision = tp / np.arange(1, n+1)[:, None]
+    ## every item in a run of tied scores takes the precision at the end of the run
+    is_end = np.ones(s_sorted.shape, dtype=bool)
+    is_end[:-1] = s_sorted[:-1] != s_sorted[1:]
+    end_idx = np.where(is_end, np.arange(n)[:, None], n - 1)
+    end_idx = np.minimum.accumulate(end_idx[::-1], axis=0)[::-1]
+    precision = np.take_along_axis(precision, end_idx, axis=0)
+    support = tp[-1]
+    ap = (y_sorted * precision).sum(axis=0) / np.maximum(support, 1.0)
+    ap[np.isnan(scores).any(axis=0)] = 0.0
+    return ap, support
+
+
+def _label_block(labels, c0, c1):
+    if sp.issparse(labels):
+        return labels[:, c0:c1].toarray() > 0
+    if labels.ndim == 1:
+        return labels[:, None] == np.arange(c0, c1)[None, :]
+    return labels[:, c0:c1] > 0
+
+
+def average_precision(labels, scores, block_elements=BLOCK_ELEMENTS):
+    """Average precision for each label (column) of a score matrix. Columns containing NaN scores get 0.0.
+
+    Parameters:
+        labels (array): Label indices of shape [n_samples] (negative for none) or a label indicator matrix
+            (dense or scipy sparse) of shape [n_samples, n_labels] for multilabel data
+        scores (array): Scores of shape [n_samples, n_labels]
+        block_elements (int): Maximum number of score matrix elements processed at once
+
+    Returns:
+        (tuple): Tuple containing:
+            - ap (:class:`numpy.ndarray`): average precision for each label
+            - support (:class:`numpy.ndarray`): number of positive samples for each label
+    """
+    if not sp.issparse(labels):
+        labels = np.asarray(labels)
+    n_labels = scores.shape[1]
+    cols = max(1, block_elements // max(1, scores.shape[0]))
+    ap, support = np.zeros(n_labels), np.zeros(n_labels)
+    for c0 in range(0, n_labels, cols):
+        c1 = min(c0 + cols, n_labels)
+        ap[c0:c1], support[c0:c1] = _average_precision_columns(_label_block(labels, c0, c1),
+                                                               np.asarray(scores[:, c0:c1], dtype='float64'))
+    return ap, support
+
+
+def classification_metrics(labels, scores, top_k=(1,), average_precision_scores=True, micro_ap=False,
+                           non_scoring_index=-1, block_elements=BLOCK_ELEMENTS):
+    """Classification metrics from a complete score matrix.
+
+    Parameters:
+        labels (array): Label indices of shape [n_samples] (negative for unlabeled samples) or a label indicator
+            matrix of shape [n_samples, n_labels] for multilabel data (top-k accuracy is not computed)
+        scores (array): Scores (e.g. logits or posteriors) of shape [n_samples, n_labels]
+        top_k (tuple): Values of k for top-k accuracy
+        average_precision_scores (bool): Compute per-label, macro and weighted average precision
+        micro_ap (bool): Also compute micro-averaged average precision (over all sample-label pairs)
+        non_scoring_index (int): Label excluded from the macro and weighted averages (-1 for none)
+        block_elements (int): Maximum number of score matrix elements processed at once
+
+    Returns:
+        (dict): Metrics with 'top_k' (dictionary of k to accuracy) and 'accuracy' (top-1) for single-label data;
+        'ap_scores' (list of (average precision, support) for each label), 'macro_ap' and 'weighted_ap' (over
+        labels with positive support) with `average_precision_scores`; 'micro_ap' with `micro_ap`
+    """
+    multilabel = sp.issparse(labels) or np.asarray(labels).ndim > 1
+    metrics = {}
+    if not multilabel and len(top_k) > 0:
+        metrics['top_k'] = top_k_accuracy(labels, scores, ks=tuple(set(top_k) | {1}), block_elements=block_elements)
+        metrics['accuracy'] = metrics['top_k'][1]
+    if average_precision_scores:
+        ap, support = average_precision(labels, scores, block_elements=block_elements)
+        metrics['ap_scores'] = [ (float(a), int(s)) for a, s in zip(ap, support) ]
+        scoring = support > 0
+        if non_scoring_index >= 0:
+            scoring[non_scoring_index] = False
+        metrics['macro_ap'] = float(ap[scoring].mean()) if scoring.any() else 0.0
+        metrics['weighted_ap'] = float((ap[scoring] * support[scoring]).sum() / support[scoring].sum()) if scoring.any() else 0.0
+    if micro_ap:
+        if sp.issparse(labels):
+            y_all = labels.toarray() > 0
+        else:
+            y_all = _label_block(np.asarray(labels), 0, scores.shape[1])
+        m_ap, _ = _average_precision_columns(y_all.reshape(-1, 1), np.asarray(scores, dtype='float64').reshape(-1, 1))
+        metrics['micro_ap'] = float(m_ap[0])
+    return metrics
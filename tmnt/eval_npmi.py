@@ -15,7 +15,7 @@ import scipy.sparse
 from tmnt.utils.ngram_helpers import BigramReader
 from itertools import combinations
 
-__all__ = ['NPMI', 'EvaluateNPMI']
+__all__ = ['NPMI', 'EvaluateNPMI', 'NPMICounts']
 
 class NPMI(object):
 
@@ -55,75 +55,73 @@ class EvaluateNPMI(object):
         return total_npmi / len(self.top_k_words_per_topic)
 
     def evaluate_csr_mat(self, csr_mat):
-        if isinstance(csr_mat, scipy.sparse.csr.csr_matrix):
-            is_sparse = True
-            mat = csr_mat
-        else:
-            is_sparse = isinstance(csr_mat, mx.nd.sparse.CSRNDArray)
-            if is_sparse:
-                mat = csr_mat.asscipy()
-            else:
-                mat = csr_mat.asnumpy()
-        n_docs = mat.shape[0]
-        total_npmi = 0
-        for i, words_per_topic in enumerate(self.top_k_words_per_topic):
-            total_topic_npmi = 0
-            n_topics = len(words_per_topic)
-            for (w1, w2) in combinations(sorted(words_per_topic), 2):
-                o_1 = mat[:, w1] > 0
-                o_2 = mat[:, w2] > 0
-                if is_sparse:
-                    o_1 = o_1.toarray().squeeze()
-                    o_2 = o_2.toarray().squeeze()
-                occur_1 = np.array(o_1, dtype='int')
-                occur_2 = np.array(o_2, dtype='int')
-                unigram_1 = occur_1.sum()
-                unigram_2 = occur_2.sum()
-                bigram_cnt = np.sum(occur_1 * occur_2)
-                if bigram_cnt < 1:
-                    npmi = 0.0
-                else:
-                    npmi = (log10(n_docs) + log10(bigram_cnt) - log10(unigram_1) - log10(unigram_2)) / (log10(n_docs) - log10(bigram_cnt) + 1e-4)
-                total_topic_npmi += npmi
-            total_topic_npmi *= (2 / (n_topics * (n_topics-1)))
-            total_npmi += total_topic_npmi
-        return total_npmi / len(self.top_k_words_per_topic)
+        counts = NPMICounts(self.top_k_words_per_topic)
+        counts.update(csr_mat)
+        return counts.npmi()
 
     def evaluate_csr_loader(self, dataloader):
-        ndocs = 0
+        counts = NPMICounts(self.top_k_words_per_topic)
+        for _, (csr,_) in enumerate(dataloader):
+            counts.update(csr)
+        return counts.npmi()
+
+
+class NPMICounts(object):
+    """Document and co-document frequencies of the top-k terms of each topic, accumulated over batches of
+    documents so that NPMI can be computed in the same pass over the data as other validation metrics.
+    Only the columns for the (union of) top-k terms are extracted from each batch; co-document frequencies
+    for all pairs of these terms are obtained with a single matrix product per batch.
+
+    Parameters:
+        top_k_words_per_topic (list): List of lists of term ids, one list per topic
+    """
+    def __init__(self, top_k_words_per_topic):
+        self.top_k_words_per_topic = top_k_words_per_topic
+        self.term_ids = sorted(set(w for words in top_k_words_per_topic for w in words))
+        self._term_index = { w: i for i, w in enumerate(self.term_ids) }
+        self._term_nd = None
+        self.reset()
+
+    def reset(self):
+        n_terms = len(self.term_ids)
+        self.n_docs = 0
+        self.doc_freqs = np.zeros(n_terms)
+        self.co_doc_freqs = np.zeros((n_terms, n_terms))
+
+    def _occurrences(self, batch):
+        if isinstance(batch, mx.nd.sparse.CSRNDArray):
+            batch = batch.asscipy()
+        elif isinstance(batch, mx.nd.NDArray):
+            ## select the term columns on the batch's device so only those are copied to the host
+            if self._term_nd is None or self._term_nd.context != batch.context:
+                self._term_nd = mx.nd.array(self.term_ids, ctx=batch.context)
+            return (mx.nd.take(batch, self._term_nd, axis=1) > 0).asnumpy().astype('float64')
+        if scipy.sparse.issparse(batch):
+            return (scipy.sparse.csr_matrix(batch)[:, self.term_ids] > 0).astype('float64')
+        return (np.asarray(batch)[:, self.term_ids] > 0).astype('float64')
+
+    def update(self, batch):
+        """Add the documents in `batch` (MXNet NDArray/CSRNDArray, scipy sparse matrix or numpy array of shape
+        [n_docs, vocab_size]) to the counts."""
+        occur = self._occurrences(batch)
+        co_occur = occur.T.dot(occur)
+        self.n_docs += occur.shape[0]
+        self.doc_freqs += np.asarray(occur.sum(axis=0)).ravel()
+        self.co_doc_freqs += co_occur.toarray() if scipy.sparse.issparse(co_occur) else co_occur
+
+    def npmi(self):
+        """Average NPMI over topics based on the documents added so far."""
+        log_n = log10(self.n_docs)
         total_npmi = 0
-        for i, words_per_topic in enumerate(self.top_k_words_per_topic):
-            n_topics = len(words_per_topic)
+        for words_per_topic in self.top_k_words_per_topic:
             total_topic_npmi = 0
+            n_words = len(words_per_topic)
             for (w1, w2) in combinations(sorted(words_per_topic), 2):
-                npmi = 0.0
-                unigram1 = 0.0
-                unigram2 = 0.0
-                bigram_cnt = 0.0
-                n_docs = 0
-                for _, (csr,_) in enumerate(dataloader):
-                    is_sparse = isinstance(csr, mx.nd.sparse.CSRNDArray)
-                    if is_sparse:
-                        mat = csr.asscipy()
-                    else:
-                        mat = csr.asnumpy()
-                    n_docs += mat.shape[0]
-                    o1 = mat[:, w1] > 0
-                    o2 = mat[:, w2] > 0
-                    if is_sparse:
-                        o1 = o1.toarray().squeeze()
-                        o2 = o2.toarray().squeeze()
-                    occur1 = np.array(o1, dtype='int')
-                    occur2 = np.array(o2, dtype='int')
-                    unigram1 += occur1.sum()
-                    unigram2 += occur2.sum()
-                    bigram_cnt += np.sum(occur1 * occur2)
+                i, j = self._term_index[w1], self._term_index[w2]
+                bigram_cnt = self.co_doc_freqs[i, j]
                 if bigram_cnt >= 1:
-                    npmi += (log10(n_docs) + log10(bigram_cnt) - log10(unigram1) - log10(unigram2)) / (log10(n_docs) - log10(bigram_cnt) + 1e-4)
-                total_topic_npmi += npmi
-            total_topic_npmi *= (2 / (n_topics * (n_topics-1)))
+                    total_topic_npmi += (log_n + log10(bigram_cnt) - log10(self.doc_freqs[i]) - log10(self.doc_freqs[j])) / \
+                        (log_n - log10(bigram_cnt) + 1e-4)
+            total_topic_npmi *= (2 / (n_words * (n_words-1)))
             total_npmi += total_topic_npmi
         return total_npmi / len(self.top_k_words_per_topic)
-                        
-        
-
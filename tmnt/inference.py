@@ -17,9 +17,12 @@ import pickle
 from tmnt.modeling import BowVAEModel, CovariateBowVAEModel, SeqBowVED, MetricSeqBowVED
 from tmnt.estimator import BowEstimator, CovariateBowEstimator, SeqBowEstimator, SeqBowMetricEstimator
 from tmnt.data_loading import DataIterLoader, file_to_data, SparseMatrixDataIter
+from tmnt.bert_handling import TokenBudgetBatchSampler
 from tmnt.preprocess.vectorizer import TMNTVectorizer
 from tmnt.distribution import HyperSphericalDistribution, LogisticGaussianDistribution
-from tmnt.utils.recalibrate import recalibrate_scores
+from tmnt.utils.recalibrate import recalibrate_scores_batch
+from tmnt.utils.precision import resolve_dtype, cast_for_inference
+from tmnt.tuning import ThroughputTuner, write_tuning_report
 from multiprocessing import Pool
 from gluonnlp.data import BERTTokenizer, BERTSentenceTransform
 from sklearn.datasets import load_svmlight_file
@@ -51,11 +54,22 @@ class BaseInferencer(object):
 
 
 class BowVAEInferencer(BaseInferencer):
+    """Inferencer for bag-of-words variational autoencoder models (with or without covariates).
+
+    Parameters:
+        estimator: Bag-of-words estimator with a trained model
+        pre_vectorizer: Vectorizer for raw texts (default uses the model vocabulary)
+        max_batch_size: Number of documents encoded per batch
+        dtype: Inference precision: 'float32' | 'bfloat16' | 'float16'. Reduced precision stores the encoder
+            layers (of the estimator's model) in that dtype; mixed precision must be enabled for the process first
+            with :func:`tmnt.utils.precision.init_reduced_precision`
     """
-    """
-    def __init__(self, estimator, pre_vectorizer=None):
+    def __init__(self, estimator, pre_vectorizer=None, max_batch_size=1024, dtype='float32'):
         super().__init__(estimator.model.model_ctx)
-        self.max_batch_size = 16
+        self.max_batch_size = max_batch_size
+        self.dtype = resolve_dtype(dtype)
+        ## the sparse (CSR) input layer stays in float32
+        cast_for_inference([estimator.model.encoder], dtype)
         self.vocab = estimator.model.vocabulary
         self.vectorizer = pre_vectorizer or TMNTVectorizer(initial_vocabulary=estimator.model.vocabulary)
         self.n_latent = estimator.model.n_latent
@@ -69,7 +83,7 @@ class BowVAEInferencer(BaseInferencer):
             self.covar_model = False
 
     @classmethod
-    def from_saved(cls, model_dir=None, ctx=mx.cpu()):
+    def from_saved(cls, model_dir=None, ctx=mx.cpu(), max_batch_size=1024, dtype='float32'):
         serialized_vectorizer_file = None
         config_file = os.path.join(model_dir,'model.config')
         param_file = os.path.join(model_dir,'model.params')
@@ -89,7 +103,7 @@ class BowVAEInferencer(BaseInferencer):
                 vectorizer = pickle.load(fp)
         else:
             vectorizer = None
-        return cls(estimator, pre_vectorizer=vectorizer)
+        return cls(estimator, pre_vectorizer=vectorizer, max_batch_size=max_batch_size, dtype=dtype)
 
     def save(self, model_dir: str) -> None:
         """
@@ -105,6 +119,29 @@ class BowVAEInferencer(BaseInferencer):
                 pickle.dump(self.vectorizer, fp)
 
 
+    def tune_throughput(self, X, y=None, memory_cap_mb=None, model_dir=None, apply=True, **tuner_kwargs):
+        """
+        Probe encoding throughput on (a sample of) `X` over candidate batch sizes and thread counts
+        (see :class:`tmnt.tuning.ThroughputTuner`).
+
+        Parameters:
+            X: Document-term matrix representative of the data to encode
+            y: Covariates for `X` (covariate models only)
+            memory_cap_mb: Settings with higher peak memory are not recommended
+            model_dir: If provided, the tuning report is written to this directory
+            apply: Use the recommended batch size for encoding with this inferencer
+            tuner_kwargs: Additional keyword arguments to :class:`tmnt.tuning.ThroughputTuner`
+
+        Returns:
+            Tuning report (dict)
+        """
+        report = ThroughputTuner(memory_cap_mb=memory_cap_mb, **tuner_kwargs).tune(self.estimator, X, y, mode='inference')
+        if model_dir is not None:
+            write_tuning_report(report, model_dir)
+        if apply and report['best'] is not None:
+            self.max_batch_size = report['best']['batch_size']
+        return report
+
     def get_model_details(self, sp_vec_file_or_X, y=None):
         if isinstance(sp_vec_file_or_X, str):
             data_csr, labels = load_svmlight_file(sp_vec_file, n_features=len(self.vocab))
@@ -189,41 +226,104 @@ class BowVAEInferencer(BaseInferencer):
                                                       batch_size, last_batch_handle='discard', shuffle=False))
         return infer_iter, last_batch_size
 
-    def encode_data(self, data_mat, labels=None, use_probs=True, include_bn=True, target_entropy=1.0):
-        infer_iter, last_batch_size = self._get_data_iterator(data_mat, labels)
-        encodings = []
-        for _, (data,labels) in enumerate(infer_iter):
-            data = data.as_in_context(self.ctx)
-            if self.covar_model and labels is not None:
-                labels = labels.as_in_context(self.ctx)
-                encs = self.model.encode_data_with_covariates(data, labels, include_bn=include_bn)
-            else:
-                encs = self.model.encode_data(data, include_bn=include_bn)
-            if use_probs:
-                e1 = (encs - mx.nd.min(encs, axis=1).expand_dims(1)).astype('float64')
-                encs = list(mx.nd.softmax(e1).asnumpy())
-                encs = list(map(partial(recalibrate_scores, target_entropy=target_entropy), encs))
-            else:
-                encs = list(encs.astype('float64').asnumpy())
-            encodings.extend(encs)
-        ## handle the last batch explicitly as NDArrayIter doesn't do that for us
-        if last_batch_size > 0:
-            last_data = mx.nd.sparse.csr_matrix(data_mat[-last_batch_size:], dtype='float32')
-            data = last_data.as_in_context(self.ctx)
-            if self.covar_model and labels is not None:
-                labels = mx.nd.one_hot(mx.nd.array(labels[-last_batch_size:], dtype='int'),
-                                       self.n_covars).as_in_context(self.ctx)
-                encs = self.model.encode_data_with_covariates(data, labels, include_bn=include_bn)
-            else:
-                encs = self.model.encode_data(data, include_bn=include_bn)
-            if use_probs:
-                e1 = (encs - mx.nd.min(encs, axis=1).expand_dims(1)).astype('float64')
-                encs = list(mx.nd.softmax(e1).asnumpy())
-                encs = list(map(partial(recalibrate_scores, target_entropy=target_entropy), encs))
+    def _encode_batch(self, X, covars, use_probs, include_bn):
+        ## returns an NDArray without waiting on it, so the next batch can be issued before this one is copied out
+        if scipy.sparse.issparse(X):
+            data = mx.nd.sparse.csr_matrix(X, dtype='float32', ctx=self.ctx)
+        else:
+            data = mx.nd.array(X, dtype='float32', ctx=self.ctx)
+        if self.covar_model and covars is not None:
+            covars = mx.nd.one_hot(mx.nd.array(covars, dtype='int', ctx=self.ctx), self.n_covars)
+            encs = self.model.encode_data_with_covariates(data, covars, include_bn=include_bn)
+        else:
+            encs = self.model.encode_data(data, include_bn=include_bn)
+        if use_probs:
+            e1 = (encs - mx.nd.min(encs, axis=1).expand_dims(1)).astype('float64')
+            return mx.nd.softmax(e1)
+        return encs.astype('float64')
+
+    def _finish_batch(self, encs, use_probs, target_entropy):
+        encs = encs.asnumpy()
+        if use_probs and target_entropy is not None:
+            encs = recalibrate_scores_batch(encs, target_entropy=target_entropy)
+        return encs
+
+    def iter_encode(self, X, covars=None, batch_size=None, use_probs=True, include_bn=True, target_entropy=1.0):
+        """Encode a document-term matrix in batches of rows, yielding the encodings of each batch in order.
+        Batches are sliced directly from `X`; each batch is submitted for encoding before the previous one
+        is copied back to host memory.
+
+        Parameters:
+            X: Document-term matrix (scipy CSR, dense numpy array or MXNet NDArray)
+            covars: Covariate values (integers) for each row of `X` (covariate models only)
+            batch_size: Number of rows per batch (default `max_batch_size`)
+            use_probs: Return topic proportions (softmax of the encodings) rather than raw encodings
+            include_bn: Apply the batch normalization of the latent distribution
+            target_entropy: Recalibrate topic proportions to this entropy (None to skip recalibration)
+
+        Returns:
+            Generator of :class:`numpy.ndarray` encodings (float64) with shape [batch rows, n_latent]
+        """
+        if isinstance(X, mx.nd.sparse.CSRNDArray):
+            X = X.asscipy()
+        elif isinstance(X, mx.nd.NDArray):
+            X = X.asnumpy()
+        if scipy.sparse.issparse(X):
+            X = X.tocsr()
+        if covars is not None:
+            covars = np.asarray(covars)
+        batch_size = batch_size or self.max_batch_size
+        pending = None
+        for i in range(0, X.shape[0], batch_size):
+            encs = self._encode_batch(X[i:i+batch_size], covars[i:i+batch_size] if covars is not None else None,
+                                      use_probs, include_bn)
+            if pending is not None:
+                yield self._finish_batch(pending, use_probs, target_entropy)
+            pending = encs
+        if pending is not None:
+            yield self._finish_batch(pending, use_probs, target_entropy)
+
+    def encode_to_array(self, X, covars=None, out=None, out_file=None, batch_size=None, use_probs=True,
+                        include_bn=True, target_entropy=1.0, dtype='float32'):
+        """Encode a document-term matrix into a preallocated array, optionally memory-mapped to a file,
+        so that no per-row or per-batch results are kept in memory.
+
+        Parameters:
+            X: Document-term matrix (scipy CSR, dense numpy array or MXNet NDArray)
+            covars: Covariate values (integers) for each row of `X` (covariate models only)
+            out: Output array of shape [rows of X, n_latent] (allocated if not provided)
+            out_file: If provided (and `out` is not), encodings are written to a memory-mapped '.npy' file at this path
+            batch_size: Number of rows per batch (default `max_batch_size`)
+            use_probs: Return topic proportions (softmax of the encodings) rather than raw encodings
+            include_bn: Apply the batch normalization of the latent distribution
+            target_entropy: Recalibrate topic proportions to this entropy (None to skip recalibration)
+            dtype: Data type of an allocated output array
+
+        Returns:
+            (:class:`numpy.ndarray`): Encodings (`out`, or the allocated array or memory map)
+        """
+        shape = (X.shape[0], self.n_latent)
+        if out is None:
+            if out_file is not None:
+                out = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=shape)
             else:
-                encs = list(encs.astype('float64').asnumpy())
-            encodings.extend(encs)
-        return encodings
+                out = np.empty(shape, dtype=dtype)
+        elif tuple(out.shape) != shape:
+            raise Exception("Output array has shape {} but encodings have shape {}".format(out.shape, shape))
+        i = 0
+        for encs in self.iter_encode(X, covars, batch_size=batch_size, use_probs=use_probs, include_bn=include_bn,
+                                     target_entropy=target_entropy):
+            out[i:i+encs.shape[0]] = encs
+            i += encs.shape[0]
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def encode_data(self, data_mat, labels=None, use_probs=True, include_bn=True, target_entropy=1.0):
+        covars = labels if self.covar_model else None
+        encodings = self.encode_to_array(data_mat, covars, use_probs=use_probs, include_bn=include_bn,
+                                         target_entropy=target_entropy, dtype='float64')
+        return list(encodings)
 
     def get_likelihood_stats(self, data_mat, n_samples=50):
         """Get the expected elbo and its variance for input data using sampling
@@ -314,20 +414,35 @@ class BowVAEInferencer(BaseInferencer):
 
 class SeqVEDInferencer(BaseInferencer):
     """Inferencer for sequence variational encoder-decoder models using BERT
+
+    Parameters:
+        estimator: Sequence estimator with a trained model
+        max_length: Maximum sequence length (in word pieces)
+        pre_vectorizer: Vectorizer for bag-of-words representations of texts (default uses the model vocabulary)
+        ctx: MXNet context
+        dtype: Inference precision: 'float32' | 'bfloat16' | 'float16'. Reduced precision stores the BERT encoder
+            (of the estimator's model) in that dtype; mixed precision must be enabled for the process first
+            with :func:`tmnt.utils.precision.init_reduced_precision`
     """
-    def __init__(self, estimator, max_length, pre_vectorizer=None, ctx=mx.cpu()):
+    def __init__(self, estimator, max_length, pre_vectorizer=None, ctx=mx.cpu(), dtype='float32'):
         super().__init__(ctx)
         self.estimator = estimator
         self.model     = estimator.model 
+        self.dtype     = resolve_dtype(dtype)
+        cast_for_inference([self.model.bert], dtype)
         self.bert_base = self.model.bert
         self.tokenizer = BERTTokenizer(estimator.bert_vocab)
         self.transform = BERTSentenceTransform(self.tokenizer, max_length, pair=False)
+        ## batches are padded to their longest sequence rather than to max_length
+        self._unpadded_transform = BERTSentenceTransform(self.tokenizer, max_length, pad=False, pair=False)
+        self._pad_id = estimator.bert_vocab[estimator.bert_vocab.padding_token]
         self.bow_vocab = estimator.bow_vocab
         self.vectorizer = pre_vectorizer or TMNTVectorizer(initial_vocabulary=estimator.bow_vocab)
 
 
     @classmethod
-    def from_saved(cls, param_file=None, config_file=None, vocab_file=None, model_dir=None, max_length=128, ctx=mx.cpu()):
+    def from_saved(cls, param_file=None, config_file=None, vocab_file=None, model_dir=None, max_length=128, ctx=mx.cpu(),
+                   dtype='float32'):
         # if model_dir is not None:
         #     param_file = os.path.join(model_dir, 'model.params')
         #     vocab_file = os.path.join(model_dir, 'vocab.json')
@@ -369,7 +484,7 @@ class SeqVEDInferencer(BaseInferencer):
                 vectorizer = pickle.load(fp)
         else:
             vectorizer = None
-        return cls(estimator, max_length, pre_vectorizer=vectorizer, ctx=ctx)
+        return cls(estimator, max_length, pre_vectorizer=vectorizer, ctx=ctx, dtype=dtype)
 
 
     def _embed_sequence(self, ids, segs):
@@ -401,6 +516,85 @@ class SeqVEDInferencer(BaseInferencer):
         topic_encoding = self.model.latent_dist.get_mu_encoding(enc)
         return topic_encoding, tokens
 
+    def _tokenized_batches(self, texts, max_tokens, max_batch_size):
+        examples = [ self._unpadded_transform((txt,)) for txt in texts ]
+        lengths = [ int(vl) for _, vl, _ in examples ]
+        sampler = TokenBudgetBatchSampler(lengths, max_tokens, max_batch_size=max_batch_size, shuffle=False)
+        for batch in sampler:
+            max_len = max(lengths[i] for i in batch)
+            ids = np.full((len(batch), max_len), self._pad_id, dtype='int32')
+            segs = np.zeros((len(batch), max_len), dtype='int32')
+            for r, i in enumerate(batch):
+                ids[r, :lengths[i]] = examples[i][0]
+                segs[r, :lengths[i]] = examples[i][2]
+            yield batch, ids, segs, np.array([ lengths[i] for i in batch ], dtype='float32')
+
+    def _encodings_to_numpy(self, encs, use_probs, target_entropy):
+        if use_probs:
+            e1 = (encs - mx.nd.min(encs, axis=1).expand_dims(1)).astype('float64')
+            return recalibrate_scores_batch(mx.nd.softmax(e1).asnumpy(), target_entropy=target_entropy)
+        return encs.astype('float64').asnumpy()
+
+    def iter_encode_texts(self, texts, max_tokens=4096, max_batch_size=None, sort_window=None, use_probs=False,
+                          target_entropy=2.0):
+        """Encode texts with batched forward passes. Texts are tokenized, sorted by length and grouped into
+        batches padded to their longest sequence and filled up to a budget of (padded) tokens. Batches are
+        yielded in length order together with the positions of their texts in `texts`.
+
+        Parameters:
+            texts: Iterable of text strings
+            max_tokens: Maximum number of (padded) tokens per batch
+            max_batch_size: Optional upper bound on the number of texts per batch
+            sort_window: Tokenize and sort `sort_window` texts at a time so that results stream before all of
+                `texts` is read (default sorts all texts)
+            use_probs: Return topic proportions (softmax of the encodings) rather than raw encodings
+            target_entropy: Recalibrate topic proportions to this entropy (None to skip recalibration)
+
+        Returns:
+            Generator of tuples (indices, encodings) with the positions of the batch's texts and their encodings
+            (:class:`numpy.ndarray` of shape [batch size, n_latent])
+        """
+        texts = iter(texts)
+        offset = 0
+        pending = None
+        while True:
+            window = list(texts) if sort_window is None else [ t for _, t in zip(range(sort_window), texts) ]
+            if len(window) == 0:
+                break
+            for batch, ids, segs, lens in self._tokenized_batches(window, max_tokens, max_batch_size):
+                _, encs = self.model.bert(mx.nd.array(ids, dtype='int32', ctx=self.ctx),
+                                          mx.nd.array(segs, dtype='int32', ctx=self.ctx),
+                                          mx.nd.array(lens, dtype='float32', ctx=self.ctx))
+                encs = self.model.latent_dist.get_mu_encoding(encs)
+                ## the next batch is issued before this one is copied back to host memory
+                if pending is not None:
+                    yield pending[0], self._encodings_to_numpy(pending[1], use_probs, target_entropy)
+                pending = (np.array(batch, dtype='int64') + offset, encs)
+            offset += len(window)
+        if pending is not None:
+            yield pending[0], self._encodings_to_numpy(pending[1], use_probs, target_entropy)
+
+    def encode_texts(self, texts, max_tokens=4096, max_batch_size=None, use_probs=False, target_entropy=2.0):
+        """Encode texts with batched forward passes (see :meth:`iter_encode_texts`).
+
+        Parameters:
+            texts: List of text strings
+            max_tokens: Maximum number of (padded) tokens per batch
+            max_batch_size: Optional upper bound on the number of texts per batch
+            use_probs: Return topic proportions (softmax of the encodings) rather than raw encodings
+            target_entropy: Recalibrate topic proportions to this entropy (None to skip recalibration)
+
+        Returns:
+            (:class:`numpy.ndarray`): Encodings of shape [len(texts), n_latent] in the order of `texts`
+        """
+        encodings = None
+        for indices, encs in self.iter_encode_texts(texts, max_tokens=max_tokens, max_batch_size=max_batch_size,
+                                                    use_probs=use_probs, target_entropy=target_entropy):
+            if encodings is None:
+                encodings = np.empty((len(texts), encs.shape[1]), dtype=encs.dtype)
+            encodings[indices] = encs
+        return encodings if encodings is not None else np.empty((0, self.model.n_latent))
+
     def predict_text(self, txt):
         encoding, _ = self.encode_text(txt)
         return self.model.classifier(encoding)
@@ -431,13 +625,7 @@ class SeqVEDInferencer(BaseInferencer):
                                       segs.as_in_context(self.ctx), lens.astype('float32').as_in_context(self.ctx))
             encs = self.model.latent_dist.get_mu_encoding(encs)
             bow_matrix.append(bow.as_np_ndarray().squeeze())
-            if use_probs:
-                e1 = (encs - mx.nd.min(encs, axis=1).expand_dims(1)).astype('float64')
-                encs = list(mx.nd.softmax(e1).asnumpy())
-                topic_encodings = list(map(partial(recalibrate_scores, target_entropy=target_entropy), encs))
-            else:
-                topic_encodings = list(encs.astype('float64').asnumpy())
-            encodings.extend(topic_encodings)
+            encodings.extend(list(self._encodings_to_numpy(encs, use_probs, target_entropy)))
         return np.vstack(encodings), mx.np.vstack(bow_matrix)
 
     def get_pyldavis_details(self, dataloader):
@@ -472,14 +660,17 @@ class SeqVEDInferencer(BaseInferencer):
 
 
 class MetricSeqVEDInferencer(SeqVEDInferencer):
-    """Inferencer for sequence variational encoder-decoder models using BERT trained via Metric Learning
+    """Inferencer for sequence variational encoder-decoder models using BERT trained via Metric Learning.
+    Texts are encoded in batches with :meth:`encode_texts` and :meth:`iter_encode_texts` as with
+    :class:`SeqVEDInferencer`.
     """
-    def __init__(self, estimator, max_length, pre_vectorizer=None, ctx=mx.cpu()):
-        super().__init__(estimator, max_length, pre_vectorizer=pre_vectorizer, ctx=ctx)
+    def __init__(self, estimator, max_length, pre_vectorizer=None, ctx=mx.cpu(), dtype='float32'):
+        super().__init__(estimator, max_length, pre_vectorizer=pre_vectorizer, ctx=ctx, dtype=dtype)
 
 
     @classmethod
-    def from_saved(cls, param_file=None, config_file=None, vocab_file=None, model_dir=None, max_length=128, ctx=mx.cpu()):
+    def from_saved(cls, param_file=None, config_file=None, vocab_file=None, model_dir=None, max_length=128, ctx=mx.cpu(),
+                   dtype='float32'):
         estimator = SeqBowMetricEstimator.from_saved(model_dir=model_dir, ctx=ctx)
         serialized_vectorizer_file = os.path.join(model_dir, 'vectorizer.pkl')
         if os.path.exists(serialized_vectorizer_file):
@@ -487,7 +678,7 @@ class MetricSeqVEDInferencer(SeqVEDInferencer):
                 vectorizer = pickle.load(fp)
         else:
             vectorizer = None
-        return cls(estimator, max_length, pre_vectorizer=vectorizer, ctx=ctx)
+        return cls(estimator, max_length, pre_vectorizer=vectorizer, ctx=ctx, dtype=dtype)
 
 
 
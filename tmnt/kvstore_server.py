@@ -0,0 +1,33 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Entry point for the scheduler and server processes of an MXNet distributed kvstore, run as
+``python -m tmnt.kvstore_server`` with ``DMLC_ROLE`` set to ``scheduler`` or ``server`` (see :func:`tmnt.parallel.launch_local`).
+"""
+
+import os
+import sys
+import logging
+
+__all__ = ['run_kvstore_process']
+
+
+def run_kvstore_process():
+    """Run this process as a kvstore scheduler or server, according to ``DMLC_ROLE``. MXNet runs the scheduler
+    or server loop when it is imported with this role set, and exits the process when the loop finishes.
+    """
+    role = os.environ.get('DMLC_ROLE')
+    if role not in ('scheduler', 'server'):
+        raise Exception("DMLC_ROLE must be 'scheduler' or 'server' to run a kvstore process, found {}".format(role))
+    import mxnet
+    ## only reached if MXNet does not start a kvstore process for this role (e.g. built without distributed kvstore support)
+    raise Exception("MXNet {} did not start a kvstore {}".format(mxnet.__version__, role))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    try:
+        run_kvstore_process()
+    except Exception as e:
+        logging.error(str(e))
+        sys.exit(1)
@@ -20,6 +20,11 @@ from tmnt.distribution import HyperSphericalDistribution
 from tmnt.distribution import GaussianUnitVarDistribution
 from mxnet.gluon.loss import Loss, KLDivLoss
 
+def _reconstruction_loss(F, data, y):
+    ## negative log-likelihood of the (possibly sparse) term counts in `data` under word distributions `y`
+    return -F.sparse.sum(data * F.log(y+1e-12), axis=1)
+
+
 class BaseVAE(HybridBlock):
 
     def __init__(self, vocabulary=None, latent_distribution=LogisticGaussianDistribution(20),
@@ -100,8 +105,7 @@ class BaseVAE(HybridBlock):
             return (cur_loss, F.zeros_like(cur_loss), F.zeros_like(cur_loss))
 
     def get_loss_terms(self, F, data, y, KL, batch_size):
-        rr = data * F.log(y+1e-12)
-        recon_loss = -F.sparse.sum( rr, axis=1 )
+        recon_loss = _reconstruction_loss(F, data, y)
         i_loss = F.broadcast_plus(recon_loss, KL)
         ii_loss, coherence_loss, redundancy_loss = self.add_coherence_reg_penalty(F, i_loss)
         return ii_loss, recon_loss, coherence_loss, redundancy_loss
@@ -248,6 +252,25 @@ class BowVAEModel(BaseVAE):
             output vector (tensor): unnormalized outputs over label values
         """
         return self.classifier(self.lab_dr(self.encode_data(data)))
+
+
+    def validation_forward(self, data):
+        """Forward pass for validation giving the loss terms needed for perplexity together with the encoding
+        and classifier outputs, so these are all obtained from a single pass through the encoder.
+
+        Parameters:
+            data (tensor): input data tensor
+        Returns:
+            (tuple): Tuple of KL, recon_loss, encoding (as with `encode_data`) and classifier outputs
+            (as with `predict`; None without a classifier)
+        """
+        enc_out = self.encoder(self.embedding(data))
+        z, KL = self.latent_distribution(enc_out, data.shape[0])
+        y = mx.nd.softmax(self.decoder(z), axis=1)
+        recon_loss = _reconstruction_loss(mx.nd, data, y)
+        encoding = self.latent_distribution.get_mu_encoding(enc_out, include_bn=True)
+        predictions = self.classifier(self.lab_dr(encoding)) if self.has_classifier else None
+        return KL, recon_loss, encoding, predictions
     
 
     def hybrid_forward(self, F, data):
@@ -311,6 +334,233 @@ class MetricBowVAEModel(BowVAEModel):
         return (elbo1 + elbo2), (rec_loss1 + rec_loss2), (KL_loss1 + KL_loss2), redundancy_loss, mu1, mu2
 
 
+def _xavier_weight(shape, ctx):
+    ## same scaling as mx.init.Xavier() (uniform, average of fan-in and fan-out) for a single (out, in) weight
+    scale = math.sqrt(3.0 / ((shape[0] + shape[1]) / 2.0))
+    return mx.nd.random.uniform(-scale, scale, shape=shape, ctx=ctx)
+
+
+class StackedBowVAEModel(Block):
+    """
+    A stack of `n_seeds` independently initialized copies of :class:`BowVAEModel` trained as a single model.
+    Every weight has a leading seed dimension and all copies see the same data batches, so one forward pass
+    computes the losses for all copies with batched operations. The copies do not share any trainable
+    parameters; `unstack` extracts an individual copy as a :class:`BowVAEModel`.
+
+    Parameters:
+        n_seeds (int): Number of stacked model copies
+        vocabulary (:class:`gluon.Vocab`): GluonNLP Vocabulary
+        enc_dim (int): Number of dimension of input encoder (first FC layer)
+        embedding_size (int): Number of dimensions for embedding layer
+        n_encoding_layers (int): Number of layers used for the encoder
+        enc_dr (float): Dropout after each encoder layer
+        fixed_embedding (bool): Whether to fix embedding weights
+        latent_distribution (:class:`tmnt.distribution.BaseDistribution`): Latent distribution (used as a template);
+            Gaussian and logistic Gaussian distributions are supported
+        n_labels (int): Number of labels for the classifier (0 or 1 for no classifier)
+        ctx (int): context device (default is mx.cpu())
+    """
+    def __init__(self, n_seeds, vocabulary, enc_dim, embedding_size, n_encoding_layers, enc_dr, fixed_embedding,
+                 latent_distribution, n_labels=0, gamma=1.0, multilabel=False, classifier_dropout=0.1,
+                 coherence_reg_penalty=0.0, redundancy_reg_penalty=0.0, ctx=mx.cpu(), **kwargs):
+        super(StackedBowVAEModel, self).__init__(**kwargs)
+        if type(latent_distribution) not in (GaussianDistribution, LogisticGaussianDistribution):
+            raise Exception("Stacked multi-seed models do not support latent distribution {}"
+                            .format(type(latent_distribution).__name__))
+        self.n_seeds = n_seeds
+        self.vocabulary = vocabulary
+        self.vocab_size = len(vocabulary)
+        self.n_latent = latent_distribution.n_latent
+        ## the distribution supplies the sampling and KL computations for the flattened stack; it is not registered
+        ## as a child block since its own (deferred) parameters are never used
+        object.__setattr__(self, 'latent_distribution', latent_distribution)
+        self.embedding_size = embedding_size
+        self.num_enc_layers = n_encoding_layers
+        self.enc_dr = enc_dr
+        self.enc_dim = enc_dim
+        self.fixed_embedding = fixed_embedding
+        self.n_labels = n_labels
+        self.gamma = gamma
+        self.multilabel = multilabel
+        self.classifier_dropout = classifier_dropout
+        self.has_classifier = self.n_labels > 1
+        self.coherence_reg_penalty = coherence_reg_penalty
+        self.redundancy_reg_penalty = redundancy_reg_penalty
+        self.model_ctx = ctx
+        self.post_sample_dr = latent_distribution.post_sample_dr_o._rate
+        self.encoding_dims = [self.embedding_size] + [enc_dim for _ in range(n_encoding_layers)]
+        S, E, V, K = n_seeds, embedding_size, self.vocab_size, self.n_latent
+        with self.name_scope():
+            ## embeddings of all copies are computed by a single (sparse) matrix product
+            self.emb_weight = self.params.get('emb_weight', shape=(S*E, V), init=mx.init.Zero())
+            self.emb_bias = self.params.get('emb_bias', shape=(S*E,), init=mx.init.Zero())
+            self.enc_weights, self.enc_biases = [], []
+            for i in range(n_encoding_layers):
+                self.enc_weights.append(self.params.get('enc{}_weight'.format(i), init=mx.init.Zero(),
+                                                        shape=(S, self.encoding_dims[i+1], self.encoding_dims[i])))
+                self.enc_biases.append(self.params.get('enc{}_bias'.format(i), shape=(S, self.encoding_dims[i+1]),
+                                                       init=mx.init.Zero()))
+            for v in ('mu', 'lv'):
+                setattr(self, v + '_weight', self.params.get(v + '_weight', shape=(S, K, enc_dim), init=mx.init.Zero()))
+                setattr(self, v + '_bias', self.params.get(v + '_bias', shape=(S, K), init=mx.init.Zero()))
+                ## batch normalization is per latent dimension, so the copies are normalized together as (B, S*K)
+                setattr(self, v + '_bn_gamma', self.params.get(v + '_bn_gamma', shape=(S*K,), init=mx.init.One()))
+                setattr(self, v + '_bn_beta', self.params.get(v + '_bn_beta', shape=(S*K,), init=mx.init.Zero()))
+                setattr(self, v + '_bn_running_mean',
+                        self.params.get(v + '_bn_running_mean', shape=(S*K,), init=mx.init.Zero(),
+                                        grad_req='null', differentiable=False))
+                setattr(self, v + '_bn_running_var',
+                        self.params.get(v + '_bn_running_var', shape=(S*K,), init=mx.init.One(),
+                                        grad_req='null', differentiable=False))
+            self.dec_weight = self.params.get('dec_weight', shape=(S, V, K), init=mx.init.Zero())
+            self.dec_bias = self.params.get('dec_bias', shape=(S, V), init=mx.init.Zero())
+            if self.has_classifier:
+                self.cls_weight = self.params.get('cls_weight', shape=(S, n_labels, K), init=mx.init.Zero())
+                self.cls_bias = self.params.get('cls_bias', shape=(S, n_labels), init=mx.init.Zero())
+            self.coherence_regularization = CoherenceRegularizer(coherence_reg_penalty, redundancy_reg_penalty)
+        self.collect_params().initialize(ctx=ctx)
+        ## each copy is initialized like a separate BowVAEModel
+        self.emb_weight.set_data(mx.nd.concat(*[_xavier_weight((E, V), ctx) for _ in range(S)], dim=0))
+        for w in self.enc_weights + [self.mu_weight, self.lv_weight, self.dec_weight] + \
+            ([self.cls_weight] if self.has_classifier else []):
+            w.set_data(mx.nd.stack(*[_xavier_weight(w.shape[1:], ctx) for _ in range(S)]))
+        if self.vocabulary.embedding:
+            assert self.vocabulary.embedding.idx_to_vec[0].size == self.embedding_size
+            emb = self.vocabulary.embedding.idx_to_vec.transpose()
+            emb_norm_val = mx.nd.norm(emb, keepdims=True, axis=0) + 1e-10
+            self.emb_weight.set_data(mx.nd.tile(emb / emb_norm_val, reps=(S, 1)).as_in_context(ctx))
+            if fixed_embedding:
+                self.emb_weight.grad_req = 'null'
+                self.emb_bias.grad_req = 'null'
+
+    def initialize_bias_terms(self, wd_freqs):
+        if wd_freqs is not None:
+            freq_nd = wd_freqs + 1 # simple smoothing
+            log_freq = freq_nd.log() - freq_nd.sum().log()
+            self.dec_bias.set_data(mx.nd.tile(log_freq.reshape((1, -1)), reps=(self.n_seeds, 1)).as_in_context(self.model_ctx))
+            self.dec_bias.grad_req = 'null'
+
+    def _stacked_dense(self, x, weight, bias):
+        ## x has shape (S, B, in), weight (S, out, in) and bias (S, out)
+        return mx.nd.broadcast_add(mx.nd.batch_dot(x, weight, transpose_b=True), bias.expand_dims(1))
+
+    def _batch_norm(self, x, prefix, eps):
+        S, B, K = x.shape
+        flat = x.transpose((1, 0, 2)).reshape((B, S*K))
+        params = [getattr(self, prefix + n).data() for n in ('_bn_gamma', '_bn_beta', '_bn_running_mean', '_bn_running_var')]
+        out = mx.nd.BatchNorm(flat, *params, eps=eps, momentum=0.8, fix_gamma=False)
+        return out.reshape((B, S, K)).transpose((1, 0, 2))
+
+    def _encode(self, data):
+        B = data.shape[0]
+        emb = mx.nd.FullyConnected(data, self.emb_weight.data(), self.emb_bias.data(),
+                                   num_hidden=self.n_seeds * self.embedding_size)
+        h = mx.nd.tanh(emb).reshape((B, self.n_seeds, self.embedding_size)).transpose((1, 0, 2))
+        for w, b in zip(self.enc_weights, self.enc_biases):
+            h = mx.nd.Activation(self._stacked_dense(h, w.data(), b.data()), act_type='softrelu')
+            if self.enc_dr > 0.0:
+                h = mx.nd.Dropout(h, p=self.enc_dr)
+        return h
+
+    def encode_data(self, data, include_bn=True):
+        """
+        Encode data to the mean of the latent distribution of every copy.
+
+        Parameters:
+            data (:class:`mxnet.ndarray.NDArray`): input data of shape (batch_size, vocab_size)
+        Returns:
+            (:class:`mxnet.ndarray.NDArray`): Encodings with shape (n_seeds, batch_size, n_latent)
+        """
+        mu = self._stacked_dense(self._encode(data), self.mu_weight.data(), self.mu_bias.data())
+        return self._batch_norm(mu, 'mu', 1e-4) if include_bn else mu
+
+    def _latent(self, enc):
+        S, B, K = enc.shape[0], enc.shape[1], self.n_latent
+        mu = self._stacked_dense(enc, self.mu_weight.data(), self.mu_bias.data())
+        lv = self._stacked_dense(enc, self.lv_weight.data(), self.lv_bias.data())
+        mu_bn = self._batch_norm(mu, 'mu', 1e-4)
+        lv_bn = self._batch_norm(lv, 'lv', 1e-3)
+        ## the copies are independent, so the distribution treats the stack as a batch of S*B rows
+        flat = [ x.reshape((S*B, K)) for x in (mu, mu_bn, lv, lv_bn) ]
+        z, KL = self.latent_distribution.sample_with_kl(mx.nd, *flat, S*B)
+        return mu, z.reshape((S, B, K)), KL.reshape((S, B))
+
+    def _coherence_terms(self, like):
+        if self.coherence_reg_penalty > 0.0:
+            E = self.embedding_size
+            emb, dec = self.emb_weight.data(), self.dec_weight.data()
+            terms = [ self.coherence_regularization(dec[s], emb[s*E:(s+1)*E]) for s in range(self.n_seeds) ]
+            c = mx.nd.concat(*[ t[0] for t in terms ], dim=0).expand_dims(1)
+            d = mx.nd.concat(*[ t[1] for t in terms ], dim=0).expand_dims(1)
+            return mx.nd.broadcast_like(c, like), mx.nd.broadcast_like(d, like)
+        else:
+            return mx.nd.zeros_like(like), mx.nd.zeros_like(like)
+
+    def predict(self, data):
+        """Predict labels for every copy given the input data (ignoring VAE reconstruction)
+
+        Parameters:
+            data (tensor): input data tensor
+        Returns:
+            output vector (tensor): unnormalized outputs over label values with shape (n_seeds, batch_size, n_labels)
+        """
+        return self._classify(self.encode_data(data))
+
+    def _classify(self, mu):
+        return self._stacked_dense(mx.nd.Dropout(mu, p=self.enc_dr*2.0), self.cls_weight.data(), self.cls_bias.data())
+
+    def forward(self, data):
+        mu, z, KL = self._latent(self._encode(data))
+        logits = mx.nd.broadcast_add(mx.nd.batch_dot(z, self.dec_weight.data(), transpose_b=True),
+                                     self.dec_bias.data().expand_dims(1))
+        y = mx.nd.softmax(logits, axis=2)
+        recon_loss = mx.nd.stack(*[ _reconstruction_loss(mx.nd, data, y[s]) for s in range(self.n_seeds) ])
+        coherence_loss, redundancy_loss = self._coherence_terms(recon_loss)
+        ii_loss = recon_loss + KL + coherence_loss + redundancy_loss
+        classifier_outputs = self._classify(mu) if self.has_classifier else None
+        return ii_loss, KL, recon_loss, coherence_loss, redundancy_loss, classifier_outputs
+
+    def unstack(self, s):
+        """Extract copy `s` of the stack as a separate model.
+
+        Parameters:
+            s (int): Index of the copy
+        Returns:
+            (:class:`BowVAEModel`): Model with the parameters of copy `s`
+        """
+        ld = self.latent_distribution
+        if isinstance(ld, LogisticGaussianDistribution):
+            dist = LogisticGaussianDistribution(self.n_latent, ctx=self.model_ctx, dr=self.post_sample_dr, alpha=ld.alpha)
+        else:
+            dist = GaussianDistribution(self.n_latent, ctx=self.model_ctx, dr=self.post_sample_dr)
+        model = BowVAEModel(self.enc_dim, self.embedding_size, n_encoding_layers=self.num_enc_layers,
+                            enc_dr=self.enc_dr, fixed_embedding=self.fixed_embedding,
+                            classifier_dropout=self.classifier_dropout, n_labels=self.n_labels, gamma=self.gamma,
+                            multilabel=self.multilabel, vocabulary=self.vocabulary, latent_distribution=dist,
+                            coherence_reg_penalty=self.coherence_reg_penalty,
+                            redundancy_reg_penalty=self.redundancy_reg_penalty, n_covars=0, ctx=self.model_ctx)
+        E, K = self.embedding_size, self.n_latent
+        model.embedding.weight.set_data(self.emb_weight.data()[s*E:(s+1)*E])
+        model.embedding.bias.set_data(self.emb_bias.data()[s*E:(s+1)*E])
+        enc_layers = [ b for b in model.encoder if isinstance(b, gluon.nn.Dense) ]
+        for layer, w, b in zip(enc_layers, self.enc_weights, self.enc_biases):
+            layer.weight.set_data(w.data()[s])
+            layer.bias.set_data(b.data()[s])
+        for v in ('mu', 'lv'):
+            getattr(dist, v + '_encoder').weight.set_data(getattr(self, v + '_weight').data()[s])
+            getattr(dist, v + '_encoder').bias.set_data(getattr(self, v + '_bias').data()[s])
+            bn = getattr(dist, v + '_bn')
+            for n in ('gamma', 'beta', 'running_mean', 'running_var'):
+                getattr(bn, n).set_data(getattr(self, '{}_bn_{}'.format(v, n)).data()[s*K:(s+1)*K])
+        model.decoder.weight.set_data(self.dec_weight.data()[s])
+        model.decoder.bias.set_data(self.dec_bias.data()[s])
+        model.decoder.bias.grad_req = self.dec_bias.grad_req
+        if self.has_classifier:
+            model.classifier.weight.set_data(self.cls_weight.data()[s])
+            model.classifier.bias.set_data(self.cls_bias.data()[s])
+        return model
+
+
 class CovariateBowVAEModel(BowVAEModel):
     """Bag-of-words topic model with labels used as co-variates
     """
@@ -389,6 +639,20 @@ class CovariateBowVAEModel(BowVAEModel):
             output.backward(retain_graph=True)
             jacobian[i] += z.grad.sum(axis=0)
         return jacobian
+
+
+    def validation_forward(self, data, covars):
+        """Forward pass for validation giving the loss terms needed for perplexity together with the encoding
+        (see :meth:`BowVAEModel.validation_forward`). Covariate models have no classifier.
+        """
+        if self.n_covars > 0:
+            covars = mx.nd.one_hot(covars, self.n_covars)
+        enc_out = self.encoder(mx.nd.concat(self.embedding(data), covars))
+        z, KL = self.latent_distribution(enc_out, data.shape[0])
+        y = mx.nd.softmax(self.decoder(z) + self.cov_decoder(z, covars), axis=1)
+        recon_loss = _reconstruction_loss(mx.nd, data, y)
+        encoding = self.latent_distribution.get_mu_encoding(enc_out, include_bn=True)
+        return KL, recon_loss, encoding, None
         
 
     def hybrid_forward(self, F, data, covars):
@@ -640,6 +904,28 @@ class MetricSeqBowVED(BaseSeqBowVED):
         redundancy_loss = self.get_redundancy_penalty()
         return elbo, rec_loss, KL_loss, redundancy_loss, z_mu1, z_mu2
 
+    def forward_with_cached_b(self, in1, tt1, vl1, bow1, in2, tt2, vl2, bow2, cached_enc2=None):
+        """Forward pass in which only a subset of the B side (`in2`, `tt2`, `vl2`, `bow2`) is run through BERT;
+        the pooled encodings of the remaining B items are given by `cached_enc2` and receive no gradient through BERT.
+        The mean ELBO terms of the B subset are added to those of each A item.
+
+        Returns:
+            (tuple): Tuple of elbo, rec_loss, KL_loss, redundancy_loss, z_mu1, z_mu2 (the B subset followed by
+            the cached items) and the pooled encodings of the B subset (e.g. to refresh the cache)
+        """
+        _, enc1 = self.bert(in1, tt1, vl1)
+        _, enc2 = self.bert(in2, tt2, vl2)
+        elbo1, rec_loss1, KL_loss1 = self._get_elbo(bow1, enc1)
+        elbo2, rec_loss2, KL_loss2 = self._get_elbo(bow2, enc2)
+        elbo = elbo1 + elbo2.mean()
+        rec_loss = rec_loss1 + rec_loss2.mean()
+        KL_loss = KL_loss1 + KL_loss2.mean()
+        z_mu1 = self.latent_dist.get_mu_encoding(enc1)
+        all_enc2 = mx.nd.concat(enc2, cached_enc2, dim=0) if cached_enc2 is not None else enc2
+        z_mu2 = self.latent_dist.get_mu_encoding(all_enc2)
+        redundancy_loss = self.get_redundancy_penalty()
+        return elbo, rec_loss, KL_loss, redundancy_loss, z_mu1, z_mu2, enc2
+
 
 class GeneralizedSDMLLoss(Loss):
     r"""Calculates Batchwise Smoothed Deep Metric Learning (SDML) Loss given two input tensors and a smoothing weight
@@ -662,7 +948,8 @@ class GeneralizedSDMLLoss(Loss):
 
     Inputs:
         - **x1**: Minibatch of data points with shape (batch_size, vector_dim)
-        - **x2**: Minibatch of data points with shape (batch_size, vector_dim)
+        - **x2**: Minibatch of data points with shape (batch_size_2, vector_dim); batch_size_2 may differ from
+          batch_size (e.g. with token-budget batching of x1)
           Each item in x1 is a positive sample for the items with the same label in x2
           That is, x1[0] and x2[0] form a positive pair iff label(x1[0]) = label(x2[0])
           All data points in different rows should be decorrelated
@@ -683,12 +970,13 @@ class GeneralizedSDMLLoss(Loss):
         in the two batches in input.
         """
 
-        # extracting sizes expecting [batch_size, dim]
-        assert x1.shape == x2.shape
+        # extracting sizes expecting [batch_size, dim] and [batch_size_2, dim]
+        assert x1.shape[1] == x2.shape[1]
         batch_size, dim = x1.shape
-        # expanding both tensor form [batch_size, dim] to [batch_size, batch_size, dim]
-        x1_ = x1.expand_dims(1).broadcast_to([batch_size, batch_size, dim])
-        x2_ = x2.expand_dims(0).broadcast_to([batch_size, batch_size, dim])
+        batch_size_2 = x2.shape[0]
+        # expanding both tensor form [batch_size, dim] to [batch_size, batch_size_2, dim]
+        x1_ = x1.expand_dims(1).broadcast_to([batch_size, batch_size_2, dim])
+        x2_ = x2.expand_dims(0).broadcast_to([batch_size, batch_size_2, dim])
         # pointwise squared differences
         squared_diffs = (x1_ - x2_)**2
         # sum of squared differences distance
@@ -710,14 +998,15 @@ class GeneralizedSDMLLoss(Loss):
         l1 = l1.squeeze()
         l2 = l2.squeeze()
         batch_size = l1.shape[0]
-        l1_x = F.broadcast_to(F.expand_dims(l1, 1), (batch_size, batch_size))
-        l2_x = F.broadcast_to(F.expand_dims(l2, 0), (batch_size, batch_size))
+        batch_size_2 = l2.shape[0]
+        l1_x = F.broadcast_to(F.expand_dims(l1, 1), (batch_size, batch_size_2))
+        l2_x = F.broadcast_to(F.expand_dims(l2, 0), (batch_size, batch_size_2))
         ll = F.equal(l1_x, l2_x)
-        labels = ll * (1 - self.smoothing_parameter) + (1 - ll) * self.smoothing_parameter / (batch_size - 1)
+        labels = ll * (1 - self.smoothing_parameter) + (1 - ll) * self.smoothing_parameter / max(batch_size_2 - 1, 1)
         ## now normalize rows to sum to 1.0
-        labels = labels / F.broadcast_to(F.sum(labels, axis=1, keepdims=True), (batch_size, batch_size))
+        labels = labels / F.broadcast_to(F.sum(labels, axis=1, keepdims=True), (batch_size, batch_size_2))
         if self.x2_downweight_idx >= 0:
-            down_wt = len(mx.np.where(l2.as_np_ndarray != self.x2_downweight_idx)[0]) / batch_size
+            down_wt = len(mx.np.where(l2.as_np_ndarray != self.x2_downweight_idx)[0]) / batch_size_2
         else:
             down_wt = 1.0
         return labels, down_wt
@@ -728,15 +1017,83 @@ class GeneralizedSDMLLoss(Loss):
         the function computes the kl divergence between the negative distances
         and the smoothed label matrix.
         """
-        batch_size = x1.shape[0]
+        batch_size_2 = x2.shape[0]
         labels, wt = self._compute_labels(F, l1, l2)
         distances = self._compute_distances(x1, x2)
         log_probabilities = F.log_softmax(-distances, axis=1)
-        # multiply by the batch size to obtain the correct loss (gluon kl_loss averages instead of sum)
-        return self.kl_loss(log_probabilities, labels.as_in_context(distances.context)) * batch_size * wt
+        # multiply by the number of columns to obtain the correct loss (gluon kl_loss averages instead of sum)
+        return self.kl_loss(log_probabilities, labels.as_in_context(distances.context)) * batch_size_2 * wt
 
 
     def hybrid_forward(self, F, x1, l1, x2, l2):
         return self._loss(F, x1, l1, x2, l2)    
 
 
+class ScalableSDMLLoss(GeneralizedSDMLLoss):
+    r"""Smoothed Deep Metric Learning (SDML) Loss (see :class:`GeneralizedSDMLLoss`) with memory use that does not
+    grow with the encoding dimension and an optional memory bank of extra candidates.
+
+    Squared distances are computed with the identity :math:`\|a-b\|^2 = \|a\|^2 + \|b\|^2 - 2 a \cdot b`, i.e. a
+    single matrix product, rather than by materializing a (batch_size, batch_size_2, vector_dim) tensor.
+    The memory bank is a first-in-first-out queue of the most recent `x2` encodings and labels; these are
+    appended to `x2` as constants (no gradient), so every step sees up to `memory_size` additional negatives
+    (and positives for matching labels) at the cost of a (batch_size, batch_size_2 + memory_size) distance matrix.
+    The loss must be used imperatively (not hybridized) when the memory bank is enabled.
+
+    Parameters
+    ----------
+    smoothing_parameter : float
+        Probability mass to be distributed over the minibatch and memory bank. Must be < 1.0.
+    weight : float or None
+        Global scalar weight for loss.
+    batch_axis : int, default 0
+        The axis that represents mini-batch.
+    memory_size : int, default 0
+        Number of recent `x2` encodings kept as extra candidates (0 for none). The bank is only updated
+        by calls made while recording gradients (i.e. during training).
+    """
+
+    def __init__(self, smoothing_parameter=0.3, weight=1., batch_axis=0, x2_downweight_idx=-1, memory_size=0, **kwargs):
+        super(ScalableSDMLLoss, self).__init__(smoothing_parameter, weight, batch_axis, x2_downweight_idx, **kwargs)
+        self.memory_size = memory_size
+        self.reset_memory()
+
+    def reset_memory(self):
+        """Empty the memory bank (e.g. when encodings from earlier training are no longer representative)."""
+        self._memory_x = None
+        self._memory_l = None
+
+    def _compute_distances(self, x1, x2):
+        """
+        Squared euclidean distance between every vector in the two input batches, computed with one matrix product.
+        """
+        assert x1.shape[1] == x2.shape[1]
+        sq_1 = (x1 ** 2).sum(axis=1, keepdims=True)
+        sq_2 = (x2 ** 2).sum(axis=1, keepdims=True).transpose()
+        cross = mx.nd.dot(x1, x2, transpose_b=True)
+        ## rounding can give small negative values for (near) identical vectors
+        return mx.nd.relu(mx.nd.broadcast_add(mx.nd.broadcast_add(cross * -2.0, sq_1), sq_2))
+
+    def _update_memory(self, x2, l2):
+        x2 = x2.detach()
+        if self._memory_x is None or self._memory_x.shape[1] != x2.shape[1]:
+            self._memory_x, self._memory_l = x2[:self.memory_size], l2[:self.memory_size]
+        else:
+            ## newest entries first; the oldest are dropped beyond memory_size
+            self._memory_x = mx.nd.concat(x2, self._memory_x, dim=0)[:self.memory_size]
+            self._memory_l = mx.nd.concat(l2, self._memory_l, dim=0)[:self.memory_size]
+
+    def _loss(self, F, x1, l1, x2, l2):
+        l2 = l2.reshape((-1,))
+        if self.memory_size > 0 and self._memory_x is not None:
+            x2_all = F.concat(x2, self._memory_x.as_in_context(x2.context), dim=0)
+            l2_all = F.concat(l2, self._memory_l.astype(l2.dtype).as_in_context(l2.context), dim=0)
+        else:
+            x2_all, l2_all = x2, l2
+        loss = super(ScalableSDMLLoss, self)._loss(F, x1, l1, x2_all, l2_all)
+        if self.memory_size > 0 and mx.autograd.is_recording():
+            with mx.autograd.pause():
+                self._update_memory(x2, l2)
+        return loss
+
+
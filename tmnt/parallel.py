@@ -0,0 +1,234 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Single-machine data-parallel training of bag-of-words models across multiple worker processes.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import subprocess
+import contextlib
+import multiprocessing
+import queue as queue_mod
+from concurrent.futures import ProcessPoolExecutor
+
+__all__ = ['launch_local', 'fit_bow_data_parallel', 'run_final_evals_parallel']
+
+
+@contextlib.contextmanager
+def _environment(env):
+    """Temporarily set environment variables (e.g. while starting processes that should inherit them)."""
+    saved_env = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for k, v in saved_env.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+def _run_worker(worker_fn, args, env, queue):
+    os.environ.update(env)
+    queue.put(worker_fn(*args))
+
+
+def _check_processes(workers, ps_procs):
+    """Raise an exception if a worker, scheduler or server process has exited with a non-zero code."""
+    for w in workers:
+        if w.exitcode is not None and w.exitcode != 0:
+            raise Exception("Data-parallel worker process exited with code {}".format(w.exitcode))
+    for p in ps_procs:
+        if p.poll() is not None and p.returncode != 0:
+            raise Exception("kvstore process exited with code {}".format(p.returncode))
+
+
+def launch_local(worker_fn, num_workers, args=(), num_servers=1, port=9092, threads_per_worker=None, ps_timeout=30):
+    """Run `worker_fn(*args)` in `num_workers` local processes connected through an MXNet distributed kvstore.
+    A kvstore scheduler and `num_servers` server processes are started alongside the workers; workers
+    create the kvstore with `mx.kv.create('dist_sync')` (or another 'dist_*' type). Worker processes are
+    started with 'spawn' so MXNet is initialized after the DMLC environment is set. The scheduler and servers
+    are run with ``python -m tmnt.kvstore_server``. An exception is raised if any worker, scheduler or
+    server process exits with a non-zero code.
+
+    Parameters:
+        worker_fn: Picklable (module-level) function run in each worker
+        num_workers: Number of worker processes
+        args: Arguments passed to `worker_fn`
+        num_servers: Number of kvstore server processes
+        port: Port for the kvstore scheduler
+        threads_per_worker: Number of OpenMP threads per worker (default divides available cores evenly)
+        ps_timeout: Seconds to wait for the scheduler and servers to exit after the workers finish
+
+    Returns:
+        List of the values returned by `worker_fn` in each worker (in order of completion)
+    """
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+    dmlc_env = {
+        'DMLC_PS_ROOT_URI': '127.0.0.1',
+        'DMLC_PS_ROOT_PORT': str(port),
+        'DMLC_NUM_SERVER': str(num_servers),
+        'DMLC_NUM_WORKER': str(num_workers),
+    }
+    def _start_ps(role):
+        return subprocess.Popen([sys.executable, '-m', 'tmnt.kvstore_server'],
+                                env={**os.environ, **dmlc_env, 'DMLC_ROLE': role, 'OMP_NUM_THREADS': '1'})
+    ps_procs = [_start_ps('scheduler')] + [_start_ps('server') for _ in range(num_servers)]
+    mp_ctx = multiprocessing.get_context('spawn')
+    queue = mp_ctx.Queue()
+    worker_env = {**dmlc_env, 'DMLC_ROLE': 'worker', 'OMP_NUM_THREADS': str(threads_per_worker)}
+    workers = [ mp_ctx.Process(target=_run_worker, args=(worker_fn, args, worker_env, queue)) for _ in range(num_workers) ]
+    ## the environment must be in place before the spawned interpreter imports mxnet
+    with _environment(worker_env):
+        for w in workers:
+            w.start()
+    results = []
+    try:
+        while len(results) < num_workers:
+            try:
+                results.append(queue.get(timeout=1.0))
+            except queue_mod.Empty:
+                _check_processes(workers, ps_procs)
+        for w in workers:
+            w.join()
+        for p in ps_procs:
+            try:
+                p.wait(timeout=ps_timeout)
+            except subprocess.TimeoutExpired:
+                raise Exception("kvstore process did not exit within {} seconds of the workers finishing".format(ps_timeout))
+        _check_processes(workers, ps_procs)
+    finally:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        for p in ps_procs:
+            if p.poll() is None:
+                p.kill()
+    return results
+
+
+def _bow_data_parallel_worker(config, vocabulary, X, y, val_X, val_y, n_covars, model_dir, seed, kvstore, local_sgd_interval):
+    ## imports are local so that mxnet is first imported in the worker process
+    from tmnt.estimator import BowEstimator, CovariateBowEstimator
+    from tmnt.data_loading import file_to_data
+    from tmnt.utils.random import seed_rng
+    from tmnt.utils.precision import init_reduced_precision
+    import autogluon.core as ag
+    init_reduced_precision(config.get('dtype', 'float32'))
+    if isinstance(X, str):
+        X, y, _, _ = file_to_data(X, len(vocabulary))
+    if isinstance(val_X, str):
+        val_X, val_y, _, _ = file_to_data(val_X, len(vocabulary))
+    seed_rng(seed) ## identical seeds give identical initial parameters on every worker
+    config = ag.space.Dict(**config)
+    if n_covars > 0:
+        estimator = CovariateBowEstimator.from_config(n_covars, config, vocabulary)
+    else:
+        estimator = BowEstimator.from_config(config, vocabulary, n_labels=config.get('n_labels', 0))
+    estimator.kvstore = kvstore
+    estimator.local_sgd_interval = local_sgd_interval
+    ts = time.time()
+    obj, v_res = estimator.fit_with_validation(X, y, val_X, val_y)
+    train_secs = time.time() - ts
+    rank = estimator._get_kvstore().rank
+    if rank == 0 and model_dir is not None:
+        estimator.write_model(model_dir)
+    return rank, obj, v_res, train_secs, estimator.convergence_trace
+
+
+def fit_bow_data_parallel(config, vocabulary, X, y=None, val_X=None, val_y=None, num_workers=2, n_covars=0,
+                          model_dir=None, seed=1234, kvstore='dist_sync', local_sgd_interval=0, **launch_kwargs):
+    """Fit a bag-of-words model (:class:`tmnt.estimator.BowEstimator`, or :class:`tmnt.estimator.CovariateBowEstimator`
+    when `n_covars` > 0) with data-parallel training over `num_workers` local processes. Gradients are synchronized
+    every batch unless `local_sgd_interval` > 0, in which case workers train independently on their shards and
+    average parameters every `local_sgd_interval` batches (and at the end of each epoch).
+
+    Parameters:
+        config: Model configuration (dictionary)
+        vocabulary: GluonNLP vocabulary
+        X: Training data as a sparse matrix or path to a file in sparse vector format (loaded by each worker)
+        y: Training labels/covariates (ignored if X is a path)
+        val_X: Validation data as a sparse matrix or path to a file in sparse vector format
+        val_y: Validation labels/covariates (ignored if val_X is a path)
+        num_workers: Number of worker processes
+        n_covars: Number of covariates (uses a covariate model if > 0)
+        model_dir: If provided, the first worker writes the trained model to this directory
+        seed: Random seed (shared by all workers)
+        kvstore: Distributed kvstore type
+        local_sgd_interval: Number of batches between parameter averaging steps; 0 synchronizes gradients every batch
+        launch_kwargs: Additional keyword arguments to :func:`launch_local`
+
+    Returns:
+        (tuple): Tuple containing:
+            - obj (float): objective on validation data
+            - v_res (dict): validation results
+            - train_secs (float): wall-clock training time of the slowest worker
+            - trace (list): convergence trace of the first worker; one dictionary per epoch with the
+              wall-clock seconds since the start of training ('secs'), 'epoch', 'batches', mean training
+              'elbo' and, for validated epochs, the validation 'objective'
+    """
+    results = launch_local(_bow_data_parallel_worker, num_workers,
+                           args=(dict(config), vocabulary, X, y, val_X, val_y, n_covars, model_dir, seed, kvstore,
+                                 local_sgd_interval),
+                           **launch_kwargs)
+    _, obj, v_res, _, trace = next(r for r in results if r[0] == 0)
+    train_secs = max(r[3] for r in results)
+    mode = 'local SGD (averaging every {} batches)'.format(local_sgd_interval) if local_sgd_interval > 0 else 'synchronous SGD'
+    logging.info("Data-parallel training with {} workers and {} finished in {:.1f} seconds"
+                 .format(num_workers, mode, train_secs))
+    for point in trace:
+        logging.info("  {:8.1f}s epoch {:>4} batches {:>7} elbo = {} objective = {}"
+                     .format(point['secs'], point['epoch'], point['batches'], point['elbo'], point.get('objective')))
+    if model_dir is not None:
+        with open(os.path.join(model_dir, 'convergence_trace.json'), 'w') as fp:
+            json.dump(trace, fp, indent=2)
+    return obj, v_res, train_secs, trace
+
+
+def _final_eval_worker(trainer, config, seed, model_dir):
+    from tmnt.utils.random import seed_rng
+    from tmnt.utils.precision import init_reduced_precision
+    from autogluon.core.scheduler.reporter import FakeReporter
+    init_reduced_precision(config.get('dtype', 'float32'))
+    seed_rng(seed)
+    model, obj, v_res, vectorizer = trainer.train_model(config, FakeReporter())
+    os.makedirs(model_dir, exist_ok=True)
+    trainer.model_out_dir = model_dir
+    trainer.write_model(model)
+    return obj, v_res, vectorizer
+
+
+def run_final_evals_parallel(trainer, config, seeds, work_dir, num_workers, threads_per_worker=None):
+    """Fit one model per seed with `trainer.train_model(config, reporter)` in `num_workers` local worker processes.
+    Each fitted model is written with `trainer.write_model` to a sub-directory of `work_dir`; models are not
+    transferred back to this process. Worker processes are started with 'spawn' and an OpenMP thread budget.
+
+    Parameters:
+        trainer: Picklable trainer (:class:`tmnt.trainer.TopicTrainer`); data sources should be file paths or
+            memory-mapped (:class:`tmnt.data_loading.MemmapCSRData`) so they are not copied to each worker
+        config: Model configuration
+        seeds: Random seed for each fit
+        work_dir: Directory for the fitted models
+        num_workers: Number of worker processes
+        threads_per_worker: Number of OpenMP threads per worker (default divides available cores evenly)
+
+    Returns:
+        List with a tuple (obj, v_res, vectorizer, model_dir) for each seed, in the order of `seeds`
+    """
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+    model_dirs = [ os.path.join(work_dir, 'seed_{}'.format(seed)) for seed in seeds ]
+    executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        ## worker processes are started on submission and inherit the thread setting
+        with _environment({'OMP_NUM_THREADS': str(threads_per_worker)}):
+            futures = [ executor.submit(_final_eval_worker, trainer, config, seed, model_dir)
+                        for seed, model_dir in zip(seeds, model_dirs) ]
+        results = [ f.result() for f in futures ]
+    finally:
+        executor.shutdown(wait=True)
+    return [ r + (model_dir,) for r, model_dir in zip(results, model_dirs) ]
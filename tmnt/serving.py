@@ -0,0 +1,362 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Local HTTP serving of a trained bag-of-words model. Concurrent requests are coalesced into micro-batches
+so that the model is run on many texts at once rather than once per request.
+"""
+
+import json
+import time
+import asyncio
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['LatencyHistogram', 'MicroBatcher', 'InferenceServer', 'run_load']
+
+## upper bounds (milliseconds) of the latency histogram buckets
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies (milliseconds) over fixed buckets.
+
+    Parameters:
+        buckets: Increasing bucket upper bounds in milliseconds; larger values fall in a final overflow bucket
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q):
+        """Upper bound of the bucket containing the `q`-th quantile (the maximum for the overflow bucket)."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c > 0:
+                return float(self.buckets[i]) if i < len(self.buckets) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count > 0 else 0.0,
+                'p50_ms': self.quantile(0.5), 'p95_ms': self.quantile(0.95), 'p99_ms': self.quantile(0.99),
+                'max_ms': self.max_ms,
+                'buckets': [ {'le_ms': b, 'count': c} for b, c in zip(list(self.buckets) + ['inf'], self.counts) ]}
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent requests, each a list of items, into batches for a batch function.
+
+    A batch is started with the oldest waiting request and closed when it holds `max_batch_size` items or
+    `max_latency_ms` have passed since it was started. Requests that arrive while a batch is running queue up
+    for the next one. The batch function runs in `executor` so the event loop keeps accepting requests.
+
+    Parameters:
+        batch_fn: Function taking a list of items and returning a list of results (one per item)
+        max_batch_size: Maximum number of items per batch (a single larger request is run as one batch)
+        max_latency_ms: Maximum time to wait for more requests before running a batch
+        executor: Executor for `batch_fn` (default a single thread)
+    """
+    def __init__(self, batch_fn, max_batch_size=256, max_latency_ms=5.0, executor=None):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency_ms = max_latency_ms
+        self.executor = executor or ThreadPoolExecutor(1)
+        self.latency = LatencyHistogram()
+        self.batch_sizes = []
+        self.max_queue_depth = 0
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        """Start batching on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    @property
+    def queue_depth(self):
+        """Number of requests waiting for a batch."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, items):
+        """Queue a request and wait for its results (a list with one result per item)."""
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((list(items), future, time.perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [ await self._queue.get() ]
+            n_items = len(batch[0][0])
+            deadline = loop.time() + self.max_latency_ms / 1000.0
+            while n_items < self.max_batch_size:
+                if self._queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    request = self._queue.get_nowait()
+                batch.append(request)
+                n_items += len(request[0])
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch):
+        items = [ item for request, _, _ in batch for item in request ]
+        self.batch_sizes.append(len(items))
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(self.executor, self.batch_fn, items)
+            if len(results) != len(items):
+                raise Exception("Batch function returned {} results for {} items".format(len(results), len(items)))
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        i = 0
+        now = time.perf_counter()
+        for request, future, start in batch:
+            if not future.done():
+                future.set_result(results[i:i+len(request)])
+            i += len(request)
+            self.latency.observe((now - start) * 1000.0)
+
+    def stats(self):
+        sizes = self.batch_sizes
+        return {'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth,
+                'batches': len(sizes), 'mean_batch_size': float(np.mean(sizes)) if len(sizes) > 0 else 0.0,
+                'max_batch_size': max(sizes) if len(sizes) > 0 else 0,
+                'latency': self.latency.snapshot()}
+
+
+def _to_json(x):
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+def _encode_batch_fn(inferencer):
+    def encode(texts):
+        return [ _to_json(e) for e in inferencer.encode_texts(texts) ]
+    return encode
+
+
+def _predict_batch_fn(inferencer, pred_threshold=0.5):
+    inv_map = { i: label for label, i in inferencer.vectorizer.label_map.items() }
+    def predict(texts):
+        _, encodings, posteriors = inferencer.predict_text(texts, pred_threshold=pred_threshold)
+        results = []
+        for enc, post in zip(encodings, posteriors):
+            if inferencer.model.multilabel:
+                label = [ inv_map[i] for i in np.where(post > pred_threshold)[0] ]
+            else:
+                label = inv_map[int(np.argmax(post))]
+            results.append({'label': label, 'encoding': _to_json(enc), 'posteriors': _to_json(post)})
+        return results
+    return predict
+
+
+class InferenceServer(object):
+    """Minimal asyncio HTTP/1.1 (keep-alive) server with a micro-batcher for each endpoint.
+
+    `POST <path>` with a JSON body `{"texts": [...]}` returns `{"results": [...]}` with one result per text;
+    `GET /stats` returns the queue depth, batch sizes and latency histogram of each endpoint.
+
+    Parameters:
+        handlers: Dictionary of endpoint path to batch function (a list of texts to a list of JSON-serializable results)
+        host: Host address to listen on
+        port: Port to listen on (0 picks a free port, available as `port` after :meth:`start`)
+        max_batch_size: Maximum number of texts per batch
+        max_latency_ms: Maximum time a request waits for others to join its batch
+    """
+    def __init__(self, handlers, host='127.0.0.1', port=8080, max_batch_size=256, max_latency_ms=5.0):
+        self.host = host
+        self.port = port
+        ## a single thread runs all batches so that the model is never used concurrently
+        executor = ThreadPoolExecutor(1)
+        self.batchers = { path: MicroBatcher(fn, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms,
+                                             executor=executor)
+                          for path, fn in handlers.items() }
+        self._server = None
+
+    @classmethod
+    def from_inferencer(cls, inferencer, pred_threshold=0.5, **kwargs):
+        """Server with '/encode' (:meth:`encode_texts`) and, for models with a classifier, '/predict'
+        (:meth:`predict_text`) endpoints for a :class:`tmnt.inference.BowVAEInferencer`."""
+        handlers = {'/encode': _encode_batch_fn(inferencer)}
+        if getattr(inferencer.model, 'has_classifier', False):
+            handlers['/predict'] = _predict_batch_fn(inferencer, pred_threshold)
+        return cls(handlers, **kwargs)
+
+    @classmethod
+    def from_saved(cls, model_dir, **kwargs):
+        """Load a saved bag-of-words model once and serve it."""
+        from tmnt.inference import BowVAEInferencer
+        return cls.from_inferencer(BowVAEInferencer.from_saved(model_dir=model_dir), **kwargs)
+
+    async def start(self):
+        for batcher in self.batchers.values():
+            batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info("Serving {} on http://{}:{}".format(sorted(self.batchers), self.host, self.port))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await self.stop()
+
+    def stats(self):
+        return { path: batcher.stats() for path, batcher in self.batchers.items() }
+
+    async def _dispatch(self, method, path, body):
+        if method == 'GET' and path == '/stats':
+            return 200, self.stats()
+        if method != 'POST' or path not in self.batchers:
+            return 404, {'error': 'Unknown endpoint {} {}'.format(method, path)}
+        try:
+            texts = json.loads(body.decode('utf-8'))['texts']
+            if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                raise ValueError("'texts' must be a list of strings")
+        except Exception as e:
+            return 400, {'error': 'Invalid request: {}'.format(e)}
+        try:
+            results = await self.batchers[path].submit(texts)
+        except Exception as e:
+            logging.error("Batch for {} failed: {}".format(path, e))
+            return 500, {'error': str(e)}
+        return 200, {'results': results}
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) < 3:
+                    break
+                method, path, version = parts[0], parts[1], parts[2]
+                headers = await _read_headers(reader)
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self._dispatch(method, path, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                _write_message(writer, 'HTTP/1.1 {} {}'.format(status, _REASONS[status]), payload,
+                               {'Connection': 'keep-alive' if keep_alive else 'close'})
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        k, _, v = line.decode('latin-1').partition(':')
+        headers[k.strip().lower()] = v.strip()
+
+
+def _write_message(writer, start_line, payload, headers):
+    data = json.dumps(payload).encode('utf-8')
+    head = [start_line, 'Content-Type: application/json', 'Content-Length: {}'.format(len(data))]
+    head += [ '{}: {}'.format(k, v) for k, v in headers.items() ]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+
+
+async def _load_client(host, port, path, payloads, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for payload in payloads:
+            start = time.perf_counter()
+            _write_message(writer, 'POST {} HTTP/1.1'.format(path), payload, {'Host': host})
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            headers = await _read_headers(reader)
+            await reader.readexactly(int(headers.get('content-length', 0)))
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_load(host, port, texts, path='/encode', concurrency=16, n_requests=256, texts_per_request=1):
+    """Loopback load generator: send `n_requests` requests from `concurrency` concurrent keep-alive connections.
+
+    Parameters:
+        host: Server host
+        port: Server port
+        texts: Texts to send (cycled over requests)
+        path: Endpoint path
+        concurrency: Number of concurrent connections (each sends its requests one after another)
+        n_requests: Total number of requests
+        texts_per_request: Number of texts in each request
+
+    Returns:
+        (dict): Number of requests and errors, elapsed seconds, requests and texts per second, and client-side
+        latency statistics in milliseconds
+    """
+    payloads = [ {'texts': [ texts[(i * texts_per_request + j) % len(texts)] for j in range(texts_per_request) ]}
+                 for i in range(n_requests) ]
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[ _load_client(host, port, path, payloads[c::concurrency], latencies, errors)
+                            for c in range(concurrency) ])
+    secs = time.perf_counter() - start
+    lat = np.array(latencies) if len(latencies) > 0 else np.zeros(1)
+    return {'requests': len(latencies), 'errors': len(errors), 'seconds': secs,
+            'requests_per_sec': len(latencies) / secs, 'texts_per_sec': len(latencies) * texts_per_request / secs,
+            'latency_ms': {'mean': float(lat.mean()), 'p50': float(np.percentile(lat, 50)),
+                           'p95': float(np.percentile(lat, 95)), 'p99': float(np.percentile(lat, 99)),
+                           'max': float(lat.max())}}
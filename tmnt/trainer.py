@@ -4,6 +4,7 @@
 Model trainers that handle data prep, pre-trained vocabularies and enable model selection.
 """
 
+import abc
 import json
 import os
 import logging
@@ -13,6 +14,7 @@ import gluonnlp as nlp
 import datetime
 import time
 import copy
+import tempfile
 import statistics
 import autogluon.core as ag
 
@@ -20,10 +22,13 @@ from autogluon.core.scheduler.reporter import FakeReporter
 from pathlib import Path
 from tmnt.utils import log_utils
 from tmnt.utils.random import seed_rng
+from tmnt.utils.precision import init_reduced_precision
 from tmnt.utils.log_utils import logging_config
-from tmnt.data_loading import load_vocab, file_to_data
+from tmnt.data_loading import load_vocab, file_to_data, MemmapCSRData
 from tmnt.bert_handling import get_bert_datasets, JsonlDataset
-from tmnt.estimator import BowEstimator, CovariateBowEstimator, SeqBowEstimator
+from tmnt.estimator import BowEstimator, CovariateBowEstimator, SeqBowEstimator, StackedBowEstimator
+from tmnt.parallel import fit_bow_data_parallel, run_final_evals_parallel
+from tmnt.tuning import ThroughputTuner, write_tuning_report
 from tmnt.preprocess.vectorizer import TMNTVectorizer
 from mxnet.gluon.data import ArrayDataset
 
@@ -58,6 +63,8 @@ class BaseTrainer(object):
             X, y, _, _ = file_to_data(data_source, len(self.vocabulary))
         elif isinstance(data_source, tuple):
             X, y = data_source
+        elif isinstance(data_source, MemmapCSRData):
+            X, y = data_source.load()
         else:
             X, y = data_source, None
         return X, y
@@ -101,15 +108,18 @@ class BaseTrainer(object):
         raise NotImplementedError()
 
 
-class TopicTrainer(BaseTrainer):
+class TopicTrainer(BaseTrainer, metaclass=abc.ABCMeta):
     """
         vocabulary (`gluonnlp.Vocab`): Gluon NLP vocabulary object representing the bag-of-words used for the dataset
+        parallel_final_evals (int): Number of worker processes for fitting the final evaluation models
+            of `train_with_single_config` in parallel (0 or 1 fits them one after another)
     """
 
-    def __init__(self, vocabulary, *args, **kwargs):
+    def __init__(self, vocabulary, *args, parallel_final_evals=0, **kwargs):
         super().__init__(*args, **kwargs)
         self.vocabulary   = vocabulary
         self.vectorizer   = None
+        self.parallel_final_evals = parallel_final_evals
         
     
     def _initialize_vocabulary(self, embedding_source, set_vocab=True):
@@ -172,7 +182,6 @@ class TopicTrainer(BaseTrainer):
                 - model (:class:`tmnt.modeling.BowVAEModel`): VAE Model instance with trained/fit parameters.
                 - obj (float): objective value of the objective function with the best model.
        """
-        rng_seed = self.rng_seed
         best_obj = -1000000000.0
         best_model = None
         best_vres = None
@@ -182,11 +191,7 @@ class TopicTrainer(BaseTrainer):
             logging.info("Training with config: {}".format(config))
             npmis, perplexities, redundancies, objectives = [],[],[],[]
             ntimes = int(num_evals)
-            for i in range(ntimes):
-                seed_rng(rng_seed) # update RNG
-                logging.info("Setting rng seed to {}".format(rng_seed))
-                rng_seed += 1
-                model, obj, v_res, vectorizer = self.train_model(config, FakeReporter()) 
+            for model, obj, v_res, vectorizer in self._run_final_evals(config, ntimes):
                 npmis.append(v_res['npmi'])
                 perplexities.append(v_res['ppl'])
                 redundancies.append(v_res['redundancy'])
@@ -215,6 +220,47 @@ class TopicTrainer(BaseTrainer):
             return best_model, best_obj, best_vres
         else:
             return self.train_model(config, FakeReporter())
+
+    def _run_final_evals(self, config, num_evals):
+        """Fit `num_evals` models with configuration `config`, one after another, each with a different RNG seed.
+
+        Returns:
+            List of (model, obj, v_res, vectorizer) tuples as returned by `train_model`, one per model
+        """
+        seeds = [ self.rng_seed + i for i in range(num_evals) ]
+        if self.parallel_final_evals > 1 and num_evals > 1 and not self.use_gpu:
+            return self._run_final_evals_parallel(config, seeds)
+        results = []
+        for rng_seed in seeds:
+            seed_rng(rng_seed) # update RNG
+            logging.info("Setting rng seed to {}".format(rng_seed))
+            results.append(self.train_model(config, FakeReporter()))
+        return results
+
+    def _run_final_evals_parallel(self, config, seeds):
+        num_workers = min(self.parallel_final_evals, len(seeds))
+        logging.info("Fitting {} models with rng seeds {} in {} worker processes".format(len(seeds), seeds, num_workers))
+        with tempfile.TemporaryDirectory(prefix='tmnt_final_evals_') as work_dir:
+            worker_trainer = copy.copy(self)
+            worker_trainer.parallel_final_evals = 0
+            for attr, source in self._get_shared_data_sources(work_dir).items():
+                setattr(worker_trainer, attr, source)
+            runs = run_final_evals_parallel(worker_trainer, config, seeds, work_dir, num_workers)
+            ## only the model that train_with_single_config keeps (the first with the highest objective) is loaded
+            objectives = [ obj for obj, _, _, _ in runs ]
+            best = objectives.index(max(objectives))
+            best_model = self._load_final_eval_model(config, runs[best][3])
+        return [ (best_model if i == best else None, obj, v_res, vectorizer)
+                 for i, (obj, v_res, vectorizer, _) in enumerate(runs) ]
+
+    def _get_shared_data_sources(self, work_dir):
+        """Replacements for data source attributes (e.g. `train_data_or_path`) that worker processes
+        can open without copying the data, created under `work_dir`."""
+        return {}
+
+    @abc.abstractmethod
+    def _load_final_eval_model(self, config, model_dir):
+        """Load a model fitted with configuration `config` and written by `write_model` to `model_dir`."""
     
 
 
@@ -230,13 +276,18 @@ class BowVAETrainer(TopicTrainer):
         use_gpu (bool): Flag to force use of a GPU if available.  Default = False.
         val_each_epoch (bool): Perform validation (NPMI and perplexity) on the validation set after each epoch. Default = False.
         rng_seed (int): Seed for random number generator. Default = 1234
+        stack_final_evals (bool): Train the multiple final evaluation models together as one stacked model
+            (see :class:`tmnt.estimator.StackedBowEstimator`) rather than one after another. Default = False
+        parallel_final_evals (int): Number of worker processes for fitting multiple final evaluation models
+            in parallel when they are not stacked. Default = 0 (sequential)
     """
     def __init__(self, vocabulary, train_data_or_path, test_data_or_path,
                  log_out_dir='_exps', model_out_dir='_model_dir', coherence_via_encoder=False, aux_data_or_path=None,
                  pretrained_param_file=None, topic_seed_file = None, use_labels_as_covars=False, coherence_coefficient=8.0,
                  use_gpu=False, n_labels=0,
-                 val_each_epoch=True, rng_seed=1234):
-        super().__init__(vocabulary, model_out_dir, train_data_or_path, test_data_or_path, aux_data_or_path, use_gpu, val_each_epoch, rng_seed)
+                 val_each_epoch=True, rng_seed=1234, stack_final_evals=False, parallel_final_evals=0):
+        super().__init__(vocabulary, model_out_dir, train_data_or_path, test_data_or_path, aux_data_or_path, use_gpu, val_each_epoch, rng_seed,
+                         parallel_final_evals=parallel_final_evals)
         if not log_utils.CONFIGURED:
             logging_config(folder=log_out_dir, name='tmnt', level='info', console_level='info')
         self.log_out_dir = log_out_dir
@@ -246,6 +297,8 @@ class BowVAETrainer(TopicTrainer):
         self.use_labels_as_covars = use_labels_as_covars
         self.coherence_via_encoder = coherence_via_encoder
         self.coherence_coefficient = coherence_coefficient
+        self.stack_final_evals = stack_final_evals
+        self.tuned_batch_size = None
         if topic_seed_file:
             self.seed_matrix = get_seed_matrix_from_file(topic_seed_file, vocabulary, ctx)
         
@@ -289,7 +342,9 @@ class BowVAETrainer(TopicTrainer):
                    model_out_dir=model_out_dir,
                    pretrained_param_file=c_args.pretrained_param_file, topic_seed_file=c_args.topic_seed_file,
                    use_labels_as_covars=c_args.use_labels_as_covars,
-                   use_gpu=c_args.use_gpu, n_labels=n_labels, val_each_epoch=val_each_epoch)
+                   use_gpu=c_args.use_gpu, n_labels=n_labels, val_each_epoch=val_each_epoch,
+                   stack_final_evals=getattr(c_args, 'stack_final_evals', False),
+                   parallel_final_evals=getattr(c_args, 'parallel_final_evals', 0))
 
 
     def pre_cache_vocabularies(self, sources):
@@ -305,7 +360,7 @@ class BowVAETrainer(TopicTrainer):
         """
         raise NotImplemented
 
-    def _get_estimator(self, config, reporter, ctx):
+    def _get_estimator(self, config, reporter, ctx, n_seeds=1):
         """Take a model configuration - specified by a config file or as determined by model selection and 
         return a VAE topic model ready for training.
 
@@ -313,9 +368,10 @@ class BowVAETrainer(TopicTrainer):
             config (dict): an autogluon configuration/argument object, instantiated to particular parameters
             reporter (`autogluon.core.scheduler.reporter.Reporter`): object for reporting model evaluations to scheduler
             ctx (`mxnet.context.Context`): Mxnet compute context
+            n_seeds (int): Number of independently initialized models to train together (StackedBowEstimator if > 1)
         
         Returns:
-            Estimator (:class:`tmnt.estimator.BaseEstimator`): Either BowEstimator or CovariateBowEstimator
+            Estimator (:class:`tmnt.estimator.BaseEstimator`): BowEstimator, StackedBowEstimator or CovariateBowEstimator
         """
         embedding_source = config['embedding']['source']
         vocab, _ = self._initialize_vocabulary(embedding_source)
@@ -323,6 +379,12 @@ class BowVAETrainer(TopicTrainer):
             estimator = CovariateBowEstimator.from_config(self.n_labels, config, vocab,
                                                      pretrained_param_file=self.pretrained_param_file,
                                                      reporter=reporter, ctx=ctx)
+        elif n_seeds > 1:
+            estimator = StackedBowEstimator.from_config(n_seeds, config, vocab, n_labels = self.n_labels,
+                                                        coherence_via_encoder   = self.coherence_via_encoder,
+                                                        validate_each_epoch     = self.validate_each_epoch,
+                                                        coherence_coefficient   = self.coherence_coefficient,
+                                                        reporter=reporter, ctx=ctx)
         else:
            estimator = BowEstimator.from_config(config, vocab, n_labels = self.n_labels,
                                                 coherence_via_encoder   = self.coherence_via_encoder,
@@ -330,16 +392,44 @@ class BowVAETrainer(TopicTrainer):
                                                 pretrained_param_file   = self.pretrained_param_file,
                                                 coherence_coefficient   = self.coherence_coefficient,
                                                 reporter=reporter, ctx=ctx)
+        if self.tuned_batch_size is not None:
+            estimator.batch_size = self.tuned_batch_size
         return estimator
+
+    def tune_throughput(self, config, memory_cap_mb=None, apply=True, **tuner_kwargs):
+        """Probe training throughput for models with configuration `config` on the training data over candidate
+        batch sizes and thread counts (see :class:`tmnt.tuning.ThroughputTuner`). The report is written to
+        the model directory.
+
+        Parameters:
+            config (dict): Model configuration
+            memory_cap_mb (float): Settings with higher peak memory are not recommended
+            apply (bool): Use the recommended batch size for models trained by this trainer, and the recommended
+                thread counts for worker processes started afterwards
+            tuner_kwargs: Additional keyword arguments to :class:`tmnt.tuning.ThroughputTuner`
+
+        Returns:
+            (dict): Tuning report
+        """
+        estimator = self._get_estimator(config, FakeReporter(), mx.cpu())
+        X, y = self._get_x_y_data(self.train_data_or_path)
+        report = ThroughputTuner(memory_cap_mb=memory_cap_mb, **tuner_kwargs).tune(estimator, X, y, mode='train')
+        if self.model_out_dir:
+            write_tuning_report(report, self.model_out_dir)
+        if apply and report['best'] is not None:
+            self.tuned_batch_size = report['best']['batch_size']
+            ThroughputTuner.apply_threads(report)
+        return report
     
 
-    def train_model(self, config, reporter):
+    def train_model(self, config, reporter, n_seeds=1):
         """Main training function which takes a single model configuration and a budget (i.e. number of epochs) and
         fits the model to the training data.
         
         Parameters:
             config: `Configuration` object within the specified `ConfigSpace`
             reporter: Reporter callback for model selection
+            n_seeds: Number of independently initialized models to train together as one stacked model
 
         Returns:
             (tuple): Tuple containing:
@@ -350,7 +440,7 @@ class BowVAETrainer(TopicTrainer):
         logging.debug("Evaluating with Config: {}".format(config))
         ctx_list = self._get_mxnet_visible_gpus() if self.use_gpu else [mx.cpu()]
         ctx = ctx_list[0]
-        vae_estimator = self._get_estimator(config, reporter, ctx)
+        vae_estimator = self._get_estimator(config, reporter, ctx, n_seeds=n_seeds)
         X, y = self._get_x_y_data(self.train_data_or_path)
         if self.test_data_or_path is None:
             vX, vy = None, None
@@ -359,6 +449,34 @@ class BowVAETrainer(TopicTrainer):
         obj, v_res = vae_estimator.fit_with_validation(X, y, vX, vy)
         return vae_estimator, obj, v_res, None
 
+    def _run_final_evals(self, config, num_evals):
+        stackable = (self.stack_final_evals and num_evals > 1 and not self.use_labels_as_covars
+                     and self.pretrained_param_file is None
+                     and config['latent_distribution']['dist_type'] != 'vmf'
+                     and int(config.get('early_stopping_patience', 0)) == 0 and not config.get('async_validation', False))
+        if not stackable:
+            return super()._run_final_evals(config, num_evals)
+        seed_rng(self.rng_seed)
+        logging.info("Training {} models together as one stacked model (rng seed {})".format(num_evals, self.rng_seed))
+        stacked, _, _, vectorizer = self.train_model(config, FakeReporter(), n_seeds=num_evals)
+        return [ (stacked.seed_estimator(s), obj, v_res, vectorizer) for s, (obj, v_res) in enumerate(stacked.seed_results) ]
+
+    def _get_shared_data_sources(self, work_dir):
+        ## sparse training/validation matrices are loaded once and memory-mapped by the worker processes
+        sources = {}
+        for attr in ('train_data_or_path', 'test_data_or_path'):
+            source = getattr(self, attr)
+            if source is not None:
+                X, y = self._get_x_y_data(source)
+                sources[attr] = MemmapCSRData.save(os.path.join(work_dir, attr), X, y)
+        return sources
+
+    def _load_final_eval_model(self, config, model_dir):
+        estimator = self._get_estimator(config, FakeReporter(), mx.cpu())
+        estimator.pretrained_param_file = os.path.join(model_dir, 'model.params')
+        estimator.initialize_with_pretrained()
+        return estimator
+
     def write_model(self, estimator):
         """Method to write an estimated model to disk
 
@@ -383,12 +501,15 @@ class SeqBowVEDTrainer(TopicTrainer):
         log_interval (int): Perform validation (NPMI and perplexity) on the validation set this many batches. Default = 10.
         rng_seed (int): Seed for random number generator. Default = 1234
         tmnt_vectorizer_args (dict): Dictionary of keyword parameter values to instantiate the TMNTVectorizer
+        parallel_final_evals (int): Number of worker processes for fitting multiple final evaluation models
+            in parallel. Default = 0 (sequential)
     """
     def __init__(self, model_out_dir, train_data_path, 
                  test_data_path, aux_data_path=None, use_gpu=False, log_interval=10, rng_seed=1234,
-                 tmnt_vectorizer_args=None):
+                 tmnt_vectorizer_args=None, parallel_final_evals=0):
         super().__init__(None, model_out_dir, train_data_or_path=train_data_path, test_data_or_path=test_data_path,
-                         aux_data_or_path=aux_data_path, use_gpu=use_gpu, val_each_epoch=True, rng_seed=rng_seed)
+                         aux_data_or_path=aux_data_path, use_gpu=use_gpu, val_each_epoch=True, rng_seed=rng_seed,
+                         parallel_final_evals=parallel_final_evals)
         self.model_out_dir = model_out_dir
         self.kld_wt = 1.0
         self.log_interval = log_interval
@@ -410,7 +531,8 @@ class SeqBowVEDTrainer(TopicTrainer):
             args.val_file,
             aux_data_path = args.aux_file,
             use_gpu = args.use_gpu,
-            log_interval = args.log_interval
+            log_interval = args.log_interval,
+            parallel_final_evals = getattr(args, 'parallel_final_evals', 0)
             )
         return trainer
 
@@ -446,10 +568,11 @@ class SeqBowVEDTrainer(TopicTrainer):
         bert_dataset    = config['bert_dataset']
         batch_size      = config['batch_size']
         max_seq_len     = config['max_seq_len']
+        max_tokens      = int(config.get('max_tokens', 0))
         
         tr_dataset, val_dataset, aux_dataset, num_examples, bert_base, bert_vocab  = \
             get_bert_datasets(classes, vectorizer, tr_ds, val_ds, batch_size, max_seq_len, aux_ds = aux_ds, 
-                              bert_model_name=bert_model_name, bert_dataset=bert_dataset, ctx=ctx)
+                              bert_model_name=bert_model_name, bert_dataset=bert_dataset, max_tokens=max_tokens, ctx=ctx)
         n_labels = len(classes) if classes else 0
         return bert_base, bert_vocab, vectorizer, n_labels, tr_dataset, val_dataset, aux_dataset, num_examples
         
@@ -490,6 +613,9 @@ class SeqBowVEDTrainer(TopicTrainer):
         return seq_ved_estimator, obj, v_res, vectorizer
 
 
+    def _load_final_eval_model(self, config, model_dir):
+        return SeqBowEstimator.from_saved(model_dir, log_interval=self.log_interval)
+
     def write_model(self, estimator, epoch_id=0):
         """Method to write an estimated model to disk along with configuration used to train the model and the vocabulary.
 
@@ -499,6 +625,7 @@ class SeqBowVEDTrainer(TopicTrainer):
         """
         model_dir = self.model_out_dir
         if model_dir:
+            os.makedirs(model_dir, exist_ok=True)
             suf = '_'+ str(epoch_id) if epoch_id > 0 else ''
             estimator.write_model(model_dir, suffix=suf)
 
@@ -513,12 +640,37 @@ def train_bow_vae(args):
     dd = datetime.datetime.now()
     trainer = BowVAETrainer.from_arguments(args, val_each_epoch=args.eval_each_epoch)
     config = ag.space.Dict(**config_dict)
+    init_reduced_precision(config_dict.get('dtype', 'float32'))
+    if getattr(args, 'tune_throughput', False):
+        trainer.tune_throughput(config, memory_cap_mb=args.tune_memory_cap_mb)
     estimator, obj, vres = trainer.train_with_single_config(config, args.num_final_evals)
     trainer.write_model(estimator)
     dd_finish = datetime.datetime.now()
     logging.info("Model training FINISHED. Time: {}".format(dd_finish - dd))
         
 
+def train_bow_vae_parallel(args):
+    try:
+        with open(args.config, 'r') as f:
+            config_dict = json.load(f)
+    except:
+        logging.error("File passed to --config, {}, does not appear to be a valid .json configuration instance".format(args.config))
+        raise Exception("Invalid Json Configuration File")
+    dd = datetime.datetime.now()
+    trainer = BowVAETrainer.from_arguments(args, val_each_epoch=args.eval_each_epoch)
+    vocab, _ = trainer._initialize_vocabulary(config_dict['embedding']['source'])
+    n_covars = trainer.n_labels if trainer.use_labels_as_covars else 0
+    if not trainer.use_labels_as_covars:
+        config_dict['n_labels'] = config_dict.get('n_labels', trainer.n_labels)
+    obj, vres, train_secs, _ = fit_bow_data_parallel(config_dict, vocab, args.tr_vec_file, val_X=args.val_vec_file,
+                                                     num_workers=args.num_workers, n_covars=n_covars,
+                                                     model_dir=trainer.model_out_dir, seed=args.seed,
+                                                     local_sgd_interval=args.local_sgd_interval)
+    dd_finish = datetime.datetime.now()
+    logging.info("Data-parallel model training FINISHED with {} workers. Objective = {}. Time: {}"
+                 .format(args.num_workers, obj, dd_finish - dd))
+
+
 def train_seq_bow(c_args):
     try:
         with open(c_args.config, 'r') as f:
@@ -528,7 +680,8 @@ def train_seq_bow(c_args):
                       .format(c_args.config))
         raise Exception("Invalid JSON configuration file")
     config = ag.space.Dict(**config_dict)    
+    init_reduced_precision(config_dict.get('dtype', 'float32'))
     trainer = SeqBowVEDTrainer.from_arguments(c_args, config)
-    estimator, obj, vres = trainer.train_with_single_config(config, 1)
+    estimator, obj, vres = trainer.train_with_single_config(config, getattr(c_args, 'num_final_evals', 1))
     trainer.write_model(estimator)
     
@@ -0,0 +1,225 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Tuning of batch size and thread counts for training and inference throughput with bag-of-words models.
+"""
+
+import os
+import json
+import time
+import logging
+import multiprocessing
+import queue as queue_mod
+import numpy as np
+from tmnt.parallel import _environment
+
+__all__ = ['ThroughputTuner', 'write_tuning_report', 'read_tuning_report']
+
+REPORT_FILE = 'tuning_report.json'
+
+
+def _probe_worker(spec, mode, X, y, batch_sizes, steps, warmup_steps):
+    ## runs in a fresh process so that the thread settings in its environment take effect
+    import resource
+    import mxnet as mx
+    from mxnet import autograd, gluon
+    from tmnt.utils.async_validation import rebuild_estimator
+    estimator = rebuild_estimator(spec)
+    n_covars = getattr(estimator.model, 'n_covars', 0)
+    results = []
+    ## batch sizes are probed in increasing order, so the running peak memory is that of the largest so far
+    for batch_size in sorted(batch_sizes):
+        def get_batch(i):
+            start = (i * batch_size) % (X.shape[0] - batch_size + 1)
+            data = mx.nd.sparse.csr_matrix(X[start:start+batch_size], dtype='float32').as_in_context(estimator.ctx)
+            if y is not None:
+                labels = mx.nd.array(y[start:start+batch_size])
+            else:
+                labels = mx.nd.zeros(batch_size) if n_covars > 0 else None
+            return data, labels
+        try:
+            ## some models (e.g. with covariates) depend on the batch size
+            estimator.batch_size = batch_size
+            model = estimator.model = estimator._get_model()
+            if mode == 'train':
+                trainer = gluon.Trainer(model.collect_params(), estimator.optimizer, {'learning_rate': estimator.lr})
+                def run_step(i):
+                    with autograd.record():
+                        _, _, _, _, _, total_ls = estimator._get_losses(model, (get_batch(i),))
+                    total_ls.backward()
+                    trainer.step(1, ignore_stale_grad=True)
+            else:
+                def run_step(i):
+                    data, labels = get_batch(i)
+                    if n_covars > 0:
+                        encs = model.encode_data_with_covariates(data, mx.nd.one_hot(labels, n_covars))
+                    else:
+                        encs = model.encode_data(data)
+                    encs.asnumpy()
+            for i in range(warmup_steps):
+                run_step(i)
+            mx.nd.waitall()
+            ts = time.time()
+            for i in range(steps):
+                run_step(warmup_steps + i)
+            mx.nd.waitall()
+            secs = time.time() - ts
+            results.append({'batch_size': batch_size, 'docs_per_sec': batch_size * steps / secs,
+                            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+        except Exception as e:
+            results.append({'batch_size': batch_size, 'error': str(e)})
+            break
+    return results
+
+
+def _run_probe(queue, args):
+    queue.put(_probe_worker(*args))
+
+
+def write_tuning_report(report, model_dir):
+    """Write a report from :class:`ThroughputTuner` to 'tuning_report.json' in `model_dir`."""
+    os.makedirs(model_dir, exist_ok=True)
+    path = os.path.join(model_dir, REPORT_FILE)
+    with open(path, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    logging.info("Throughput tuning report written to {}".format(path))
+    return path
+
+
+def read_tuning_report(model_dir):
+    """Read a report written by :func:`write_tuning_report` from `model_dir`."""
+    with open(os.path.join(model_dir, REPORT_FILE), 'r') as fp:
+        return json.load(fp)
+
+
+class ThroughputTuner(object):
+    """Find the batch size and thread counts that maximize throughput (documents per second) for training
+    or inference with a bag-of-words estimator, subject to a memory cap.
+
+    Each thread setting is probed in a separate process, since OpenMP and MXNet engine thread counts are fixed
+    when MXNet is loaded. Within a process, each batch size is timed over a number of training steps (forward,
+    backward and update) or inference batches on a sample of the data, after a few warm-up steps; peak resident
+    memory of the process is recorded with each measurement.
+
+    Parameters:
+        batch_sizes: Candidate batch sizes
+        omp_threads: Candidate OpenMP thread counts (default powers of two up to the number of cores)
+        engine_threads: Candidate MXNet CPU engine worker thread counts (`MXNET_CPU_WORKER_NTHREADS`)
+        steps: Number of timed steps for each batch size
+        warmup_steps: Number of untimed steps before timing
+        memory_cap_mb: Settings whose peak resident memory exceeds this are not recommended (None for no cap)
+        probe_timeout: Seconds allowed for the probes of one thread setting
+    """
+    def __init__(self, batch_sizes=(32, 64, 128, 256, 512, 1024), omp_threads=None, engine_threads=(1, 2),
+                 steps=20, warmup_steps=3, memory_cap_mb=None, probe_timeout=600):
+        self.batch_sizes = list(batch_sizes)
+        if omp_threads is None:
+            n_cores = os.cpu_count() or 1
+            omp_threads = [ 2**i for i in range(n_cores.bit_length()) if 2**i <= n_cores ]
+            if omp_threads[-1] != n_cores:
+                omp_threads.append(n_cores)
+        self.omp_threads = list(omp_threads)
+        self.engine_threads = list(engine_threads)
+        self.steps = steps
+        self.warmup_steps = warmup_steps
+        self.memory_cap_mb = memory_cap_mb
+        self.probe_timeout = probe_timeout
+
+    def _sample(self, X, y):
+        n_rows = min(X.shape[0], max(self.batch_sizes) * 4)
+        rows = np.sort(np.random.choice(X.shape[0], n_rows, replace=False))
+        return X[rows], (np.asarray(y)[rows] if y is not None else None)
+
+    def _probe_threads(self, spec, mode, X, y, batch_sizes, omp, engine):
+        env = {'OMP_NUM_THREADS': str(omp), 'MXNET_CPU_WORKER_NTHREADS': str(engine)}
+        mp_ctx = multiprocessing.get_context('spawn')
+        queue = mp_ctx.Queue()
+        proc = mp_ctx.Process(target=_run_probe,
+                              args=(queue, (spec, mode, X, y, batch_sizes, self.steps, self.warmup_steps)))
+        with _environment(env):
+            proc.start()
+        deadline = time.time() + self.probe_timeout
+        results = None
+        try:
+            while results is None:
+                try:
+                    results = queue.get(timeout=1.0)
+                except queue_mod.Empty:
+                    if proc.exitcode is not None:
+                        results = [{'batch_size': None, 'error': 'Probe process exited with code {}'.format(proc.exitcode)}]
+                    elif time.time() > deadline:
+                        results = [{'batch_size': None, 'error': 'Probe timed out after {} seconds'.format(self.probe_timeout)}]
+        finally:
+            ## a hung probe would otherwise keep running (and using the cores) during later probes
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        for r in results:
+            r.update(omp_threads=omp, engine_threads=engine)
+        return results
+
+    def tune(self, estimator, X, y=None, mode='train'):
+        """Run throughput probes for `estimator` on (a sample of) `X`.
+
+        Parameters:
+            estimator: Bag-of-words estimator (:class:`tmnt.estimator.BaseBowEstimator`); its configuration is used,
+                but its parameters are not modified
+            X: Document-term matrix (scipy CSR) representative of the data
+            y: Labels or covariates for `X` (optional)
+            mode: 'train' to time training steps or 'inference' to time encoding
+
+        Returns:
+            (dict): Report with the data characteristics, all probe results and the 'best' setting
+            (None if no setting fits within the memory cap)
+        """
+        if mode not in ('train', 'inference'):
+            raise Exception("Unknown tuning mode {}; must be 'train' or 'inference'".format(mode))
+        X_s, y_s = self._sample(X, y)
+        batch_sizes = [ b for b in self.batch_sizes if b <= X_s.shape[0] ]
+        if len(batch_sizes) == 0:
+            raise Exception("Data has fewer rows ({}) than the smallest candidate batch size".format(X_s.shape[0]))
+        spec = estimator._get_validation_snapshot_spec()
+        probes = []
+        for omp in self.omp_threads:
+            for engine in self.engine_threads:
+                results = self._probe_threads(spec, mode, X_s, y_s, batch_sizes, omp, engine)
+                for r in results:
+                    if 'error' in r:
+                        logging.info("Probe omp_threads={} engine_threads={} batch_size={} failed: {}"
+                                     .format(omp, engine, r['batch_size'], r['error']))
+                    else:
+                        logging.info("Probe omp_threads={} engine_threads={} batch_size={}: {:.1f} docs/sec, peak {:.0f} MB"
+                                     .format(omp, engine, r['batch_size'], r['docs_per_sec'], r['peak_rss_mb']))
+                probes.extend(results)
+        feasible = [ p for p in probes if 'error' not in p
+                     and (self.memory_cap_mb is None or p['peak_rss_mb'] <= self.memory_cap_mb) ]
+        best = max(feasible, key=lambda p: p['docs_per_sec']) if len(feasible) > 0 else None
+        if best is not None:
+            logging.info("Best {} setting: batch_size={} omp_threads={} engine_threads={} ({:.1f} docs/sec)"
+                         .format(mode, best['batch_size'], best['omp_threads'], best['engine_threads'], best['docs_per_sec']))
+        else:
+            logging.warning("No {} setting satisfied the memory cap of {} MB".format(mode, self.memory_cap_mb))
+        return {'mode': mode,
+                'data': {'n_docs': int(X.shape[0]), 'vocab_size': int(X.shape[1]),
+                         'density': float(X.nnz) / (X.shape[0] * X.shape[1])},
+                'cpu_count': os.cpu_count(),
+                'memory_cap_mb': self.memory_cap_mb,
+                'probes': probes,
+                'best': best}
+
+    @staticmethod
+    def apply_threads(report):
+        """Set the recommended thread counts in the environment (`OMP_NUM_THREADS` and `MXNET_CPU_WORKER_NTHREADS`).
+        This applies only to child processes started afterwards (e.g. data-parallel or final evaluation workers):
+        both settings are read when MXNet is loaded, so training in the current process is not affected.
+
+        Returns:
+            (dict): The environment variables set (empty if the report has no recommended setting)
+        """
+        best = report.get('best')
+        if best is None:
+            return {}
+        env = {'OMP_NUM_THREADS': str(best['omp_threads']), 'MXNET_CPU_WORKER_NTHREADS': str(best['engine_threads'])}
+        os.environ.update(env)
+        logging.info("Thread settings {} applied to worker processes started from now on".format(env))
+        return env
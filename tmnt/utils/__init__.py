@@ -7,6 +7,10 @@ Copyright (c) 2019 The MITRE Corporation.
 from .log_utils import *
 from .mat_utils import *
 from .random import *
+from .precision import *
+from .async_validation import *
+from .checkpoint import *
+from .training_state import *
 ##from .pubmed_utils import *
 
-__all__ = log_utils.__all__ + mat_utils.__all__ + random.__all__ 
+__all__ = log_utils.__all__ + mat_utils.__all__ + random.__all__ + precision.__all__ + async_validation.__all__ + checkpoint.__all__ + training_state.__all__
@@ -0,0 +1,163 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Validation of parameter snapshots in a background process while training continues.
+"""
+
+import os
+import shutil
+import logging
+import tempfile
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+__all__ = ['AsyncValidator', 'HostBatchLoader', 'rebuild_estimator']
+
+## state of the background validation process, set by the pool initializer
+_worker_state = {}
+
+
+def _to_host(batch):
+    """Convert (nested tuples of) NDArrays into picklable numpy arrays and scipy CSR matrices."""
+    import mxnet as mx
+    import scipy.sparse as sp
+    if batch is None:
+        return None
+    if isinstance(batch, (tuple, list)):
+        return tuple(_to_host(b) for b in batch)
+    if isinstance(batch, mx.nd.sparse.CSRNDArray):
+        return sp.csr_matrix((batch.data.asnumpy(), batch.indices.asnumpy(), batch.indptr.asnumpy()), shape=batch.shape)
+    return batch.asnumpy()
+
+
+def _from_host(batch):
+    import mxnet as mx
+    import scipy.sparse as sp
+    if batch is None:
+        return None
+    if isinstance(batch, tuple):
+        return tuple(_from_host(b) for b in batch)
+    if sp.issparse(batch):
+        return mx.nd.sparse.csr_matrix(batch, dtype=batch.dtype)
+    return mx.nd.array(batch, dtype=batch.dtype)
+
+
+class HostBatchLoader(object):
+    """Picklable loader over batches materialized in host memory from another validation data loader.
+    Batches have the same (nested tuple) structure as those of the source loader.
+
+    Parameters:
+        data_loader: Loader to materialize (iterated once)
+    """
+    def __init__(self, data_loader):
+        self.batches = [ _to_host(b) for b in data_loader ]
+        self.last_batch_size = getattr(data_loader, 'last_batch_size', -1)
+        self.num_batches = getattr(data_loader, 'num_batches', len(self.batches))
+        self.handle_last_batch = getattr(data_loader, 'handle_last_batch', 'pad')
+
+    def __iter__(self):
+        for b in self.batches:
+            yield _from_host(b)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def _noop():
+    return None
+
+
+def rebuild_estimator(spec):
+    """Rebuild an estimator, with a freshly initialized model, from the picklable description returned by
+    its `_get_validation_snapshot_spec` method. Embeddings are randomly initialized rather than loaded."""
+    import autogluon.core as ag
+    import gluonnlp as nlp
+    from tmnt.utils.precision import init_reduced_precision, DynamicLossScaler
+    est_cls, args, config, vocab_json, attrs = spec
+    ## mixed precision is process-wide, so it is enabled here for estimators trained in reduced precision
+    init_reduced_precision(attrs.get('dtype', 'float32'))
+    estimator = est_cls.from_config(*args, ag.space.Dict(**config), nlp.Vocab.from_json(vocab_json))
+    for k, v in attrs.items():
+        setattr(estimator, k, v)
+    if estimator.dtype == 'float16':
+        estimator.loss_scaler = DynamicLossScaler()
+    estimator.embedding_source = 'random'
+    estimator.pretrained_param_file = None
+    estimator.reporter = None
+    estimator.model = estimator._get_model()
+    return estimator
+
+
+def _init_worker(spec, val_loader, val_X_size, total_val_words, val_y):
+    ## all weights (including embeddings) are loaded from the snapshots
+    estimator = rebuild_estimator(spec)
+    _worker_state.update(estimator=estimator, val_loader=val_loader, val_X_size=val_X_size,
+                         total_val_words=total_val_words, val_y=val_y)
+
+
+def _validate_snapshot(epoch, param_file):
+    s = _worker_state
+    estimator = s['estimator']
+    estimator.model.load_parameters(param_file, ctx=estimator.ctx)
+    os.remove(param_file)
+    sc_obj, v_res = estimator._perform_validation(epoch, s['val_loader'], s['val_X_size'], s['total_val_words'],
+                                                  s['val_y'])
+    return epoch, sc_obj, v_res
+
+
+class AsyncValidator(object):
+    """Validate snapshots of an estimator's parameters in a background process.
+
+    The estimator is rebuilt (on CPU) in the background process from its configuration and validation data is
+    materialized once, so each submitted epoch only transfers a parameter file. Results are returned in epoch order.
+
+    Parameters:
+        estimator: Bag-of-words estimator being trained
+        validation_dataloader: Validation data loader (materialized in host memory)
+        val_X_size: Number of validation documents
+        total_val_words: Total number of validation tokens
+        val_y: Validation labels (optional)
+        threads: Number of OpenMP threads for the background process (default leaves the environment unchanged)
+    """
+    def __init__(self, estimator, validation_dataloader, val_X_size, total_val_words, val_y=None, threads=None):
+        self._snapshot_dir = tempfile.mkdtemp(prefix='tmnt_val_')
+        self._pending = collections.OrderedDict()
+        self._executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                                             initargs=(estimator._get_validation_snapshot_spec(),
+                                                       HostBatchLoader(validation_dataloader),
+                                                       val_X_size, total_val_words, val_y))
+        saved_threads = os.environ.get('OMP_NUM_THREADS')
+        if threads is not None:
+            os.environ['OMP_NUM_THREADS'] = str(threads)
+        try:
+            ## start the background process now so it inherits the thread setting and is ready by the first snapshot
+            self._executor.submit(_noop).result()
+        finally:
+            if threads is not None:
+                if saved_threads is None:
+                    del os.environ['OMP_NUM_THREADS']
+                else:
+                    os.environ['OMP_NUM_THREADS'] = saved_threads
+
+    def submit(self, epoch, model):
+        """Snapshot the parameters of `model` and queue their validation as epoch `epoch`."""
+        param_file = os.path.join(self._snapshot_dir, 'epoch_{}.params'.format(epoch))
+        model.save_parameters(param_file)
+        self._pending[epoch] = self._executor.submit(_validate_snapshot, epoch, param_file)
+
+    def completed(self, wait=False):
+        """Results (epoch, objective, validation results) for finished snapshots, in epoch order.
+        A result is held back until all earlier epochs have finished; with `wait`, block until all have finished."""
+        results = []
+        while len(self._pending) > 0:
+            epoch, future = next(iter(self._pending.items()))
+            if not (wait or future.done()):
+                break
+            del self._pending[epoch]
+            results.append(future.result())
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self._snapshot_dir, ignore_errors=True)
@@ -0,0 +1,117 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Background writer for model checkpoints.
+"""
+
+import os
+import queue
+import logging
+import threading
+import mxnet as mx
+
+__all__ = ['CheckpointWriter']
+
+
+class CheckpointWriter(object):
+    """Write model checkpoints from a background thread so training is not blocked by serialization.
+
+    `save` takes an in-memory copy of the parameters (queued on the MXNet engine, so it does not wait for
+    pending computation) and returns; files are written by the background thread to a temporary name and
+    atomically renamed into place. A checkpoint with tag `t` consists of 'model.params<t>' and one file
+    '<name><t>' for each entry of the `files` dictionary passed to `save`.
+
+    Parameters:
+        checkpoint_dir: Output directory (created if needed)
+        keep_last: Retain only the `keep_last` most recent checkpoints (0 retains all)
+        keep_best: Additionally retain the `keep_best` checkpoints with the highest scores (only applies when
+            `keep_last` > 0, since all checkpoints are otherwise retained)
+        max_pending: Maximum number of checkpoints held in memory awaiting writing; `save` blocks beyond this
+    """
+    def __init__(self, checkpoint_dir: str, keep_last: int = 0, keep_best: int = 0, max_pending: int = 2):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self._written = [] ## (tag, score, file names) in order of writing
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, tag, model, files=None, score=None):
+        """Queue a checkpoint of `model` (a Gluon block) tagged with `tag`.
+
+        Parameters:
+            tag: Suffix for checkpoint file names (e.g. the epoch)
+            model: Gluon block whose parameters are saved (loadable with `load_parameters`)
+            files: Dictionary of additional file names to (string) contents, e.g. configuration and vocabulary
+            score: Score used for keep-best retention (higher is better); None if not available
+        """
+        self._raise_error()
+        ## names without the block prefix, as written by `ParameterDict.save(strip_prefix=...)`
+        params = { self._strip_prefix(k, model.prefix): p.data().copyto(mx.cpu())
+                   for k, p in model.collect_params().items() }
+        self._queue.put((str(tag), params, dict(files or {}), score))
+
+    def close(self):
+        """Wait for all queued checkpoints to be written."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    @staticmethod
+    def _strip_prefix(name, prefix):
+        return name[len(prefix):] if name.startswith(prefix) else name
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception("Checkpoint writing failed") from error
+
+    def _atomic_write(self, name, write_fn):
+        path = os.path.join(self.checkpoint_dir, name)
+        tmp_path = path + '.tmp'
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def _write_text(self, contents):
+        def write_fn(path):
+            with open(path, 'w') as fp:
+                fp.write(contents)
+        return write_fn
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            tag, params, files, score = item
+            try:
+                paths = [ self._atomic_write('model.params' + tag, lambda path: mx.nd.save(path, params)) ]
+                paths += [ self._atomic_write(name + tag, self._write_text(contents)) for name, contents in files.items() ]
+                self._written.append((tag, score, paths))
+                logging.info("Checkpoint {} written to {}".format(tag, self.checkpoint_dir))
+                self._apply_retention()
+            except Exception as e:
+                logging.error("Failed to write checkpoint {}: {}".format(tag, e))
+                self._error = e
+
+    def _apply_retention(self):
+        if self.keep_last <= 0:
+            return
+        keep = set(tag for tag, _, _ in self._written[-self.keep_last:])
+        scored = sorted([ c for c in self._written if c[1] is not None ], key=lambda c: c[1], reverse=True)
+        keep.update(tag for tag, _, _ in scored[:self.keep_best])
+        retained = []
+        for tag, score, paths in self._written:
+            if tag in keep:
+                retained.append((tag, score, paths))
+            else:
+                for path in paths:
+                    if os.path.exists(path):
+                        os.remove(path)
+        self._written = retained
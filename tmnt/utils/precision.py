@@ -0,0 +1,141 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Utilities for reduced-precision (bfloat16/float16) training and inference.
+"""
+
+import logging
+import numpy as np
+import mxnet as mx
+
+__all__ = ['bfloat16_supported', 'init_reduced_precision', 'resolve_dtype', 'cast_for_inference', 'DynamicLossScaler']
+
+## dtype in effect and the dtype requested (they differ when bfloat16 falls back to float16)
+_AMP_DTYPE = None
+_AMP_REQUESTED = None
+
+
+def bfloat16_supported() -> bool:
+    """Whether the installed MXNet backend can run bfloat16 operators on CPU.
+    Requires an AMP build with bfloat16 operator lists and the MKLDNN backend.
+    """
+    try:
+        from mxnet.contrib.amp.lists import symbol_bf16
+    except ImportError:
+        return False
+    return mx.runtime.Features().is_enabled('MKLDNN')
+
+
+def init_reduced_precision(dtype: str) -> str:
+    """
+    Enable automatic mixed precision for all subsequently executed operators. Precision-sensitive
+    operators (softmax, log, sums, norms) remain in float32 and parameters keep float32 master copies.
+
+    AMP patches MXNet operators process-wide (affecting every model in the process), so this is never called
+    implicitly: it must be called once, before any model is built, by programs that opt in to reduced precision
+    (estimators and inferencers with a reduced `dtype` require it). Calling it again with the same dtype has no
+    effect; a different reduced dtype cannot be activated in the same process.
+
+    Parameters:
+        dtype: Requested dtype: 'float32', 'bfloat16' or 'float16'. 'bfloat16' falls back to
+            'float16' when unsupported by the backend. 'float32' leaves operators unchanged.
+    Returns:
+        The dtype actually in effect
+    """
+    global _AMP_DTYPE, _AMP_REQUESTED
+    if dtype == 'float32':
+        return dtype
+    if dtype not in ('bfloat16', 'float16'):
+        raise ValueError("Unsupported dtype {}; must be one of 'float32', 'bfloat16' or 'float16'".format(dtype))
+    if _AMP_DTYPE is not None:
+        if dtype != _AMP_REQUESTED:
+            raise Exception("Mixed precision already initialized with dtype {}; {} cannot be enabled in the same process"
+                            .format(_AMP_DTYPE, dtype))
+        return _AMP_DTYPE
+    _AMP_REQUESTED = dtype
+    if dtype == 'bfloat16' and not bfloat16_supported():
+        logging.warning("bfloat16 not supported by this MXNet backend; falling back to float16 with float32 accumulation")
+        dtype = 'float16'
+    from mxnet.contrib import amp
+    amp.init(target_dtype=dtype)
+    _AMP_DTYPE = dtype
+    logging.info("Automatic mixed precision initialized with target dtype = {}".format(dtype))
+    return _AMP_DTYPE
+
+
+def resolve_dtype(dtype: str) -> str:
+    """
+    The dtype in effect for an estimator or inferencer requesting `dtype`. Reduced precision requires that
+    :func:`init_reduced_precision` was called with the same request beforehand.
+
+    Parameters:
+        dtype: Requested dtype: 'float32', 'bfloat16' or 'float16'
+    Returns:
+        'float32', or the reduced dtype initialized for the process
+    """
+    if dtype == 'float32':
+        return dtype
+    if _AMP_DTYPE is None or dtype != _AMP_REQUESTED:
+        raise Exception("dtype {} requires mixed precision to be enabled first with "
+                        "tmnt.utils.precision.init_reduced_precision('{}')".format(dtype, dtype))
+    return _AMP_DTYPE
+
+
+def cast_for_inference(blocks, dtype: str) -> None:
+    """
+    Store the parameters of `blocks` in reduced precision for inference, halving their memory. Requires mixed
+    precision to be enabled (see :func:`init_reduced_precision`) so operators cast their inputs as needed.
+    Training keeps float32 master parameters; only inference stores reduced-precision weights.
+
+    Parameters:
+        blocks: Gluon blocks to cast (e.g. the BERT encoder or the bag-of-words encoder layers)
+        dtype: Requested dtype: 'float32', 'bfloat16' or 'float16'
+    """
+    dtype = resolve_dtype(dtype)
+    if dtype != 'float32':
+        for block in blocks:
+            block.cast(dtype)
+
+
+class DynamicLossScaler(object):
+    """Dynamic loss scaling for float16 training.
+
+    The loss is multiplied by `loss_scale` before the backward pass. The scale is halved (and the update skipped)
+    whenever gradients overflow and doubled after `scale_window` consecutive steps without overflow. Gradients are
+    unscaled by passing the scale into `Trainer.update` as part of the step size.
+
+    Parameters:
+        init_scale: Initial loss scale
+        scale_factor: Factor to grow/shrink the scale by
+        scale_window: Number of overflow-free steps before growing the scale
+        min_scale: Lower bound on the loss scale
+    """
+    def __init__(self, init_scale: float = 2.**16, scale_factor: float = 2.0, scale_window: int = 2000, min_scale: float = 1.0):
+        self.loss_scale = init_scale
+        self.scale_factor = scale_factor
+        self.scale_window = scale_window
+        self.min_scale = min_scale
+        self._steps_since_overflow = 0
+
+    def scale(self, loss):
+        return loss * self.loss_scale
+
+    def has_overflow(self, params) -> bool:
+        """Check all gradients of `params` for inf/nan with a single synchronization point."""
+        grad_sums = [ g.sum() for p in params if p.grad_req != 'null' for g in p.list_grad() ]
+        if len(grad_sums) == 0:
+            return False
+        total = mx.nd.add_n(*grad_sums).asscalar()
+        return not np.isfinite(total)
+
+    def update_scale(self, overflow: bool) -> bool:
+        if overflow:
+            self.loss_scale = max(self.loss_scale / self.scale_factor, self.min_scale)
+            self._steps_since_overflow = 0
+            logging.debug("Gradient overflow; reducing loss scale to {}".format(self.loss_scale))
+        else:
+            self._steps_since_overflow += 1
+            if self._steps_since_overflow >= self.scale_window:
+                self.loss_scale *= self.scale_factor
+                self._steps_since_overflow = 0
+        return overflow
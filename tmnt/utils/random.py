@@ -7,7 +7,7 @@ import random
 import mxnet as mx
 import numpy as np
 
-__all__ = ['seed_rng']
+__all__ = ['seed_rng', 'get_rng_state', 'set_rng_state', 'draw_mx_seed', 'seed_mx_rng_for_epoch']
 
 def seed_rng(seed: int):
     """
@@ -17,3 +17,36 @@ def seed_rng(seed: int):
     random.seed(seed)
     np.random.seed(seed)
     mx.random.seed(seed)
+
+def get_rng_state() -> dict:
+    """
+    Get the state of the Python and Numpy random number generators.
+    MXNet does not expose the state of its generators; training loops that need to restore it
+    reseed MXNet at the start of every epoch with :func:`seed_mx_rng_for_epoch` instead.
+    :return: Dictionary with the generator states
+    """
+    return {'python': random.getstate(), 'numpy': np.random.get_state()}
+
+def set_rng_state(state: dict):
+    """
+    Restore the Python and Numpy random number generators to a state returned by :func:`get_rng_state`.
+    :param state: Generator states
+    """
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+
+def draw_mx_seed() -> int:
+    """
+    Draw a seed from the MXNet random number generator; the Python and Numpy generators are not used.
+    :return: The seed drawn
+    """
+    return int(mx.nd.random.randint(0, 2**31 - 1, shape=(1,)).asscalar())
+
+def seed_mx_rng_for_epoch(base_seed: int, epoch: int):
+    """
+    Seed the MXNet random number generators for a training epoch, so that the MXNet random draws of an
+    epoch depend only on `base_seed` and `epoch` (e.g. when training is resumed from a saved state).
+    :param base_seed: Seed for the training run (see :func:`draw_mx_seed`)
+    :param epoch: Epoch index
+    """
+    mx.random.seed((base_seed + epoch) % (2**31 - 1))
@@ -7,6 +7,8 @@ import math
 import numpy as np
 from scipy.optimize import minimize_scalar
 
+__all__ = ['entropy', 'rescale', 'recalibrate_scores', 'recalibrate_scores_batch']
+
 def entropy(x):
     return - ( x * np.log(x) ).sum()
 
@@ -48,3 +50,61 @@ def recalibrate_scores(x, target_entropy=1.0):
     res = minimize_scalar(obj_fn, method='bounded', bounds=bounds)
     return rescale(x, res.x)
 
+
+
+def _log_rescale(log_x, t):
+    ## log of rescale(x, t) for each row, computed in log space so small probabilities do not underflow
+    z = t[:, None] * log_x
+    z = z - z.max(axis=1, keepdims=True)
+    return z - np.log(np.exp(z).sum(axis=1, keepdims=True))
+
+
+def _row_entropies(log_p):
+    p = np.exp(log_p)
+    return - np.where(p > 0.0, p * log_p, 0.0).sum(axis=1)
+
+
+def recalibrate_scores_batch(X, target_entropy=1.0, tol=1e-5, max_iter=60):
+    """Recalibrate each row of a matrix of probability distributions to (approximately) a target entropy.
+    Applies the same heuristic pre-scaling and temperature bounds as :func:`recalibrate_scores`, but solves for
+    all per-row temperatures at once: the entropy of `x ** t` (normalized) decreases monotonically with `t`,
+    so a vectorized bisection on `log(t)` is run for all rows together.
+
+    Parameters:
+        X (array): Probability distributions of shape [n_samples, n_labels] (or a single distribution)
+        target_entropy (float): Target entropy for each row
+        tol (float): Bisection stops when every row's interval on `log(t)` is smaller than this
+        max_iter (int): Maximum number of bisection steps
+
+    Returns:
+        (:class:`numpy.ndarray`): Recalibrated distributions with the shape of `X`
+    """
+    X = np.asarray(X, dtype='float64')
+    single = X.ndim == 1
+    X = np.atleast_2d(X)
+    if X.shape[0] == 0:
+        return X.copy()
+    with np.errstate(divide='ignore'):
+        log_x = np.log(X)
+    log_x = _log_rescale(log_x, np.ones(X.shape[0]))
+    e_x = _row_entropies(log_x)
+    entropy_ratio = e_x / np.log(X.shape[1])
+    ## same heuristics as recalibrate_scores to get entropies in the ball-park of the target
+    t0 = np.select([e_x < 1e-20, e_x < 0.01, entropy_ratio > 0.998, entropy_ratio > 0.994,
+                    entropy_ratio > 0.98, e_x > 2.0],
+                   [0.1, 0.5, 32.0, 16.0, 8.0, 4.0], default=1.0)
+    log_x = _log_rescale(log_x, t0)
+    e_x = _row_entropies(log_x)
+    below = e_x < target_entropy
+    lo = np.where(below, math.log(0.05), 0.0)
+    hi = np.where(below, 0.0, math.log(32.0))
+    for _ in range(max_iter):
+        if np.all(hi - lo < tol):
+            break
+        mid = (lo + hi) / 2.0
+        ## entropy above the target means the temperature (exponent) must increase
+        higher = _row_entropies(_log_rescale(log_x, np.exp(mid))) > target_entropy
+        lo = np.where(higher, mid, lo)
+        hi = np.where(higher, hi, mid)
+    rescaled = np.exp(_log_rescale(log_x, np.exp((lo + hi) / 2.0)))
+    return rescaled[0] if single else rescaled
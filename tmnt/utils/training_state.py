@@ -0,0 +1,107 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Saving and restoring the complete state of a training run so that it can be resumed.
+"""
+
+import os
+import pickle
+import logging
+import mxnet as mx
+from tmnt.utils.random import get_rng_state, set_rng_state
+
+__all__ = ['save_training_state', 'load_training_state', 'get_loader_states', 'set_loader_states']
+
+STATE_FILE = 'training_state.pkl'
+
+
+def _atomic_write(path, write_fn):
+    tmp_path = path + '.tmp'
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+    return os.path.basename(path)
+
+
+def save_training_state(state_dir, model, trainers, state, arrays=None):
+    """Save model parameters, optimizer (trainer) states, random number generator states and a dictionary of
+    loop state (epoch, step counters, ...) to `state_dir`. Files for the new state are written first under
+    names tagged with the epoch; the state file that refers to them is replaced atomically last, so an
+    interrupted save leaves the previous state intact.
+
+    Parameters:
+        state_dir: Directory for the training state (created if needed)
+        model: Gluon block being trained
+        trainers: Dictionary of name to `gluon.Trainer` (None entries are skipped)
+        state: Picklable dictionary of loop state; must include 'epoch' (number of completed epochs)
+        arrays: Dictionary of name to dictionary of NDArrays (e.g. best parameters for early stopping)
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    tag = '.e{}'.format(state['epoch'])
+    files = {'model': _atomic_write(os.path.join(state_dir, 'model.params' + tag), model.save_parameters)}
+    for name, trainer in trainers.items():
+        if trainer is not None:
+            files['trainer_' + name] = _atomic_write(os.path.join(state_dir, 'trainer_{}.states{}'.format(name, tag)),
+                                                     trainer.save_states)
+    for name, array_dict in (arrays or {}).items():
+        if array_dict is not None:
+            files['arrays_' + name] = _atomic_write(os.path.join(state_dir, '{}.arrays{}'.format(name, tag)),
+                                                    lambda path: mx.nd.save(path, array_dict))
+    full_state = dict(state, files=files, rng=get_rng_state())
+    def write_state(path):
+        with open(path, 'wb') as fp:
+            pickle.dump(full_state, fp)
+    _atomic_write(os.path.join(state_dir, STATE_FILE), write_state)
+    ## remove files from earlier saves
+    current = set(files.values())
+    for f in os.listdir(state_dir):
+        if f not in current and (f.startswith('model.params.e') or f.startswith('trainer_') or '.arrays.e' in f):
+            os.remove(os.path.join(state_dir, f))
+    logging.info("Training state after epoch {} saved to {}".format(state['epoch'], state_dir))
+
+
+def load_training_state(state_dir, model, trainers, ctx=mx.cpu()):
+    """Restore a training state written by :func:`save_training_state`. The model parameters and trainer states are
+    loaded in place and the Python and Numpy random number generators are restored, so this should be called
+    immediately before training continues. The MXNet generator state cannot be saved; training loops reseed it at
+    the start of every epoch from a seed kept in the loop state (:func:`tmnt.utils.random.seed_mx_rng_for_epoch`).
+
+    Parameters:
+        state_dir: Directory with the training state
+        model: Gluon block being trained (same architecture as the saved model)
+        trainers: Dictionary of name to `gluon.Trainer` (same names as when saved)
+        ctx: Context for the model parameters
+
+    Returns:
+        (tuple): Tuple containing:
+            - state (dict): loop state as saved
+            - arrays (dict): dictionary of name to dictionary of NDArrays as saved
+    """
+    with open(os.path.join(state_dir, STATE_FILE), 'rb') as fp:
+        state = pickle.load(fp)
+    files = state.pop('files')
+    model.load_parameters(os.path.join(state_dir, files['model']), ctx=ctx)
+    for name, trainer in trainers.items():
+        if trainer is not None:
+            trainer.load_states(os.path.join(state_dir, files['trainer_' + name]))
+    arrays = { k[len('arrays_'):]: mx.nd.load(os.path.join(state_dir, f)) for k, f in files.items() if k.startswith('arrays_') }
+    set_rng_state(state.pop('rng'))
+    logging.info("Resuming training after epoch {} from {}".format(state['epoch'], state_dir))
+    return state, arrays
+
+
+def get_loader_states(loaders):
+    """Sampler states of `loaders`, from the `state_dict` method of loaders that provide one
+    (e.g. :class:`tmnt.data_loading.SamplerDataLoader`); None for other loaders."""
+    return [ loader.state_dict() if loader is not None and hasattr(loader, 'state_dict') else None for loader in loaders ]
+
+
+def set_loader_states(loaders, states):
+    """Restore sampler states returned by :func:`get_loader_states` for the same `loaders`."""
+    if len(loaders) != len(states):
+        raise Exception("Training state has sampler states for {} data loaders but {} were provided"
+                        .format(len(states), len(loaders)))
+    for loader, state in zip(loaders, states):
+        if state is not None:
+            if loader is None or not hasattr(loader, 'load_state_dict'):
+                raise Exception("Saved sampler state cannot be restored to data loader {}".format(type(loader).__name__))
+            loader.load_state_dict(state)
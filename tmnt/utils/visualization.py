@@ -0,0 +1,96 @@
+# coding: utf-8
+# Copyright (c) 2021 The MITRE Corporation.
+"""
+Projection and plotting of validation encodings off the training critical path.
+"""
+
+import os
+import logging
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+__all__ = ['EncodingPlotter']
+
+
+def _plot_encodings(ofile, encodings, labels, n_neighbors, min_dist, metric):
+    ## umap and matplotlib are only needed (and imported) where plots are made
+    import umap
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    umap_model = umap.UMAP(n_neighbors=n_neighbors, min_dist=min_dist, metric=metric)
+    embeddings = umap_model.fit_transform(encodings.astype('float32'))
+    plt.scatter(*embeddings.T, c=labels, s=0.8, alpha=0.9, cmap='coolwarm')
+    plt.savefig(ofile)
+    plt.close("all")
+    return ofile
+
+
+class EncodingPlotter(object):
+    """UMAP projections and scatter plots of the encodings from validation. Validation passes its encodings to
+    `add`, which keeps (a float16 copy of) the most recent ones in a buffer and returns immediately; plots for
+    due epochs are made in a background process so they do not add to validation time.
+
+    Parameters:
+        plot_dir: Output directory for the plots ('plot_<epoch>.png')
+        plot_every: Plot the encodings of every `plot_every`-th validation; 0 plots only the final validation
+            (when :meth:`close` is called at the end of training)
+        n_neighbors: UMAP number of neighbors
+        min_dist: UMAP minimum distance
+        metric: UMAP distance metric
+        background: Make plots in a background process (otherwise in the calling process)
+    """
+    def __init__(self, plot_dir, plot_every=1, n_neighbors=4, min_dist=0.5, metric='euclidean', background=True):
+        self.plot_dir = plot_dir
+        self.plot_every = plot_every
+        self.umap_args = (n_neighbors, min_dist, metric)
+        self.background = background
+        self._buffer = None ## (epoch, encodings, labels) from the most recent validation
+        self._plotted = set()
+        self._pending = []
+        self._executor = None
+
+    def add(self, epoch, encodings, labels):
+        """Buffer the `encodings` (shape [n_samples, n_latent]) and `labels` (used for colors) of validation at
+        `epoch`, and queue a plot if this epoch is due."""
+        self._buffer = (epoch, np.asarray(encodings, dtype='float16'), np.asarray(labels))
+        if self.plot_every > 0 and (epoch + 1) % self.plot_every == 0:
+            self._submit()
+        self._collect()
+
+    def _submit(self):
+        epoch, encodings, labels = self._buffer
+        if epoch in self._plotted:
+            return
+        self._plotted.add(epoch)
+        os.makedirs(self.plot_dir, exist_ok=True)
+        ofile = os.path.join(self.plot_dir, 'plot_{}.png'.format(epoch))
+        if self.background:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+            self._pending.append(self._executor.submit(_plot_encodings, ofile, encodings, labels, *self.umap_args))
+        else:
+            _plot_encodings(ofile, encodings, labels, *self.umap_args)
+
+    def _collect(self, wait=False):
+        pending = []
+        for future in self._pending:
+            if wait or future.done():
+                try:
+                    logging.info("Encoding plot written to {}".format(future.result()))
+                except Exception as e:
+                    logging.error("Encoding plot failed: {}".format(e))
+            else:
+                pending.append(future)
+        self._pending = pending
+
+    def close(self):
+        """Plot the most recent encodings (if not already plotted) and wait for all plots to be written."""
+        if self._buffer is not None:
+            self._submit()
+            self._buffer = None
+        self._collect(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None